@@ -0,0 +1,119 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the adaptive bitrate (ABR) algorithms of the clients.
+
+When a video has several renditions (several rows with the same id_video and
+id_server in the database, with different bitrates and sizes), an ABR client
+downloads it segment by segment, see :func:`model.Client.set_abr`. Before
+each segment, the algorithm chooses the rendition from the throughput measured
+on the previous segments and the level of the play buffer.
+
+.. code-block:: python
+
+    client.set_abr(abr.create('throughput'), max_buffer=30)
+
+To write your own algorithm, extend :class:`ABRAlgorithm` and implement
+:func:`ABRAlgorithm.choose`.
+
+Code documentation
+==================
+"""
+import abc
+from abc import ABCMeta
+
+
+class ABRAlgorithm(metaclass=ABCMeta):
+    """ Common base of the ABR algorithms, one instance per client.
+
+        Keeps an estimate of the throughput, an exponentially weighted moving
+        average of the throughput of the segments downloaded.
+
+        Args:
+            smoothing (float): weight of the last segment in the estimate
+    """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.throughput = None
+        """ estimated throughput in kb/s, None before the first segment """
+
+    def segment_downloaded(self, size, download_time):
+        """ Updates the throughput estimate
+
+            Args:
+                size (float): size of the segment, in kb
+                download_time (float): from the request to the last chunk,
+                                       in seconds
+        """
+        if download_time <= 0:
+            return
+        sample = size/download_time
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput += self.smoothing*(sample - self.throughput)
+
+    @abc.abstractmethod
+    def choose(self, bitrates, buffer_level, current):
+        """ Chooses the rendition of the next segment
+
+            Args:
+                bitrates (list): bitrates of the renditions in kb/s, ascending
+                buffer_level (float): seconds of video in the buffer
+                current (int): index of the rendition of the last segment
+
+            Returns:
+                the index of the rendition
+        """
+        pass
+
+class ThroughputRule(ABRAlgorithm):
+    """ Highest bitrate below a part of the estimated throughput
+
+        Args:
+            safety (float): part of the throughput which can be used
+    """
+
+    def __init__(self, safety=0.9, smoothing=0.3):
+        ABRAlgorithm.__init__(self, smoothing)
+        self.safety = safety
+
+    def choose(self, bitrates, buffer_level, current):
+        if self.throughput is None:
+            return 0
+        best = 0
+        for i, bitrate in enumerate(bitrates):
+            if bitrate <= self.safety*self.throughput:
+                best = i
+        return best
+
+class BufferRule(ABRAlgorithm):
+    """ Bitrate depending only on the buffer level: the lowest one below
+        the reservoir, the highest one above reservoir+cushion, and linear
+        in between (buffer-based adaptation).
+
+        Args:
+            reservoir (float): in seconds
+            cushion (float): in seconds
+    """
+
+    def __init__(self, reservoir=5, cushion=10, smoothing=0.3):
+        ABRAlgorithm.__init__(self, smoothing)
+        self.reservoir = reservoir
+        self.cushion = cushion
+
+    def choose(self, bitrates, buffer_level, current):
+        if buffer_level <= self.reservoir:
+            return 0
+        if buffer_level >= self.reservoir+self.cushion:
+            return len(bitrates)-1
+        return int((buffer_level-self.reservoir)/self.cushion*(len(bitrates)-1))
+
+ALGORITHMS = {'throughput': ThroughputRule, 'buffer': BufferRule}
+""" the algorithms which can be given by name in the configuration """
+
+def create(name):
+    """ Returns a new instance of the algorithm called name in ALGORITHMS """
+    return ALGORITHMS[name]()
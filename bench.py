@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#coding=utf-8
+# benchmarks of the loading of the input files
+
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+import traces
+
+def write_fake_trace(path, nb_rows, nb_clients=5000, nb_videos=20000, nb_servers=4):
+    """ Writes a random trace file with the same format as fake_trace.dat """
+    tmstp = 1405699506
+    with open(path, 'w') as f:
+        f.write('# benchmark trace\n')
+        f.write('"id_client","req_timestamp","id_video","id_server"\n')
+        for i in range(nb_rows):
+            tmstp += random.randint(0, 3)
+            f.write('%d,%d,%d,%d\n' % (random.randint(1, nb_clients), tmstp,
+                                       random.randint(1, nb_videos),
+                                       random.randint(1, nb_servers)))
+
+def load_trace_rows(file_path):
+    """ Reference: the row by row loader the orchestrator used before
+        traces.load_trace_arrays (without the creation of the clients).
+    """
+    first_tmstp = None
+    last_delay = 0
+    events = []
+    last_media = dict()
+    trace_file = open(file_path, 'r')
+    trace_reader = csv.DictReader(filter(lambda row: row[0]!='#', trace_file))
+    for row in trace_reader:
+        id_client = int(row['id_client'])+1000
+        if first_tmstp is None:
+            first_tmstp = float(row['req_timestamp'])
+        delay = float(row['req_timestamp']) - first_tmstp
+        # what Client.two_in_a_row_protection did at runtime
+        if last_media.get(id_client) == row['id_video']:
+            continue
+        last_media[id_client] = row['id_video']
+        events.append({'delay_abs': delay, 'delay': delay - last_delay,
+                       'id_client': id_client, 'id_video': row['id_video'],
+                       'id_server': int(row['id_server'])})
+        last_delay = delay
+    trace_file.close()
+    return events
+
+def load_trace_vectorized(file_path):
+    return traces.load_trace_arrays(file_path, traces.IdInterner(),
+                                    traces.IdInterner())
+
+def bench(func, path, repeat):
+    """ Returns the best throughput of func on path, in MB/s """
+    size = os.path.getsize(path)/(1024*1024)
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return size/best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000, help="number of requests in the generated trace")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best one is kept")
+    parser.add_argument("--trace", metavar='/path/to/trace.dat', help="use this trace instead of a generated one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.trace
+        if not path:
+            path = os.path.join(tmp, 'trace.dat')
+            write_fake_trace(path, args.rows)
+        print("Trace: "+path+" ("+str(round(os.path.getsize(path)/(1024*1024), 1))+" MB)")
+
+        rows = bench(load_trace_rows, path, args.repeat)
+        print("Row by row loader: "+str(round(rows, 1))+" MB/s")
+        vectorized = bench(load_trace_vectorized, path, args.repeat)
+        print("Vectorized loader: "+str(round(vectorized, 1))+" MB/s (x"+str(round(vectorized/rows, 1))+")")
@@ -5,6 +5,7 @@
 import config
 import orchestration
 import metrics
+import resultcache
 import time
 import argparse
 import sys
@@ -16,12 +17,16 @@ import copy
 
 #def compare(prox1, prox2):
 
-def run_simu(conf_orch, data_out):
+def run_simu(conf_orch, data_out, cache=None):
     """ This is used to run two simulations in two different threads.
 
         Args:
             conf_orch (dict): configuration for the Orchestrator
             data_out (str): path to save the data output
+            cache (:class:`resultcache.ResultCache`): if given, the result is
+                    taken from this store when the same simulation was already
+                    run, and stored in it otherwise, with the files written
+                    in data_out.
     """
     o = orchestration.Orchestrator(conf=conf_orch)
     #o.load_trace()
@@ -29,6 +34,14 @@ def run_simu(conf_orch, data_out):
     o.skip_inactivity = conf_orch['orchestration']['skip_inactivity']
     o.method = conf_orch['orchestration']['method']
 
+    key = None
+    if cache:
+        key = o.fingerprint()
+        result = cache.get(key, data_out)
+        if result is not None:
+            print("Result found in the cache: "+key)
+            return result
+
     o.set_up()
 
     #cProfile.run('o.run_simulation()')
@@ -37,7 +50,11 @@ def run_simu(conf_orch, data_out):
     o.run_simulation()
     o.wait_end()
 
-    return o.gather_statistics(data_out, graphs=False)
+    result = o.gather_statistics(data_out, graphs=False)
+    if cache:
+        cache.put(key, result, o.output_files)
+
+    return result
 
 if __name__ == "__main__":
 
@@ -47,7 +64,10 @@ if __name__ == "__main__":
     parser.add_argument("--skip", dest='skip_inactivity', help="override the ini conf to skip inactivity", action="store_true")
     parser.add_argument("--no-skip", dest='skip_inactivity', help="override the ini conf to skip inactivity", action="store_false")
     parser.set_defaults(skip_inactivity=None)
-    parser.add_argument("--trace", metavar='/path/to/trace.dat', help="override the ini conf for the trace file")
+    parser.add_argument("--trace", nargs='+', metavar='/path/to/trace.dat', help="override the ini conf for the trace file, can be several files or glob patterns, compressed or not (.gz, .xz, .bz2)")
+    parser.add_argument("--from", dest='window_start', type=float, metavar='64800', help="replay the trace from this time, in seconds since its beginning")
+    parser.add_argument("--to", dest='window_end', type=float, metavar='79200', help="replay the trace until this time, in seconds since its beginning")
+    parser.add_argument("--warmup", type=float, metavar='3600', help="seconds of trace replayed before --from to fill the cache, without counting in the metrics")
     parser.add_argument("--db", metavar='/path/to/db.dat', help="override the ini conf for the database file")
     parser.add_argument("--consume", dest='consume_videos', help="override the ini conf to consume videos", action="store_true")
     parser.add_argument("--no-consume", dest='consume_videos', help="override the ini conf to consume videos", action="store_false")
@@ -58,6 +78,8 @@ if __name__ == "__main__":
     parser.add_argument("--parallel", help="use true parallelism when comparing", action="store_true")
     parser.set_defaults(parallel=False)
     parser.add_argument("--compare-to", dest='proxy2', metavar='LRUProxy', help="compare the first proxy to this one")
+    parser.add_argument("--no-cache", dest='use_cache', help="always run the simulation, even if the result is in the cache", action="store_false")
+    parser.set_defaults(use_cache=True)
     args = parser.parse_args()
 
     if args.verbosity:
@@ -77,7 +99,8 @@ if __name__ == "__main__":
         config.set_consume_videos(args.consume_videos)
 
     if args.trace:
-        config.set_trace_file(args.trace)
+        config.set_trace_file(','.join(args.trace))
+    config.set_window(args.window_start, args.window_end, args.warmup)
     if args.db:
         config.set_db_file(args.db)
     if args.speed:
@@ -92,6 +115,12 @@ if __name__ == "__main__":
     conf_orch = config.get_orchestration_config_dict()
 
     print(str(conf))
+
+    cache = None
+    if args.use_cache and config.use_result_cache():
+        cache = resultcache.ResultCache(
+                        conf['results'].get('cache_dir', '.results_cache'),
+                        conf['results'].get('cache_max_size', 50))
     
     if args.proxy2:
         """ case where we want to have a comparison """
@@ -100,7 +129,7 @@ if __name__ == "__main__":
 
         
         
-        run_simu_out = functools.partial(run_simu, data_out=conf['data']['data_out'])
+        run_simu_out = functools.partial(run_simu, data_out=conf['data']['data_out'], cache=cache)
 
         result = []
 
@@ -136,7 +165,7 @@ if __name__ == "__main__":
         ps1 = None
         
         plts = metrics.PlotStats()
-        (lpc1, ps1) = run_simu(conf_orch, conf['data']['data_out'])
+        (lpc1, ps1) = run_simu(conf_orch, conf['data']['data_out'], cache)
         plts.plot_bar(conf['data']['data_out'], 
                       (conf['proxy']['proxy_type'],), 
                       lpc1)
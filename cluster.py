@@ -0,0 +1,229 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the cluster mode, in which the content is sharded over
+several caching proxies: each client is connected to all the nodes of the
+cluster and routes each request to one of them by consistent hashing of its
+(idServer, idVideo) pair.
+
+The nodes are placed on a :class:`HashRing` several times (the virtual
+nodes), so that the videos are spread evenly and adding or removing a node
+only moves the videos of this node. The :class:`ConsistentHashRouter` is
+shared by all the clients, counts the requests routed to each node and
+records the churn of each change of the cluster. The connection of each
+client is a :class:`RoutedConnection`, which sends each request on the
+connection to the right node.
+
+.. code-block:: python
+
+    router = cluster.ConsistentHashRouter(virtual_nodes=100)
+    for proxy in nodes:
+        router.add_node(proxy.get_id())
+    # the clients are connected to all the nodes
+    connections = {proxy.get_id(): client.connect_to(proxy) for proxy in nodes}
+    client.set_connection(cluster.RoutedConnection(router, connections))
+    ...
+    router.remove_node('node2', keys, sizes, time=600)
+    router.get_changes()
+
+Code documentation
+==================
+"""
+import bisect
+import collections as collec
+import hashlib
+import threading
+
+import numpy as np
+
+
+def _hash(value):
+    """ Position of a value on the ring, a 64 bits integer """
+    digest = hashlib.md5(str(value).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class HashRing:
+    """ Consistent hashing ring with virtual nodes. Not thread safe, see
+        :class:`ConsistentHashRouter`.
+
+        Args:
+            virtual_nodes (int): number of positions of each node on the ring
+    """
+
+    def __init__(self, virtual_nodes=100):
+        self.virtual_nodes = virtual_nodes
+        self._points = []
+        """ sorted positions of the virtual nodes """
+        self._owners = []
+        """ node of each position """
+        self.nodes = []
+        """ the nodes on the ring, in the order they were added """
+
+    def add_node(self, node):
+        """ Places a node on the ring, does nothing if it is already on it """
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.virtual_nodes):
+            point = _hash((node, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove_node(self, node):
+        """ Removes a node from the ring, does nothing if it is not on it """
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        kept = [i for i, owner in enumerate(self._owners) if owner != node]
+        self._points = [self._points[i] for i in kept]
+        self._owners = [self._owners[i] for i in kept]
+
+    def node_for(self, key):
+        """ Returns the node of a key: the first virtual node after its
+            position, clockwise. None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._owners[index]
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class ConsistentHashRouter:
+    """ The ring of the cluster, shared by the clients, with the load of
+        each node and the churn of the changes of the cluster.
+
+        Args:
+            virtual_nodes (int): number of positions of each node on the ring
+    """
+
+    def __init__(self, virtual_nodes=100):
+        self._ring = HashRing(virtual_nodes)
+        self._lock = threading.Lock()
+        self._requests = collec.Counter()
+        """ number of requests routed to each node """
+        self._changes = []
+
+    @property
+    def nodes(self):
+        """ the nodes currently on the ring """
+        return list(self._ring.nodes)
+
+    def node_for(self, key):
+        """ Returns the node of key, without counting a request """
+        with self._lock:
+            return self._ring.node_for(key)
+
+    def route(self, key):
+        """ Returns the node a request for key is sent to, and counts it """
+        with self._lock:
+            node = self._ring.node_for(key)
+            self._requests[node] += 1
+        return node
+
+    def add_node(self, node, keys=None, sizes=None, time=None):
+        """ Adds a node to the cluster. When the keys (and sizes) of the 
+            videos are given, the churn is computed and the change is 
+            recorded, see :func:`get_changes`.
+        """
+        return self._change(self._ring.add_node, '+', node, keys, sizes, time)
+
+    def remove_node(self, node, keys=None, sizes=None, time=None):
+        """ Removes a node from the cluster, see :func:`add_node` """
+        return self._change(self._ring.remove_node, '-', node, keys, sizes, time)
+
+    def _change(self, apply, sign, node, keys, sizes, time):
+        if keys is None:
+            with self._lock:
+                apply(node)
+            return None
+        with self._lock:
+            before = [self._ring.node_for(key) for key in keys]
+            apply(node)
+            moved = np.array([self._ring.node_for(key) != owner
+                              for key, owner in zip(keys, before)], dtype=bool)
+            nb_nodes = len(self._ring)
+        if sizes is None:
+            sizes = np.ones(len(keys))
+        sizes = np.asarray(sizes, dtype=np.float64)
+        change = {'time': time, 'change': sign+str(node), 'nb_nodes': nb_nodes,
+                  'moved_keys': int(moved.sum()),
+                  'churn': moved.mean() if len(keys) else 0,
+                  'moved_kb': sizes[moved].sum() if len(keys) else 0}
+        self._changes.append(change)
+        return change
+
+    def reset_load_stats(self):
+        """ Sets the number of requests of all the nodes back to zero """
+        with self._lock:
+            self._requests.clear()
+
+    def get_changes(self):
+        """ Returns the changes of the cluster, as dictionaries with:
+
+            - time: when the change happened
+            - change: +node or -node
+            - nb_nodes: number of nodes after the change
+            - moved_keys: number of videos now routed to another node
+            - churn: moved_keys over the number of videos
+            - moved_kb: total size of the moved videos
+        """
+        return list(self._changes)
+
+    def get_load_stats(self, nodes=None):
+        """ Returns the number of requests of each node, by node, and the
+            imbalance: the highest number of requests over the mean, 1 when
+            the load is perfectly balanced.
+
+            Args:
+                nodes (list): the nodes to count, all the nodes which got a
+                              request or are on the ring by default
+        """
+        with self._lock:
+            if nodes is None:
+                nodes = list(self._ring.nodes) + [node for node in self._requests
+                                                  if node not in self._ring]
+            requests = {node: self._requests[node] for node in nodes}
+        counts = np.array(list(requests.values()), dtype=np.float64)
+        imbalance = counts.max()/counts.mean() if len(counts) and counts.sum() else 0
+        return requests, imbalance
+
+
+class RoutedConnection:
+    """ The connection of a client to the cluster: sends each request on the
+        connection to its node, like a single :class:`model.Connection`.
+
+        The cancel of a request goes to the node of the request, even if the
+        cluster changed meanwhile.
+
+        Args:
+            router (:class:`ConsistentHashRouter`): the router of the cluster
+            connections (dict): the :class:`model.Connection` to each node,
+                                by node
+    """
+
+    def __init__(self, router, connections):
+        self.router = router
+        self.connections = connections
+        self._last_node = dict()
+        """ node of the last request for each key """
+
+    def send(self, data, mode='normal', callback=None, dropped=None):
+        pld = data['payload']
+        key = (pld['idServer'], pld['idVideo'])
+        if data['plType'] == 'cancel':
+            node = self._last_node.get(key) or self.router.node_for(key)
+        else:
+            node = self.router.route(key)
+            self._last_node[key] = node
+        self.connections[node].send(data, mode, callback, dropped)
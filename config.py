@@ -12,6 +12,23 @@ wait_acc = 1
 
 raw_conf = configparser.ConfigParser()
 
+BOOLEAN_OPTIONS = ['skip_inactivity', 'consume_videos', 'enabled', 'siblings',
+                   'p2p', 'prefetch', 'partition_elastic']
+""" options converted to bool in the configuration dictionnaries """
+FLOAT_OPTIONS = ['speed', 'wait_acc', 'cache_size', 'up', 'down', 'lag_up', 
+                 'lag_down', 'max_chunk', 'cache_max_size', 
+                 'window_start', 'window_end', 'warmup', 'index_step',
+                 'idle_timeout', 'egress_bandwidth', 'egress_interval',
+                 'max_concurrency', 'service_time', 'stats_interval',
+                 'max_buffer', 'segment_duration', 'watch_mean', 'watch_seed',
+                 'cluster_size', 'virtual_nodes', 'digest_interval', 
+                 'digest_fp_rate', 'local_cache_size', 'p2p_lag', 
+                 'max_uploads', 'ram_size', 'ram_latency', 'ram_bandwidth',
+                 'disk_latency', 'disk_bandwidth', 'prefetch_top_k', 
+                 'prefetch_half_life', 'prefetch_max_videos', 'workers',
+                 'request_cost', 'byte_cost', 'lock_shards']
+""" options converted to float in the configuration dictionnaries """
+
 def load_config_file(file = 'config.ini'):
     global speed
     global wait_acc
@@ -39,9 +56,9 @@ def get_sub_config_dict(file=None, sublist=None):
                 if sublist == None or section in sublist:
                     conf[section] = {}
                     for option in raw_conf.options(section):
-                        if option in ['skip_inactivity', 'consume_videos']:
+                        if option in BOOLEAN_OPTIONS:
                             conf[section][option] = raw_conf.getboolean(section, option)
-                        elif option in ['speed', 'wait_acc', 'cache_size', 'up', 'down', 'lag_up', 'lag_down', 'max_chunk']:
+                        elif option in FLOAT_OPTIONS:
                             conf[section][option] = raw_conf.getfloat(section, option)
                         else:
                             conf[section][option] = raw_conf.get(section, option)
@@ -53,6 +70,12 @@ def get_config_dict(file=None):
 def get_orchestration_config_dict(file=None):
     return get_sub_config_dict(file, ['orchestration', 'proxy', 'clients', 'servers'])
 
+def use_result_cache():
+    """ True if the results of the simulations should be cached on disk """
+    global raw_conf
+    return raw_conf.has_section('results') and \
+           raw_conf.getboolean('results', 'enabled', fallback=True)
+
 def set_skip_activity(value):
     global raw_conf
     raw_conf.set('orchestration', 'skip_inactivity', str(value))
@@ -65,6 +88,19 @@ def set_trace_file(value):
     global raw_conf
     raw_conf.set('orchestration', 'trace_file', value)
 
+def set_window(start=None, end=None, warmup=None):
+    """ Replays only the part of the trace between start and end (seconds
+        since the beginning of the trace), warmup seconds before start
+        filling the cache without being counted in the metrics.
+    """
+    global raw_conf
+    if start is not None:
+        raw_conf.set('orchestration', 'window_start', str(start))
+    if end is not None:
+        raw_conf.set('orchestration', 'window_end', str(end))
+    if warmup is not None:
+        raw_conf.set('orchestration', 'warmup', str(warmup))
+
 def set_db_file(value):
     global raw_conf
     raw_conf.set('orchestration', 'db_file', value)
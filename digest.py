@@ -0,0 +1,72 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the cache digests exchanged by the sibling proxies: a
+Bloom filter of the keys of the videos in a cache (see
+:func:`model.CachingProxy.set_siblings`). A Bloom filter never misses a key
+which was added, but can contain keys which were not (false positives), with
+a probability fp_rate when it holds nb_items keys.
+
+.. code-block:: python
+
+    bloom = digest.BloomFilter.from_keys(keys, fp_rate=0.01)
+    if key in bloom:
+        ...
+    bloom.size_kb
+
+Code documentation
+==================
+"""
+import hashlib
+import math
+
+import numpy as np
+
+
+class BloomFilter:
+    """ Bit array with k hash functions, sized for nb_items keys.
+
+        Args:
+            nb_items (int): number of keys expected
+            fp_rate (float): probability of false positive with nb_items keys
+    """
+
+    MIN_BITS = 64
+
+    def __init__(self, nb_items, fp_rate=0.01):
+        nb_items = max(nb_items, 1)
+        self.nb_bits = max(int(math.ceil(-nb_items*math.log(fp_rate)/math.log(2)**2)),
+                           self.MIN_BITS)
+        self.nb_hashes = max(int(round(self.nb_bits/nb_items*math.log(2))), 1)
+        self._bits = np.zeros(self.nb_bits, dtype=bool)
+        self.nb_items = 0
+        """ number of keys added """
+
+    @classmethod
+    def from_keys(cls, keys, fp_rate=0.01):
+        """ Returns a filter sized for and containing the keys """
+        keys = list(keys)
+        bloom = cls(len(keys), fp_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, key):
+        """ The bits of a key, by double hashing of its md5 """
+        digest = hashlib.md5(str(key).encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i*h2) % self.nb_bits for i in range(self.nb_hashes)]
+
+    def add(self, key):
+        self._bits[self._positions(key)] = True
+        self.nb_items += 1
+
+    def __contains__(self, key):
+        return bool(self._bits[self._positions(key)].all())
+
+    @property
+    def size_kb(self):
+        """ size of the filter when sent, in kb """
+        return self.nb_bits/1024
@@ -0,0 +1,111 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the locks of the caching proxies (see
+:class:`model.CachingProxy`), which are called from the threads of all their
+connections at the same time.
+
+An :class:`InstrumentedLock` is a reentrant lock counting how often it was
+taken, how often a thread had to wait for it (the contention) and how long
+the threads waited, in wall-clock seconds: the time lost to the locks by the
+simulator itself, not by the simulated proxy. An uncontended acquisition
+costs a single non-blocking try, the clock is only read when the lock is
+busy.
+
+A :class:`ShardedLock` is a set of such locks, the lock of a key being
+chosen by its hash, so that the requests for different videos rarely wait
+for each other while those for the same video are serialized.
+
+.. code-block:: python
+
+    shards = locks.ShardedLock(16)
+    with shards.for_key(id_video):
+        ...
+    print(shards.get_stats())
+
+Code documentation
+==================
+"""
+import threading
+import time
+
+
+class InstrumentedLock:
+    """ A reentrant lock measuring its contention """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset_stats()
+
+    def acquire(self):
+        if not self._lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            # the counters are only changed with the lock held
+            self.contended += 1
+            self.wait_time += time.perf_counter() - start
+        self.acquisitions += 1
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def reset_stats(self):
+        """ Sets the counters back to zero """
+        self.acquisitions = 0
+        """ number of times the lock was taken """
+        self.contended = 0
+        """ of those, number of times a thread had to wait """
+        self.wait_time = 0
+        """ total wall-clock seconds the threads waited """
+
+    def get_stats(self):
+        """ Returns the acquisitions, the contended ones, the contention
+            (contended/acquisitions) and the wait time, in seconds
+        """
+        return {'acquisitions': self.acquisitions, 'contended': self.contended,
+                'contention': self.contended/self.acquisitions if self.acquisitions else 0,
+                'wait_time': self.wait_time}
+
+
+class ShardedLock:
+    """ One :class:`InstrumentedLock` per shard of the keys.
+
+        Args:
+            nb_shards (int): number of locks
+    """
+
+    def __init__(self, nb_shards=16):
+        self.shards = [InstrumentedLock() for _ in range(max(1, int(nb_shards)))]
+
+    def for_key(self, key):
+        """ Returns the lock of the shard of a key """
+        return self.shards[hash(key) % len(self.shards)]
+
+    def reset_stats(self):
+        for lock in self.shards:
+            lock.reset_stats()
+
+    def get_stats(self):
+        """ Returns the statistics of all the shards together, see
+            :func:`InstrumentedLock.get_stats`, with the highest number of
+            contended acquisitions of a shard (max_contended), to spot a hot
+            shard.
+        """
+        stats = [lock.get_stats() for lock in self.shards]
+        acquisitions = sum(s['acquisitions'] for s in stats)
+        contended = sum(s['contended'] for s in stats)
+        return {'acquisitions': acquisitions, 'contended': contended,
+                'contention': contended/acquisitions if acquisitions else 0,
+                'wait_time': sum(s['wait_time'] for s in stats),
+                'max_contended': max(s['contended'] for s in stats)}
+
+    def __len__(self):
+        return len(self.shards)
@@ -3,9 +3,10 @@
 Presentation
 ============
 
-This module contains everything related to the metrics. The Decartors are the
-metrics for the Client class, the ProxyHitCounter is to be inherited from by 
-proxies.
+This module contains everything related to the metrics. The ClientMetrics
+observe the clients and the ProxyMetrics the caching proxies, through their
+hooks. The decorators time the methods of any class. The ProxyHitCounter is 
+to be inherited from by proxies and the ServerLoadCounter by video servers.
 
 Using a decorator
 =================
@@ -17,7 +18,7 @@ To use a decorator to monitor a class:
     # this will time how long it takes to start playing a video along with how many times
     # the video stopped during playback.
     @TwoMethodsTimerAndCounter('request_media', 'start_playback', '_video_stopped', 0, 'id_media')
-    class MetricClient(Client):
+    class StopClient(Client):
         pass
 
 A more simple example with TwoMethodsTimer applied to a standard class:
@@ -47,11 +48,36 @@ foobar
 >>> print(f.latencies)
 [1.02]
 
+The decorators wrap each instance, every attribute access going through the
+wrapper. The clients and the caching proxies have hooks instead, called 
+directly and costing nothing without observer.
+
+Using the hooks
+===============
+
+An observer has some of the methods named in the HOOKS of the class (see 
+:class:`Observable`), and is registered once:
+
+.. code-block:: python
+
+    client = Client(1001, "c1")
+    client_metrics = ClientMetrics()
+    client.add_observer(client_metrics)
+    proxy = LRUProxy(0, "Proxy")
+    proxy_metrics = ProxyMetrics()
+    proxy.add_observer(proxy_metrics)
+    ...
+    print(client_metrics.latencies.values(), client_metrics.stalls)
+    print(proxy_metrics.hit_ratio())
+
+The metrics are kept in preallocated numpy arrays (see :class:`Buffer`).
+
 
 Code documentation
 ==================
 """
 import time
+import threading
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -203,6 +229,14 @@ def TwoMethodsTimerAndCounter(func1, func2, func3, param_pos=None, param_name=No
                 self.__counter += 1
                 return self.__oldFunc3( *args, **kargs)
 
+            def reset_metrics(self):
+                """ Forgets the latencies, the counter and the pending 
+                    timers, for instance at the end of a warm-up period.
+                """
+                self.__startTime.clear()
+                self.__latencies.clear()
+                self.__counter = 0
+
             def __getattr__(self, attrname):
                 if(attrname is 'counter'):
                     return self.__counter
@@ -273,14 +307,221 @@ def TwoMethodsTimer(func1, func2):                        # On @ decorator
         return Wrapper
     return ClassBuilder
 
+class Observable:
+    """ Class to inherit from to have observers, see :func:`add_observer`.
+
+        HOOKS are the names of the methods an observer can have. The 
+        callbacks of each hook are kept bound, in a tuple called 
+        _<hook>_hooks, that the inherited class calls in a loop: nothing to
+        look up on each call, and an empty loop without observer.
+    """
+
+    HOOKS = ()
+
+    def __init__(self):
+        for hook in self.HOOKS:
+            setattr(self, '_'+hook+'_hooks', ())
+
+    def add_observer(self, observer):
+        """ Calls the methods of observer named like the hooks, from now on.
+            An observer does not need all of them.
+        """
+        for hook in self.HOOKS:
+            callback = getattr(observer, hook, None)
+            if callback is not None:
+                name = '_'+hook+'_hooks'
+                setattr(self, name, getattr(self, name) + (callback,))
+
+    def remove_observer(self, observer):
+        for hook in self.HOOKS:
+            callback = getattr(observer, hook, None)
+            if callback is not None:
+                name = '_'+hook+'_hooks'
+                setattr(self, name, tuple(c for c in getattr(self, name) if c != callback))
+
+
+class Buffer:
+    """ Values appended to a preallocated numpy array, which doubles when
+        full. Not thread safe.
+
+        Args:
+            capacity (int): initial number of values
+            dtype: type of the values
+    """
+
+    def __init__(self, capacity=64, dtype=np.float64):
+        self._data = np.empty(max(1, capacity), dtype)
+        self._size = 0
+
+    def append(self, value):
+        if self._size == len(self._data):
+            data = np.empty(2*len(self._data), self._data.dtype)
+            data[:self._size] = self._data
+            self._data = data
+        self._data[self._size] = value
+        self._size += 1
+
+    def values(self):
+        """ Returns the values appended, as a view of the array """
+        return self._data[:self._size]
+
+    def tolist(self):
+        return self.values().tolist()
+
+    def clear(self):
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+
+class Histogram:
+    """ Running aggregates of positive values, like delays in seconds: 
+        their number, sum and maximum, and their counts in fixed bins of 
+        logarithmic width, so that the memory does not depend on the number
+        of values. The percentiles are the upper bound of their bin, within 
+        about 12% with 20 bins per decade. Not thread safe.
+
+        Args:
+            low (float): the values below are counted as 0
+            high (float): upper bound of the last bin, the values above are
+                          counted in it
+            bins_per_decade (int): resolution of the bins
+    """
+
+    def __init__(self, low=1e-6, high=1e4, bins_per_decade=20):
+        self.low = low
+        self.bins_per_decade = bins_per_decade
+        nb_bins = int(np.ceil(np.log10(high/low)*bins_per_decade))
+        self.edges = low*10**(np.arange(nb_bins+1)/bins_per_decade)
+        """ upper bound of each bin, the first one for the values below low """
+        self.clear()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value < self.low:
+            self.counts[0] += 1
+        else:
+            i = int(np.log10(value/self.low)*self.bins_per_decade)+1
+            self.counts[min(i, len(self.counts)-1)] += 1
+
+    def mean(self):
+        return self.total/self.count if self.count else 0
+
+    def percentile(self, p):
+        """ Returns the upper bound of the bin of the p-th percentile (0 to
+            100), at most the maximum, 0 without values
+        """
+        if not self.count:
+            return 0
+        i = int(np.searchsorted(np.cumsum(self.counts), p/100*self.count))
+        if i == 0:
+            return 0
+        return min(self.edges[i], self.max)
+
+    def clear(self):
+        self.counts = np.zeros(len(self.edges), dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __len__(self):
+        return self.count
+
+
+class ClientMetrics:
+    """ Observer of a client (see :func:`model.Client.add_observer`): the 
+        startup latency of each video, from its request to the start of its
+        playback, and the times the videos stopped, in seconds of simulation.
+    """
+
+    def __init__(self, capacity=16):
+        self.latencies = Buffer(capacity)
+        self.stall_times = Buffer(capacity)
+        self._started = dict()
+        """ time of the request of each video not playing yet """
+
+    def on_request(self, id_media):
+        self._started[id_media] = simu.time_()
+
+    def on_playback(self, id_media):
+        start = self._started.pop(id_media, None)
+        if start is not None:
+            self.latencies.append(simu.time_() - start)
+
+    def on_stall(self, id_media):
+        self.stall_times.append(simu.time_())
+
+    @property
+    def stalls(self):
+        """ number of times the videos stopped """
+        return len(self.stall_times)
+
+    def reset(self):
+        """ Forgets the latencies, the stalls and the videos requested, for
+            instance at the end of a warm-up period
+        """
+        self.latencies.clear()
+        self.stall_times.clear()
+        self._started.clear()
+
+
+class ProxyMetrics:
+    """ Observer of a caching proxy (see :func:`model.CachingProxy.add_observer`):
+        the time, size and outcome of each request of the clients, to follow
+        the hit ratio over time.
+    """
+
+    def __init__(self, capacity=1024):
+        self.times = Buffer(capacity)
+        self.sizes = Buffer(capacity)
+        """ kb of the videos """
+        self.hits = Buffer(capacity, np.bool_)
+        # the connections call the proxy from several threads
+        self._lock = threading.Lock()
+
+    def _record(self, size_kb, hit):
+        with self._lock:
+            self.times.append(simu.time_())
+            self.sizes.append(size_kb)
+            self.hits.append(hit)
+
+    def on_hit(self, key, size_kb):
+        self._record(size_kb, True)
+
+    def on_miss(self, key, size_kb):
+        self._record(size_kb, False)
+
+    def hit_ratio(self, start=None):
+        """ Part of the requests since start (all by default) which were hits """
+        with self._lock:
+            hits = self.hits.values()
+            if start is not None:
+                hits = hits[np.searchsorted(self.times.values(), start):]
+            return hits.mean() if len(hits) else 0
+
+    def reset(self):
+        with self._lock:
+            self.times.clear()
+            self.sizes.clear()
+            self.hits.clear()
+
 class ProxyHitCounter:
     """ Class to inherit from for proxies to have hit stats.
 
         The inherited class must call _from_cache() and _from_server() when
-        serving a video from the cache or not. Then, get_stats() can be used.
+        serving a video from the cache or not, and _not_sent() for the part
+        of a video which was cancelled. Then, get_stats() can be used. The 
+        counters can be changed from several threads at the same time.
     """
     
     def __init__(self):
+        self._hit_lock = threading.Lock()
+        self._reset_hit_counters()
+
+    def _reset_hit_counters(self):
         self._cache_hits = 0
         self._nb_served = 0
         self._byte_served = 0
@@ -293,11 +534,12 @@ class ProxyHitCounter:
             size = size_kB
         elif size_kb:
             size = size_kb/8
-        self._byte_cache += size
-        self._byte_served += size
+        with self._hit_lock:
+            self._byte_cache += size
+            self._byte_served += size
 
-        self._cache_hits += 1
-        self._nb_served += 1
+            self._cache_hits += 1
+            self._nb_served += 1
 
     def _from_server(self, size_kB=None, size_kb=None):
         size = 0
@@ -305,8 +547,29 @@ class ProxyHitCounter:
             size = size_kB
         elif size_kb:
             size = size_kb/8
-        self._byte_served += size
-        self._nb_served += 1
+        with self._hit_lock:
+            self._byte_served += size
+            self._nb_served += 1
+
+    def _not_sent(self, size_kB=None, size_kb=None, from_cache=False):
+        """ Takes back the part of a video counted by _from_cache() or 
+            _from_server() which was not sent, because the request was 
+            cancelled.
+        """
+        size = 0
+        if size_kB:
+            size = size_kB
+        elif size_kb:
+            size = size_kb/8
+        with self._hit_lock:
+            self._byte_served -= size
+            if from_cache:
+                self._byte_cache -= size
+
+    def reset_hit_stats(self):
+        """ Sets all the counters back to zero """
+        with self._hit_lock:
+            self._reset_hit_counters()
 
     def get_stats(self):
         return self.get_hit_stats()
@@ -324,20 +587,117 @@ class ProxyHitCounter:
                 - byte_served (int): total number of bytes served
                 - byte_hit_ratio (float): byte_cache/byte_served
         """
+        with self._hit_lock:
+            cache_hits, nb_served = self._cache_hits, self._nb_served
+            byte_cache, byte_served = self._byte_cache, self._byte_served
         hit_ratio = 0
         byte_hit_ratio = 0
-        if self._nb_served != 0:
-            hit_ratio = self._cache_hits/self._nb_served
-        if self._byte_served != 0:
-            byte_hit_ratio = self._byte_cache/self._byte_served
-        return {'cache_hits':self._cache_hits,
-                'nb_served':self._nb_served,
+        if nb_served != 0:
+            hit_ratio = cache_hits/nb_served
+        if byte_served != 0:
+            byte_hit_ratio = byte_cache/byte_served
+        return {'cache_hits':cache_hits,
+                'nb_served':nb_served,
                 'hit_ratio':hit_ratio,
-                'byte_cache':self._byte_cache,
-                'byte_served':self._byte_served,
+                'byte_cache':byte_cache,
+                'byte_served':byte_served,
                 'byte_hit_ratio':byte_hit_ratio}
 
 
+class ServerLoadCounter:
+    """ Class to inherit from for video servers to have load stats.
+
+        The inherited class must call _request_received() when a request
+        arrives and _response_sent() when the last chunk of a response has 
+        been sent. Then, get_load_stats() and get_load_intervals() can be used.
+        The intervals start at the first request.
+    """
+
+    def __init__(self, interval=10):
+        self._load_interval = interval
+        self._load_lock = threading.Lock()
+        self._load_start = None
+        self._load_intervals = []
+        """ per interval: [requests, kb served, max queue length, max active] """
+        self._response_times = Histogram()
+        """ aggregates, the memory does not grow with the trace """
+        self._nb_requests = 0
+        self._served_kb = 0
+
+    def set_load_interval(self, interval):
+        """ Sets the period of get_load_intervals(), in seconds """
+        self._load_interval = interval
+
+    def _load_bucket(self):
+        now = simu.time_()
+        if self._load_start is None:
+            self._load_start = now
+        i = int((now - self._load_start)/self._load_interval)
+        while len(self._load_intervals) <= i:
+            self._load_intervals.append([0, 0, 0, 0])
+        return self._load_intervals[i]
+
+    def _request_received(self, queue_length=0, active=0):
+        """ A request arrived, queue_length requests are waiting and active
+            requests are being served.
+        """
+        with self._load_lock:
+            bucket = self._load_bucket()
+            bucket[0] += 1
+            bucket[2] = max(bucket[2], queue_length)
+            bucket[3] = max(bucket[3], active)
+            self._nb_requests += 1
+
+    def _response_sent(self, size_kb, response_time):
+        """ size_kb were sent response_time seconds after the request arrived """
+        with self._load_lock:
+            self._load_bucket()[1] += size_kb
+            self._served_kb += size_kb
+            self._response_times.add(response_time)
+
+    def reset_load_stats(self):
+        """ Sets all the counters back to zero """
+        ServerLoadCounter.__init__(self, self._load_interval)
+
+    def get_load_stats(self):
+        """ 
+            Returns:
+                A dictionnary containing the stats, fields:
+
+                - nb_requests (int): number of requests received
+                - nb_responses (int): number of responses completely sent
+                - served_kb (float): kb sent
+                - max_queue (int): maximum number of requests waiting
+                - response_time_mean, response_time_p50, response_time_p90,
+                  response_time_p99, response_time_max (float): time 
+                  between the arrival of a request and the end of its 
+                  response, in seconds, the percentiles from a 
+                  :class:`Histogram`
+        """
+        with self._load_lock:
+            times = self._response_times
+            stats = {'nb_requests': self._nb_requests,
+                     'nb_responses': len(times),
+                     'served_kb': self._served_kb,
+                     'max_queue': max([b[2] for b in self._load_intervals], default=0)}
+            stats['response_time_mean'] = times.mean()
+            for p in (50, 90, 99):
+                stats['response_time_p'+str(p)] = times.percentile(p)
+            stats['response_time_max'] = times.max
+        return stats
+
+    def get_load_intervals(self):
+        """ Returns a list of dict, one per interval, with the time (seconds
+            since the first request), the number of requests received, the 
+            kb served, and the maximum number of requests waiting and being
+            served.
+        """
+        with self._load_lock:
+            return [{'time': i*self._load_interval, 'requests': requests,
+                     'served_kb': served, 'max_queue': queue, 'max_active': active}
+                    for i, (requests, served, queue, active) 
+                    in enumerate(self._load_intervals)]
+
 class PlotStats:
     """ Class to plot the statistics/metrics of the clients and proxy and save 
         it in PNG pictures.
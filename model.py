@@ -42,7 +42,9 @@ Optional fields:
 
 The payload can be a video, here are the fields of a video:
 
-- idVideo (int/str): unique id of the video
+- idVideo (int/str): unique id of the video. The orchestrator uses the dense
+  id of the (id_server, id_video) pair (see :mod:`traces`), so that videos of
+  different servers never collide in a cache
 - duration (int): duration in seconds
 - size (int): in kb
 - bitrate (float): in kb/s
@@ -82,7 +84,8 @@ import getopt
 import time
 import queue
 import threading
-from collections import deque
+from collections import deque, OrderedDict
+import numpy as np
 # for abstract classes
 import abc
 from abc import ABCMeta
@@ -90,6 +93,8 @@ from abc import ABCMeta
 from metrics import *
 import config
 import simu
+import digest
+import locks
 
 
 class Peer:
@@ -98,20 +103,18 @@ class Peer:
     The Peer class gives a base for communication, all communicating classes
     should inherit from it.
 
-    IDs conventions:
+    The IDs only need to be unique and hashable, the peers do not rely on
+    their values. The orchestrator uses:
 
-    - 0 for the proxy
-    - from 1 to 1000 for VideoServers
+    - 0 for a single proxy, the name of the proxy in a topology of caches
+    - the id_server of the database for VideoServers, from 1 to 1000
     - from 1001 to infinity for the clients
 
     Args:
-        id (int): an ID identifying the Peer on the 'network', should be unique
+        id (int|str): an ID identifying the Peer on the 'network', should be 
+                      unique
         name (str): a easy to read name, optional
     """
-    # IDs conventions:
-    # 0 for the proxy
-    # from 1 to 1000 for VideoServers
-    # from 1001 to infinity for the clients
 
     def __init__(self, id_, name=None):
         self.name = name or ""
@@ -120,11 +123,38 @@ class Peer:
         self._num_packet = 0
         self._received_data = None
 
-    def connect_to(self, peer):
-        """ connect a peer to another peer """
-        self.connection = Connection(peer)
+    def connect_to(self, peer, connection=None):
+        """ connect a peer to another peer 
+
+            Args:
+                peer (:class:`Peer`): the Peer to connect to
+                connection (:class:`Connection`): an unused connection to 
+                    reuse instead of creating a new one (and a new thread), 
+                    see :class:`ConnectionPool`
+        """
+        if connection is None:
+            connection = Connection(peer)
+        else:
+            connection.connect(peer)
+        self.connection = connection
         return self.connection
 
+    def set_connection(self, connection):
+        """ Replaces the connection by another object with the send method 
+            of :class:`Connection`, like a :class:`cluster.RoutedConnection`
+            sending the requests to several peers.
+        """
+        self.connection = connection
+        return connection
+
+    def disconnect(self, peer=None):
+        """ Removes the connection to the other peer and returns it, so that 
+            it can be given back to a :class:`ConnectionPool`.
+        """
+        connection = self.connection
+        self.connection = None
+        return connection
+
     def _pack_data(self, data, size=None, type_='other', response_to=None, 
                    chunk_id=None, chunk_size=None):
         #TODO replace the plSize
@@ -140,9 +170,14 @@ class Peer:
         return real_data
 
     def request(self, data, size=None, type_='other'):
-        """ low level method to request something from the other peer """
+        """ low level method to request something from the other peer 
+
+            Returns:
+                the packetId of the request, the responses refer to it
+        """
         real_data = self._pack_data(data, size, type_)
         self.connection.send(real_data)
+        return real_data['packetId']
 
     def received_callback(self, data):
         """Meant to be called to give data to the Peer
@@ -182,6 +217,17 @@ class Connection:
         self.bandwidth = bandwidth
         self.peer = peer
         self.max_chunk = max_chunk
+        self.link = None
+        """ :class:`SharedLink` this connection is sending through, if any """
+        self.weight = 1
+        """ share of the :class:`SharedLink` compared to the other connections """
+        self.bandwidth_trace = None
+        """ :class:`BandwidthTrace` followed instead of the bandwidth, if any """
+        self.trace_offset = 0
+        self._cancelled = set()
+        """ responseTo of the responses whose chunks are dropped, see 
+            :func:`cancel`
+        """
         self.q = queue.Queue()
         self.thread = threading.Thread(target=self._worker)
         self.thread.daemon = True
@@ -219,6 +265,39 @@ class Connection:
         self.bandwidth = bandwidth
         return self
 
+    def set_shared_link(self, link):
+        """ Sends through a capacity shared with other connections, the
+            bandwidth of this connection stays the maximum.
+
+        Args:
+            link (:class:`SharedLink`): the shared capacity, or None
+        """
+        self.link = link
+        return self
+
+    def set_bandwidth_trace(self, trace, offset=0):
+        """ Makes the bandwidth of the link vary over time.
+
+        Args:
+            trace (:class:`BandwidthTrace`): the bandwidth over time, can be
+                                            shared by many connections
+            offset (float): where this connection starts in the trace, in 
+                            seconds, so that the connections sharing a trace
+                            do not all vary at the same time
+        """
+        self.bandwidth_trace = trace
+        self.trace_offset = offset
+        return self
+
+    def set_weight(self, weight=1):
+        """ Set the share of this connection on its :class:`SharedLink`
+
+        Args:
+            weight (float): relative to the weights of the other connections
+        """
+        self.weight = weight
+        return self
+
     def set_max_chunk(self, max_chunk=8):
         """ Set the size of network frames, in which big data packet are split.
 
@@ -246,6 +325,9 @@ class Connection:
             item = self.q.get()
             data = item['data']
             mode = item['mode']
+            if self._cancelled and data.get('responseTo') in self._cancelled:
+                self._drop(item)
+                continue
             if mode is 'normal':
                 # we set the chunkId before it is updated in the item (in the if)
                 data['chunkId'] = item['chunkId']
@@ -272,7 +354,13 @@ class Connection:
                 data['chunkSize'] = item['size']
                 data['lastChunk'] = True
 
-            delay = data['chunkSize']/self.bandwidth
+            if self.bandwidth_trace is not None:
+                delay = self.bandwidth_trace.transmission_time(
+                    simu.time_()+self.trace_offset, data['chunkSize'])
+            else:
+                delay = data['chunkSize']/self.bandwidth
+            if self.link is not None:
+                delay = max(delay, self.link.transmission_delay(self, data['chunkSize']))
 
             if data['chunkId'] is 0:
                 """ only add the latency on the first chunk as the latency
@@ -283,10 +371,42 @@ class Connection:
             #print("Delay: "+str(delay)+", ChunkSize: "+str(data['chunkSize']))
 
             simu.sleep(delay)
+            if self.link is not None and self.q.empty():
+                # nothing more to send for now, the others get our share
+                self.link.release(self)
             self.peer.received_callback(data)
+            if item['callback'] is not None and 'lastChunk' in data:
+                item['callback']()
             self.q.task_done()
 
-    def send(self, data, mode='normal'):
+    def _drop(self, item):
+        """ Drops what is left of a cancelled response, without delay """
+        data = item['data']
+        if item['dropped'] is not None:
+            if item['mode'] is 'forwardchunk':
+                item['dropped'](data['chunkSize'])
+            else:
+                item['dropped'](item['size'])
+        if item['callback'] is not None:
+            item['callback']()
+        if self.q.empty():
+            # the chunks of the cancelled responses were queued before the
+            # cancellation, none is left
+            self._cancelled.clear()
+            if self.link is not None:
+                self.link.release(self)
+        self.q.task_done()
+
+    def cancel(self, response_to):
+        """ Drops the chunks waiting to be sent of the response to a request,
+            when they reach the head of the queue.
+
+        Args:
+            response_to (int): the packetId of the request
+        """
+        self._cancelled.add(response_to)
+
+    def send(self, data, mode='normal', callback=None, dropped=None):
         """ Send data through the link,
             low level function used by other functions
             internally
@@ -301,6 +421,10 @@ class Connection:
                            splitting it. It will send it and set the chunk id to
                            0, the chunkSize to the size of data and the lastChunk
                            flag to True.
+            callback (function): called without argument once the last chunk
+                                 of data has been sent, or dropped
+            dropped (function): called with the size in kb not sent if the
+                                data is dropped by :func:`cancel`
         """
         if self.peer:
             # calculating the time the packet would need to be transmitted over this connection
@@ -310,17 +434,229 @@ class Connection:
             # inserting the data to send in the Queue with the time it's supposed to take
              #self.q.put({'delay': delay, 'data':data})
             # modes: normal, donotchunk, forwardchunk
-            self.q.put({'size': data['plSize'], 'chunkId': 0, 'data': data, 'mode': mode})
+            self.q.put({'size': data['plSize'], 'chunkId': 0, 'data': data, 'mode': mode,
+                        'callback': callback, 'dropped': dropped})
         else:
             #error, no peer
             print("error, no peer connected")
 
+class ConnectionPool:
+    """ Keeps the unused connections, and their threads, to reuse them for 
+        other peers instead of starting new threads.
+
+        .. code-block:: python
+
+            pool = ConnectionPool()
+            client.connect_to(proxy, pool.get())
+            ...
+            pool.release(client.disconnect())
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+        self.nb_created = 0
+        """ number of connections created by the pool """
+
+    def get(self):
+        """ Returns an unused connection, without peer """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.nb_created += 1
+        return Connection()
+
+    def release(self, connection):
+        """ Gives back a connection, it must not have anything left to send """
+        if connection is None:
+            return
+        connection.peer = None
+        connection.link = None
+        connection.weight = 1
+        connection.bandwidth_trace = None
+        connection._cancelled.clear()
+        with self._lock:
+            self._idle.append(connection)
+
+    def __len__(self):
+        return len(self._idle)
+
+class SharedLink:
+    """ A capacity shared by several connections, like the network interface
+        of a peer.
+
+        The connections having something to send share the capacity in
+        proportion to their weight (weighted max-min fair sharing). A 
+        connection never exceeds its own bandwidth, the capacity it leaves
+        goes to the others (water-filling). The rate of a connection is 
+        computed again for each chunk. The time lost because of the sharing 
+        is counted as queueing delay.
+
+        Args:
+            capacity (float): in kb/s
+            interval (float): period of the statistics, in seconds
+    """
+
+    def __init__(self, capacity, interval=10):
+        self.capacity = capacity
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = dict()
+        """ weights of the connections currently sending """
+        self._total_weight = 0
+        self._start = None
+        self._stats = []
+        """ per interval: [kb sent, total queueing delay, nb chunks, max flows] """
+
+    def transmission_delay(self, connection, size):
+        """ Returns the time needed by a connection to send size kb now """
+        with self._lock:
+            if connection not in self._active:
+                self._active[connection] = connection.weight
+                self._total_weight += connection.weight
+            delay = size/self._rate_of(connection)
+
+            now = simu.time_()
+            if self._start is None:
+                self._start = now
+            i = int((now - self._start)/self.interval)
+            while len(self._stats) <= i:
+                self._stats.append([0, 0, 0, 0])
+            stats = self._stats[i]
+            stats[0] += size
+            stats[1] += delay - size/connection.bandwidth
+            stats[2] += 1
+            stats[3] = max(stats[3], len(self._active))
+        return delay
+
+    def _rate_of(self, connection):
+        """ The weighted max-min fair rate of an active connection: the
+            connections limited by their bandwidth below their share keep 
+            their bandwidth, the others share what remains by weight.
+        """
+        capacity = self.capacity
+        weight = self._total_weight
+        for other in sorted(self._active, key=lambda c: c.bandwidth/self._active[c]):
+            level = capacity/weight
+            if other.bandwidth >= level*self._active[other]:
+                # this connection and the next ones are not limited
+                break
+            if other is connection:
+                return other.bandwidth
+            capacity -= other.bandwidth
+            weight -= self._active[other]
+        return min(capacity*connection.weight/weight, connection.bandwidth)
+
+    def release(self, connection):
+        """ The connection has nothing more to send """
+        with self._lock:
+            weight = self._active.pop(connection, None)
+            if weight is not None:
+                self._total_weight -= weight
+
+    def get_stats(self):
+        """ Returns a list of dict, one per interval, with the time (seconds
+            since the first chunk), the utilization of the capacity (between
+            0 and 1), the average queueing delay per chunk in seconds and
+            the maximum number of connections sending at the same time.
+        """
+        rows = []
+        with self._lock:
+            for i, (size, delay, nb_chunks, flows) in enumerate(self._stats):
+                rows.append({'time': i*self.interval,
+                             'utilization': size/(self.capacity*self.interval),
+                             'queueing_delay': delay/nb_chunks if nb_chunks else 0,
+                             'flows': flows})
+        return rows
+
+class BandwidthTrace:
+    """ A bandwidth varying over time, piecewise constant, repeated after
+        its duration.
+
+        The data sent since the beginning of the trace is precomputed at each
+        step, so that the time needed to send a chunk is found with two 
+        binary searches, whatever the length of the trace. A trace is 
+        read-only and meant to be shared by many connections, see
+        :func:`Connection.set_bandwidth_trace`.
+
+        Args:
+            times (list): beginning of each step in seconds, starting at 0
+            rates (list): bandwidth of each step, in kb/s
+            duration (float): end of the last step, one more step of the same
+                              length as the previous one by default
+    """
+
+    def __init__(self, times, rates, duration=None):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.rates = np.asarray(rates, dtype=np.float64)
+        if duration is None:
+            step = self.times[-1] - self.times[-2] if len(self.times) > 1 else 1
+            duration = self.times[-1] + step
+        self.duration = duration
+        ends = np.append(self.times[1:], duration)
+        self.cumulative = np.concatenate(([0], np.cumsum(self.rates*(ends-self.times))))
+        """ kb sent since the beginning of the trace, at each step and at 
+            the end
+        """
+        self.total = self.cumulative[-1]
+        if self.total <= 0:
+            raise ValueError("The bandwidth trace never sends anything")
+
+    @classmethod
+    def from_file(cls, file_path):
+        """ Reads a CSV file with a "time","bandwidth" header, in seconds and
+            kb/s, sorted by time.
+        """
+        with open(file_path, 'r') as f:
+            lines = [line for line in f if line[0] != '#']
+        # without the header
+        data = np.loadtxt(lines[1:], delimiter=',', ndmin=2)
+        return cls(data[:, 0] - data[0, 0], data[:, 1])
+
+    def rate_at(self, t):
+        """ Bandwidth at time t, in kb/s """
+        i = np.searchsorted(self.times, t % self.duration, side='right') - 1
+        return self.rates[i]
+
+    def _amount(self, t):
+        """ kb which can be sent from 0 to t """
+        loops, t = divmod(t, self.duration)
+        i = np.searchsorted(self.times, t, side='right') - 1
+        return loops*self.total + self.cumulative[i] + self.rates[i]*(t-self.times[i])
+
+    def _time_for(self, amount):
+        """ first time at which amount kb can have been sent since 0 """
+        loops, amount = divmod(amount, self.total)
+        # last step beginning with less than amount sent, its rate is not 0
+        i = np.searchsorted(self.cumulative, amount, side='left') - 1
+        if i < 0:
+            return loops*self.duration
+        return loops*self.duration + self.times[i] + (amount-self.cumulative[i])/self.rates[i]
+
+    def transmission_time(self, start, size):
+        """ Time needed to send size kb, beginning at the time start of the 
+            trace (in seconds, can be greater than the duration).
+        """
+        if size <= 0:
+            return 0.0
+        return float(self._time_for(self._amount(start)+size) - start)
+
 #@TwoMethodsTimer("request_media", "start_playback")
-class Client(Peer):
+class Client(Peer, Observable):
     """Represents a client, which downloads videos through the Proxy.
-       Can be monitored wit the metrics in metrics.python.
+       Can be monitored with the observers of metrics.py (see 
+       add_observer), whose hooks are called when a video is requested
+       (on_request), starts playing (on_playback) and stops (on_stall), 
+       with the ID of the video.
        Can consume videos (play them) to measure how many times the video stops.
        For the latter feature, call start_video_consumer.
+       Downloads the whole videos, or segment by segment with an adaptive
+       bitrate algorithm, see set_abr.
+       A video can be requested with a watch duration, the viewer then leaves
+       after watching this part of it and the rest of the download is
+       cancelled, see abandon_media.
+       The videos downloaded can be kept in a local cache, see 
+       set_local_cache, and uploaded to the other clients, see set_tracker.
 
         Args:
             args (list): will be forwarded to :class:`Peer`
@@ -328,21 +664,61 @@ class Client(Peer):
 
     """
 
+    HOOKS = ('on_request', 'on_playback', 'on_stall')
+
     def __init__(self, *args, **kargs):
         Peer.__init__(self, *args, **kargs)
+        Observable.__init__(self)
         self.buffer_size = 1024
         """bufferSize in Kb"""
         self.media_asked_for = {}
         """ Dict to store the media the client is downloading """
         self.media_downloading = 0
-        """ Counter to know how many downloads are currently pending. Not used."""
-        self.play_thread = threading.Thread(target=self._play_videos)
-        """ Thread for the play loop :func:`_play_videos` to consume video and 
-            detect re-buffering. 
+        """ Counter to know how many downloads are currently pending """
+        self.media_played = []
+        """ IDs of the media played until the end, removed from
+            :attr:`media_asked_for`
         """
-        self.play_thread.daemon = True
-        
-        # settings for the player thread
+        self.consume_videos = False
+        """ Whether the player consumes the videos, see :func:`start_video_consumer` """
+        self._play_lock = threading.RLock()
+        """ The buffers are filled by the connections and emptied by the timers
+            of :mod:`simu`
+        """
+        self.abr = None
+        """ :class:`abr.ABRAlgorithm` choosing the renditions, None to 
+            download the whole videos
+        """
+        self.max_buffer = 30
+        """ With an ABR algorithm, seconds of video buffered before waiting
+            to request the next segment
+        """
+        self.delivered_kb = 0
+        """ bitrate times duration of the videos or segments downloaded, 
+            divided by delivered_seconds it is the average bitrate
+        """
+        self.delivered_seconds = 0
+        self.nb_switches = 0
+        """ number of changes of rendition between two segments """
+        self.nb_abandoned = 0
+        """ number of videos left before the end of their download """
+        self.local_cache = None
+        """ :class:`CachingProxy` used as the cache of the client, see
+            :func:`set_local_cache`
+        """
+        self.local_hits = 0
+        """ number of videos or segments served by the local cache """
+        self.local_hit_kb = 0
+        self.tracker = None
+        """ :class:`p2p.Tracker` of the peer-assisted delivery, see 
+            :func:`set_tracker`
+        """
+        self.max_uploads = 4
+        self._uploads = 0
+        """ number of uploads in progress """
+        self.reset_p2p_stats()
+
+        # settings for the player
         self.play_auto = True
         self.play_wait_buffer = True
 
@@ -356,40 +732,58 @@ class Client(Peer):
         # function to signal a download being done
         self.signal_end_download = self.print_end_dl
 
-    def _play_videos(self):
-        """ Automatically consumes videos when the buffer has been filled initially
-            Supposed to be run only in an independant thread.
-            Runs once every simulated second.
+    def _drain_buffer(self, media, now):
+        """ Consumes the buffer (in seconds) of a media being played, up to now """
+        if media['state'] == 'play' and self.consume_videos:
+            played = min(media['buffer'], now-media['updated'])
+            media['buffer'] -= played
+            media['played'] += played
+        media['updated'] = now
+
+    def _schedule_underrun(self, id_media, media):
+        """ Sets a timer for the moment the buffer of a playing media will be
+            empty if nothing else is received. Receiving data only postpones
+            this moment, so the timer is not moved: :func:`_check_underrun`
+            sets a new one if the buffer was refilled meanwhile.
         """
-        while True:
-            # Infinite loop, not really efficient
-            for id_media in self.media_asked_for:
-                # if the state of the video is "buffering"
-                if self.play_wait_buffer and self.media_asked_for[id_media]['state'] is 'buffer':
-                    # if the buffer is filled enough, we update the state to "playing"
-                    if self.media_asked_for[id_media]['buffer'] > self.buffer_size:
-                        self.media_asked_for[id_media]['state'] = 'play'
-                # if the state of the video is "playing"
-                if self.media_asked_for[id_media]['state'] is 'play':
-                    if self.media_asked_for[id_media]['buffer'] >= self.media_asked_for[id_media]['bitrate']:
-                        self.media_asked_for[id_media]['buffer'] -= self.media_asked_for[id_media]['bitrate']
-                    else:
-                        self.media_asked_for[id_media]['buffer'] = 0
-                    if self.media_asked_for[id_media]['buffer'] is 0:
-                        # change the state if we want to wait for the buffer to be filled
-                        if self.play_wait_buffer:
-                            # only when we want to wait for a buffer refill each time it stops
-                            self.media_asked_for[id_media]['state'] = 'buffer'
-                        #print("Buffer empty for video "+str(id_media))
-                        self._video_stopped(id_media)
-                    percentage = self.media_asked_for[id_media]['buffer']/self.buffer_size*100
-                    #print("Buffer for media "+str(id_media)+" filled at "+str(percentage)+"%")
-            simu.sleep(1)
-
+        if media['timer'] is None and media['state'] == 'play' and self.consume_videos:
+            media['timer'] = simu.timers.call_later(media['buffer'],
+                                                    self._check_underrun, id_media, media)
+
+    def _check_underrun(self, id_media, media):
+        """ Called by the timer of :func:`_schedule_underrun`. The video either
+            stops (empty buffer), ends (empty buffer and download complete)
+            or keeps playing.
+        """
+        with self._play_lock:
+            media['timer'] = None
+            if self.media_asked_for.get(id_media) is not media:
+                # requested again meanwhile
+                return
+            self._drain_buffer(media, simu.time_())
+            # tolerance for the rounding errors
+            if media['buffer'] > 1e-6:
+                self._schedule_underrun(id_media, media)
+            elif media['done']:
+                del self.media_asked_for[id_media]
+                self.media_played.append(id_media)
+            else:
+                media['buffer'] = 0
+                media['state'] = 'buffer'
+                self._video_stopped(id_media)
 
     def start_video_consumer(self):
-        """ starts the thread to consume videos"""
-        self.play_thread.start()
+        """ Starts to consume the videos, and thus to detect re-buffering.
+
+            The player is event driven: when a video is playing, a timer of
+            :mod:`simu` is set for the moment its buffer will be empty.
+        """
+        with self._play_lock:
+            self.consume_videos = True
+            now = simu.time_()
+            for id_media, media in self.media_asked_for.items():
+                media['updated'] = now
+                self._schedule_underrun(id_media, media)
 
     def _video_stopped(self, id_video=None):
         """ Hook to count how many times videos are stopping
@@ -402,16 +796,19 @@ class Client(Peer):
         #     print("Video "+str(id_video)+" stopped playing on client "+self.name)
         # else:
         #     print("A video stopped playing on client "+self.name)
-        pass
+        for hook in self._on_stall_hooks:
+            hook(id_video)
 
 
-    def request_media(self, id_media, server_id=1):
+    def request_media(self, id_media, server_id=1, watch_duration=None):
         """
         A really useful function.
 
         Args:
             id_media (int|str): ID of the media requested 
             server_id (int): ID of the server where the media is
+            watch_duration (float): seconds of the video the viewer watches
+                                    before leaving, None to watch it all
 
         Returns None
 
@@ -425,11 +822,313 @@ class Client(Peer):
             print("Not requesting "+str(id_media))
             return
         self.last_media = id_media
+        for hook in self._on_request_hooks:
+            hook(id_media)
         payload = {'idServer': server_id, 'idVideo': id_media}
-        self.request(payload, None, 'videoRequest')
-        self.media_asked_for[id_media] = {'received': 0, 'size': None, 'bitrate': 0, 'buffer': 0, 'state': 'stop'}
-        #self.media_downloading += 1
+        with self._play_lock:
+            old_media = self.media_asked_for.get(id_media)
+            if old_media is not None and old_media['timer'] is not None:
+                simu.timers.cancel(old_media['timer'])
+            media = {'received': 0, 'size': None, 'bitrate': 0, 'buffer': 0, 'done': False,
+                     'state': 'stop', 'updated': simu.time_(), 'timer': None,
+                     'idServer': server_id, 'packetId': None, 
+                     'watch': watch_duration, 'played': 0, 'timer_abandon': None,
+                     'asked': simu.time_()}
+            self.media_asked_for[id_media] = media
+            self.media_downloading += 1
         self.signal_new_download()
+        if self.abr is None:
+            if not self._local_hit(payload):
+                media['packetId'] = self._request_video(media, payload)
+        else:
+            # the lowest rendition first, the others are not known yet
+            media.update({'segment': 0, 'rendition': 0,
+                          'segment_received': 0, 'segment_start': None})
+            self._request_segment(id_media, media)
+
+    def set_abr(self, algorithm, max_buffer=30):
+        """ Downloads the videos segment by segment, the rendition of each
+            segment being chosen by an ABR algorithm.
+
+            Args:
+                algorithm (:class:`abr.ABRAlgorithm`): the algorithm of this
+                                                       client, or None
+                max_buffer (float): seconds of video in the buffer above 
+                                    which the next segment is requested later
+        """
+        self.abr = algorithm
+        self.max_buffer = max_buffer
+
+    def _request_segment(self, id_media, media):
+        """ Requests the next segment of a media """
+        with self._play_lock:
+            media['timer_segment'] = None
+            if self.media_asked_for.get(id_media) is not media:
+                return
+            media['segment_received'] = 0
+            media['segment_start'] = simu.time_()
+            payload = {'idServer': media['idServer'], 'idVideo': id_media,
+                       'rendition': media['rendition'], 'segment': media['segment']}
+            if not self._local_hit(payload):
+                media['packetId'] = self._request_video(media, payload)
+
+    def set_local_cache(self, cache):
+        """ Keeps the videos (or segments) downloaded in a local cache, 
+            like the cache of a browser. A video in it is played without
+            requesting it, and does not count in the hits of the proxy.
+
+            Args:
+                cache (:class:`CachingProxy`): any caching proxy, only used
+                       for its cache and its policy, with its size set by 
+                       set_cache_size. None to remove the local cache.
+        """
+        self.local_cache = cache
+
+    def _local_hit(self, payload):
+        """ Delivers a video or segment at once from the local cache.
+
+            Returns:
+                False if it is not in the local cache
+        """
+        if self.local_cache is None:
+            return False
+        video = self.local_cache.cache_lookup(payload)
+        if video is None:
+            return False
+        self.local_hits += 1
+        self.local_hit_kb += video['size']
+        self.received_callback({'sender': self._id, 'payload': video, 
+                                'plSize': video['size'], 'plType': 'video',
+                                'chunkId': 0, 'chunkSize': video['size'], 
+                                'lastChunk': True, 'local': True})
+        return True
+
+    def reset_local_cache_stats(self):
+        """ Forgets the hits of the local cache """
+        self.local_hits = 0
+        self.local_hit_kb = 0
+
+    def set_tracker(self, tracker, max_uploads=4):
+        """ Downloads the videos from the other clients when they have them,
+            and uploads the videos of the local cache to them. The client 
+            must have been added to the tracker, see 
+            :func:`p2p.Tracker.add_peer`.
+
+            Args:
+                tracker (:class:`p2p.Tracker`): the tracker shared by the 
+                                                 clients, or None
+                max_uploads (int): number of videos uploaded at the same time
+                                   above which the requests are refused
+        """
+        self.tracker = tracker
+        self.max_uploads = max_uploads
+
+    def _request_video(self, media, payload):
+        """ Requests a video or segment from a client having it, from the 
+            proxy otherwise.
+
+            Returns:
+                the packetId of the request
+        """
+        media.pop('peer', None)
+        if self.tracker is not None:
+            id_peer = self.tracker.find(self.tracker.key(payload), self._id)
+            connection = None
+            if id_peer is not None:
+                connection = self.tracker.connection(self._id, id_peer)
+            if connection is not None:
+                self.p2p_stats['p2p_requests'] += 1
+                media['peer'] = id_peer
+                data = self._pack_data(payload, None, 'videoRequest')
+                connection.send(data)
+                return data['packetId']
+        return self.request(payload, None, 'videoRequest')
+
+    def _upload(self, data):
+        """ Sends a video of the local cache to the client requesting it, or
+            a peer miss if it is not there anymore or if there are already 
+            max_uploads uploads.
+        """
+        connection = None
+        if self.tracker is not None:
+            connection = self.tracker.connection(self._id, data['sender'])
+        if connection is None:
+            return
+        pld = data['payload']
+        video = None
+        with self._play_lock:
+            busy = self._uploads >= self.max_uploads
+            if self.local_cache is not None and not busy:
+                video = self.local_cache.cache_lookup(pld)
+            if video is not None:
+                self._uploads += 1
+                self.p2p_stats['nb_uploads'] += 1
+                self.p2p_stats['upload_kb'] += video['size']
+        if video is None:
+            miss = self._pack_data(dict(pld, busy=busy), data['plSize'], 
+                                   'peerMiss', data['packetId'])
+            connection.send(miss, 'donotchunk')
+            return
+        new_data = self._pack_data(video, video['size'], 'video', data['packetId'])
+        new_data['p2p'] = True
+        connection.send(new_data, callback=self._upload_done, 
+                        dropped=self._upload_dropped)
+
+    def _upload_done(self):
+        """ called by the connections, the last chunk of an upload was sent
+            or dropped
+        """
+        with self._play_lock:
+            self._uploads -= 1
+
+    def _upload_dropped(self, size):
+        """ called by the connections, size kb of an upload are not sent """
+        with self._play_lock:
+            self.p2p_stats['upload_kb'] -= size
+
+    def _cancel_upload(self, data):
+        """ The client downloading a video does not want the rest of it """
+        if self.tracker is not None:
+            connection = self.tracker.connection(self._id, data['sender'])
+            if connection is not None:
+                connection.cancel(data['payload']['packetId'])
+
+    def _peer_miss(self, data):
+        """ The client asked did not send the video, it is requested from 
+            the proxy instead
+        """
+        pld = dict(data['payload'])
+        busy = pld.pop('busy', False)
+        with self._play_lock:
+            media = self.media_asked_for.get(pld['idVideo'])
+            if media is None or media['packetId'] != data['responseTo']:
+                # abandoned meanwhile
+                return
+            self.p2p_stats['p2p_misses'] += 1
+            if not busy:
+                self.tracker.withdraw(self.tracker.key(pld), data['sender'])
+            media.pop('peer', None)
+            media['packetId'] = self.request(pld, None, 'videoRequest')
+
+    def reset_p2p_stats(self):
+        """ Forgets the statistics of the peer-assisted delivery """
+        self.p2p_stats = {'p2p_requests': 0, 'p2p_misses': 0, 'p2p_kb': 0,
+                          'proxy_kb': 0, 'nb_uploads': 0, 'upload_kb': 0}
+        """ requests sent to other clients, peer misses, kb received from 
+            the other clients and from the proxy, and videos and kb uploaded
+        """
+        self.p2p_startups = []
+        """ seconds between the request and the start of the playback of
+            the videos received from other clients
+        """
+
+    def _segment_complete(self, id_media, media, segment, local=False):
+        """ Called when the last chunk of a segment is received. Requests the
+            next one, with the rendition chosen by the ABR algorithm, or
+            completes the download. After a segment of the local cache, the
+            next one is requested by a timer, else a video entirely in the
+            cache would be delivered by recursive calls.
+        """
+        self.abr.segment_downloaded(segment['size'], simu.time_() - media['segment_start'])
+        if segment['segment']+1 >= segment['nbSegments']:
+            media['done'] = True
+            self.download_complete(id_media)
+            return
+        media['segment'] = segment['segment']+1
+        media['rendition'] = self.abr.choose(segment['renditions'], media['buffer'], 
+                                             segment['rendition'])
+        if media['rendition'] != segment['rendition']:
+            self.nb_switches += 1
+        # the buffer is full enough, the request waits until it is not
+        wait = media['buffer'] - self.max_buffer
+        if self.consume_videos and media['state'] == 'play' and wait > 0:
+            media['timer_segment'] = simu.timers.call_later(wait, self._request_segment, 
+                                                            id_media, media)
+        elif local:
+            media['timer_segment'] = simu.timers.call_later(0, self._request_segment, 
+                                                            id_media, media)
+        else:
+            self._request_segment(id_media, media)
+
+    def _check_abandon(self, id_media, media):
+        """ Called by the timer set at the start of the playback. The viewer
+            leaves once the watch duration has been played, or elapsed when
+            the videos are not consumed.
+        """
+        with self._play_lock:
+            media['timer_abandon'] = None
+            if self.media_asked_for.get(id_media) is not media:
+                return
+            self._drain_buffer(media, simu.time_())
+            left = media['watch'] - media['played']
+            if self.consume_videos and left > 1e-6:
+                # stalled meanwhile
+                media['timer_abandon'] = simu.timers.call_later(left, self._check_abandon, 
+                                                                id_media, media)
+                return
+        self.abandon_media(id_media)
+
+    def abandon_media(self, id_media):
+        """ The viewer stops watching a media. If its download is not 
+            complete, the rest is cancelled: a cancel packet referring to 
+            the pending request is sent, and the chunks still arriving are 
+            ignored.
+
+            Args:
+                id_media (int|str): ID of the media
+        """
+        with self._play_lock:
+            media = self.media_asked_for.pop(id_media, None)
+            if media is None:
+                return
+            for timer in ('timer', 'timer_abandon', 'timer_segment'):
+                if media.get(timer) is not None:
+                    simu.timers.cancel(media[timer])
+            if media['done']:
+                return
+            self.nb_abandoned += 1
+            self.media_downloading -= 1
+            payload = {'idServer': media['idServer'], 'idVideo': id_media, 
+                       'packetId': media['packetId']}
+        self.signal_end_download()
+        print("Media "+str(id_media)+" abandoned by "+self.name)
+        connection = None
+        if 'peer' in media:
+            connection = self.tracker.connection(self._id, media['peer'])
+        if connection is None:
+            self.request(payload, None, 'cancel')
+        else:
+            connection.send(self._pack_data(payload, None, 'cancel'))
+
+    def _delivered(self, bitrate, duration):
+        """ Counts a video or a segment for the average bitrate """
+        self.delivered_kb += bitrate*duration
+        self.delivered_seconds += duration
+
+    def reset_bitrate_stats(self):
+        """ Forgets the bitrates delivered and the switches, for instance at 
+            the end of a warm-up period.
+        """
+        self.delivered_kb = 0
+        self.delivered_seconds = 0
+        self.nb_switches = 0
+
+    @property
+    def avg_bitrate(self):
+        """ Average bitrate of what was downloaded, weighted by the duration """
+        if not self.delivered_seconds:
+            return 0
+        return self.delivered_kb/self.delivered_seconds
+
+    def is_idle(self):
+        """ True when the client is not downloading nor playing anything """
+        with self._play_lock:
+            if self.media_downloading > 0 or self._uploads > 0:
+                return False
+            if not self.consume_videos:
+                return True
+            return not any(media['state'] in ('play', 'buffer') 
+                           for media in self.media_asked_for.values())
 
     def set_buffer_size(self, buffer_size):
         """ Set the size of the player buffer for the client
@@ -448,6 +1147,8 @@ class Client(Peer):
                                          until the buffer is full to continue 
                                          playing the video, thus reducing the 
                                          number of stops/re-buffering.
+                                         Otherwise, it continues as soon as
+                                         data is received.
         """
         self.play_wait_buffer = play_wait_buffer
 
@@ -477,35 +1178,84 @@ class Client(Peer):
 
             id_media = data['payload']['idVideo']
 
-            # wow, we never asked for that media!
-            if id_media not in self.media_asked_for:
-                print("These are not the droids you're looking for")
-                return
-
-            # if this is the first chunk we receive
-            if not self.media_asked_for[id_media]['size']:
-                self.media_asked_for[id_media]['size'] = data['plSize']
-                self.media_asked_for[id_media]['bitrate'] = data['payload']['bitrate']
-
-            oldReceived = self.media_asked_for[id_media]['received']
-            # we update how much we received for this media
-            self.media_asked_for[id_media]['received'] += data['chunkSize']
-            self.media_asked_for[id_media]['buffer'] += data['chunkSize']
-            #print("Downloaded "+str(self.media_asked_for[id_media]['received'])+" out of "+str(self.media_asked_for[id_media]['size'])+" for "+str(id_media))
-            received = self.media_asked_for[id_media]['received']
-            # if the download is complete
-            if received >= self.media_asked_for[id_media]['size']:
-                print("Downloaded "+str(self.media_asked_for[id_media]['received'])+" out of "+str(self.media_asked_for[id_media]['size'])+" for "+str(id_media))
-                self.download_complete(id_media)
-
-            # start playing the video if the buffer was previously not filled enough and is now ok
-            if received >= self.buffer_size and oldReceived < received \
-            and self.media_asked_for[id_media]['state'] is 'stop':
-                self.media_asked_for[id_media]['state'] = 'play'
-                self.start_playback(id_media=id_media)
+            with self._play_lock:
+                media = self.media_asked_for.get(id_media)
+                # wow, we never asked for that media!
+                if media is None:
+                    print("These are not the droids you're looking for")
+                    return
+
+                pld = data['payload']
+                # the bitrate of the last chunk, it changes with the renditions
+                media['bitrate'] = pld['bitrate']
+                # if this is the first chunk we receive
+                if not media['size']:
+                    media['size'] = data['plSize']
+
+                if 'p2p' in data:
+                    self.p2p_stats['p2p_kb'] += data['chunkSize']
+                elif 'local' not in data:
+                    self.p2p_stats['proxy_kb'] += data['chunkSize']
+
+                self._drain_buffer(media, simu.time_())
+                oldReceived = media['received']
+                # we update how much we received for this media
+                media['received'] += data['chunkSize']
+                if pld['bitrate'] > 0:
+                    # the buffer is in seconds of video
+                    media['buffer'] += data['chunkSize']/pld['bitrate']
+                received = media['received']
+                if 'segment' in pld:
+                    old_segment = media['segment_received']
+                    media['segment_received'] += data['chunkSize']
+                    if old_segment < data['plSize'] <= media['segment_received']:
+                        self._delivered(pld['bitrate'], pld['duration'])
+                        self._store_local(data, media)
+                        self._segment_complete(id_media, media, pld, 'local' in data)
+                # if the download is complete (only once, if the same media
+                # was requested again during the download)
+                elif oldReceived < media['size'] <= received:
+                    print("Downloaded "+str(received)+" out of "+str(media['size'])+" for "+str(id_media))
+                    media['done'] = True
+                    self._delivered(pld['bitrate'], pld['duration'])
+                    self._store_local(data, media)
+                    self.download_complete(id_media)
+
+                # enough video in the buffer to play, buffer_size is in kb
+                enough = media['done'] or pld['bitrate'] <= 0 \
+                         or media['buffer'] >= self.buffer_size/pld['bitrate']
+                # start playing the video if the buffer was previously not filled enough and is now ok
+                if media['state'] == 'stop' and enough:
+                    media['state'] = 'play'
+                    if 'p2p' in data:
+                        self.p2p_startups.append(simu.time_() - media['asked'])
+                    self.start_playback(id_media=id_media)
+                    if media['watch'] is not None:
+                        media['timer_abandon'] = simu.timers.call_later(
+                            media['watch'], self._check_abandon, id_media, media)
+                # resume after a stop
+                elif media['state'] == 'buffer' and (not self.play_wait_buffer or enough):
+                    media['state'] = 'play'
+                self._schedule_underrun(id_media, media)
+        elif data['plType'] is 'videoRequest':
+            self._upload(data)
+        elif data['plType'] is 'peerMiss':
+            self._peer_miss(data)
+        elif data['plType'] is 'cancel':
+            self._cancel_upload(data)
         else:
             Peer.received_callback(self, data)
 
+    def _store_local(self, data, media):
+        """ Keeps a video or segment entirely downloaded in the local cache,
+            and announces it to the tracker
+        """
+        if self.local_cache is not None and 'local' not in data:
+            if self.local_cache.cache_store(data['payload']) and self.tracker is not None:
+                # the videos sent do not tell their server
+                payload = dict(data['payload'], idServer=media['idServer'])
+                self.tracker.announce(self.tracker.key(payload), self._id)
+
     def start_playback(self, id_media=None, data=None):
         """ To signal that we can start the playback
 
@@ -518,8 +1268,10 @@ class Client(Peer):
                          can extract the video ID. In case id_media is not 
                          provided.
         """
-        if not id_media:
+        if id_media is None:
             id_media = data['payload']['videoId']
+        for hook in self._on_playback_hooks:
+            hook(id_media)
         print("Video "+str(id_media)+" is playing")
 
     def download_complete(self, id_media=None, data=None):
@@ -531,9 +1283,10 @@ class Client(Peer):
                          can extract the video ID. In case id_media is not 
                          provided.
         """
-        if not id_media:
+        if id_media is None:
             id_media = data['payload']['videoId']
-        #self.media_downloading -= 1
+        with self._play_lock:
+            self.media_downloading -= 1
         self.signal_end_download()
         print("Download of media "+str(id_media)+" for client "+self.name+" completed.")
 
@@ -582,16 +1335,30 @@ class BaseProxy(Peer):
         self.connection = dict()
         """ stores connections to other Peers (i.e. Clients and VideoServers) """
 
-    def connect_to(self, peer):
+    def connect_to(self, peer, connection=None):
         """ Redefined connect_to function to handle multiple connections.
 
         Args:
             peer (:class:`Peer`): the Peer to connect to.
+            connection (:class:`Connection`): an unused connection to reuse
         """
         id_ = peer.get_id()
-        self.connection[id_] = Connection(peer)
+        if connection is None:
+            connection = Connection(peer)
+        else:
+            connection.connect(peer)
+        self.connection[id_] = connection
         return self.connection[id_]
 
+    def disconnect(self, peer=None):
+        """ Removes the connection to a peer and returns it.
+
+        Args:
+            peer (:class:`Peer`|int): the Peer, or its ID, to disconnect from
+        """
+        id_ = peer.get_id() if hasattr(peer, 'get_id') else peer
+        return self.connection.pop(id_, None)
+
 class AbstractProxy(BaseProxy, metaclass=ABCMeta):
     """ Abstract class for more sophisticated proxy working with the requests 
         defined in the specs 
@@ -601,7 +1368,47 @@ class AbstractProxy(BaseProxy, metaclass=ABCMeta):
     - processVideoRequest for a video request from a client and maybe forward it to a Video Server
     - processResponseTo for the responses the Proxy receives, usually the video he asked
     - processOther for anything else
+
+    By default, the packets are processed at once, however many arrive. With
+    :func:`set_processing`, the video requests and the chunks of the 
+    responses are processed by a limited number of workers, each taking a 
+    time per request (or response) and per kb of video received, the others
+    waiting in the admission queue, so that the proxy itself can be the 
+    bottleneck (see :func:`get_processing_stats`). The cancellations and the
+    digests are still processed at once.
     """
+    def __init__(self, *args, **kargs):
+        BaseProxy.__init__(self, *args, **kargs)
+        self.workers = 0
+        """ number of packets processed at the same time, 0 for no limit """
+        self.request_cost = 0
+        """ processing time of a packet, in seconds """
+        self.byte_cost = 0
+        """ processing time per kb of the videos received, in seconds """
+        self.__admission = deque()
+        """ turns of the packets waiting for a worker, first come first 
+            served
+        """
+        self.__nb_busy = 0
+        self.__processing_cond = threading.Condition()
+        self.reset_processing_stats()
+
+    def set_processing(self, workers=0, request_cost=0, byte_cost=0):
+        """ Set the processing limits of the proxy
+
+            Args:
+                workers (int): number of packets processed at the same time,
+                               0 for no limit
+                request_cost (float): processing time of a video request or
+                                      of the first chunk of a response, in 
+                                      seconds
+                byte_cost (float): processing time per kb of the responses
+                                   received from the servers or the parent,
+                                   in seconds
+        """
+        self.workers = workers
+        self.request_cost = request_cost
+        self.byte_cost = byte_cost
 
     @abc.abstractmethod
     def _process_video_request(self, data):
@@ -618,15 +1425,106 @@ class AbstractProxy(BaseProxy, metaclass=ABCMeta):
         """ process the unknown, can be anything else """
         pass
 
+    def _process_cancel(self, data):
+        """ process the cancellation of a previous request, ignored by 
+            default
+        """
+        pass
+
+    def _process_digest(self, data):
+        """ process the digest of the cache of a sibling proxy, ignored by
+            default
+        """
+        pass
+
     def received_callback(self, data):
         """
         This will filter through the different type of packets
-        and cal the appropriate function.
+        and cal the appropriate function, after the processing time and the
+        wait for a worker with :func:`set_processing`.
+        """
+        if self.workers and ('responseTo' in data or data['plType'] is 'videoRequest'):
+            self.__admit(data)
+        else:
+            self._dispatch(data)
+
+    def __admit(self, data):
+        """ Waits for a worker, in turn, then for the processing time of 
+            the packet, in the thread which received it so that the chunks 
+            of a response stay in order
+        """
+        cost = self.byte_cost*data.get('chunkSize', 0) if 'responseTo' in data else 0
+        if data.get('chunkId', 0) == 0:
+            cost += self.request_cost
+        arrival = simu.time_()
+        turn = object()
+        with self.__processing_cond:
+            self.__admission.append(turn)
+            waiting = len(self.__admission) - (self.__nb_busy < self.workers)
+            self.__processing['max_queue'] = max(self.__processing['max_queue'], waiting)
+            while self.__admission[0] is not turn or self.__nb_busy >= self.workers:
+                self.__processing_cond.wait()
+            self.__admission.popleft()
+            self.__nb_busy += 1
+            self.__processing['delays'].add(simu.time_() - arrival)
+            self.__processing['busy'] += cost
+            # the next packet may have a free worker too
+            self.__processing_cond.notify_all()
+        if cost > 0:
+            simu.sleep(cost)
+        with self.__processing_cond:
+            self.__nb_busy -= 1
+            self.__processing_cond.notify_all()
+        self._dispatch(data)
+
+    def reset_processing_stats(self):
+        """ Sets the counters of the processing back to zero, see
+            :func:`get_processing_stats`
         """
+        with self.__processing_cond:
+            # aggregates, a long simulation processes millions of packets
+            self.__processing = {'start': simu.time_(), 'delays': Histogram(), 
+                                 'busy': 0, 'max_queue': len(self.__admission)}
+
+    def get_processing_stats(self):
+        """
+            Returns:
+                A dictionnary containing the stats, fields:
+
+                - nb_processed (int): packets given to a worker (the 
+                                      requests and the chunks of the 
+                                      responses)
+                - max_queue (int): maximum number of packets waiting
+                - queueing_delay_mean, queueing_delay_p50, 
+                  queueing_delay_p90, queueing_delay_p99, queueing_delay_max
+                  (float): time the packets waited for a worker, in 
+                  seconds, the percentiles from a :class:`metrics.Histogram`
+                - utilization (float): part of the time the workers were 
+                                       busy, between 0 and 1
+        """
+        with self.__processing_cond:
+            delays = self.__processing['delays']
+            elapsed = simu.time_() - self.__processing['start']
+            stats = {'nb_processed': len(delays), 
+                     'max_queue': self.__processing['max_queue'],
+                     'utilization': min(1, self.__processing['busy']/(self.workers*elapsed))
+                                    if self.workers and elapsed > 0 else 0}
+            stats['queueing_delay_mean'] = delays.mean()
+            for p in (50, 90, 99):
+                stats['queueing_delay_p'+str(p)] = delays.percentile(p)
+            stats['queueing_delay_max'] = delays.max
+        return stats
+
+    def _dispatch(self, data):
+        """ Calls the function processing a packet """
         if 'responseTo' in data:
             self._process_response_to(data)
         elif data['plType'] is 'videoRequest':
             self._process_video_request(data)
+        elif data['plType'] is 'cancel':
+            self._process_cancel(data)
+        elif data['plType'] is 'digest':
+            self._process_digest(data)
         elif data['plType'] is 'other':
             self._process_other(data)
 
@@ -643,6 +1541,56 @@ class ForwardProxy(AbstractProxy):
         """ Data structure to store the active requests so that we can reply 
             to them 
         """
+        self._forwarded = dict()
+        """ packetId of the forwarded request, by (origSender, origPackId),
+            to cancel it
+        """
+        self.parent = None
+        """ ID of the parent proxy the requests are forwarded to, None to
+            forward them to the video servers
+        """
+        self.upstream_kb = 0
+        """ kb received from the parent proxy or the servers, not from the
+            siblings
+        """
+        self._stats_lock = threading.Lock()
+        """ the counters are changed by the threads of all the connections """
+
+    def set_parent(self, parent_id):
+        """ Forwards the requests to a parent proxy instead of the video 
+            servers, to build a hierarchy of caches.
+
+            Args:
+                parent_id: ID of the parent proxy, which must be connected, 
+                           or None
+        """
+        self.parent = parent_id
+
+    def _upstream_for(self, payload):
+        """ Returns the connection a request is forwarded to: the one to the
+            parent proxy if there is one, to the video server otherwise.
+
+            Args:
+                payload (dict): the payload of the request
+        """
+        if self.parent is not None:
+            return self.connection[self.parent]
+        return self.connection[payload['idServer']]
+
+    def _forward_request(self, data, upstream=None):
+        """ Forwards a request upstream, see :func:`_upstream_for`, or on 
+            the given connection
+
+            Returns:
+                the information about the forwarded request, see 
+                :func:`_get_req_info`
+        """
+        forward_data = self._pack_forward_request(data)
+        upstream = upstream or self._upstream_for(data['payload'])
+        req_info = self.active_requests[forward_data['packetId']]
+        req_info['upstream'] = upstream
+        upstream.send(forward_data, 'forwardchunk')
+        return req_info
 
     def _pack_forward_request(self, data):
         """ Packs data to be forwarded and stores the ID of the sender in the 
@@ -661,7 +1609,9 @@ class ForwardProxy(AbstractProxy):
         forward_data['chunkSize'] = data['chunkSize']
         # store the forwarded packetId in the active request to keep track of it
         self.active_requests[forward_data['packetId']] = \
-                {'origSender': data['sender'], 'origPackId': data['packetId']}
+                {'origSender': data['sender'], 'origPackId': data['packetId'],
+                 'idServer': data['payload']['idServer']}
+        self._forwarded[(data['sender'], data['packetId'])] = forward_data['packetId']
 
         return forward_data
 
@@ -673,34 +1623,92 @@ class ForwardProxy(AbstractProxy):
                 data (dict): the data to pack
 
             Returns:
-                Data in a dictionnary ready to be forwarded
+                Data in a dictionnary ready to be forwarded, None if the 
+                request was cancelled meanwhile
         """
         response_to = data['responseTo']
-        req_info = self.active_requests[response_to]
+        req_info = self.active_requests.get(response_to)
+        if req_info is None:
+            return None
         forward_data = self._pack_data(data['payload'], 
                                    data['plSize'], 
                                    data['plType'], 
                                    req_info['origPackId'])
         forward_data['chunkId'] = data['chunkId']
         forward_data['chunkSize'] = data['chunkSize']
+        req_info['forwarded'] = req_info.get('forwarded', 0) + data['chunkSize']
+        if 'sibling' not in req_info:
+            # the data of the siblings is counted by the caching proxies
+            with self._stats_lock:
+                self.upstream_kb += data['chunkSize']
         if 'lastChunk' in data:
-            del self.active_requests[response_to]
+            self.active_requests.pop(response_to, None)
+            self._forwarded.pop((req_info['origSender'], req_info['origPackId']), None)
 
         return forward_data
 
+    def _add_stat(self, stats, name, value):
+        """ Adds value to the counter name of the dict stats, from any 
+            thread
+        """
+        with self._stats_lock:
+            stats[name] += value
+
+    def _cache_key(self, payload):
+        """ The key of a video in the caches: its id, or its id, rendition and
+            segment when the clients download the renditions segment by
+            segment (see :mod:`abr`).
+        """
+        if 'segment' in payload:
+            return (payload['idVideo'], payload['rendition'], payload['segment'])
+        return payload['idVideo']
+
     def _process_video_request(self, data):
-        """ Forwards the request to the VideoServer """
+        """ Forwards the request to the VideoServer, or the parent proxy """
         #print("DATA "+str(data))
-        forward_data = self._pack_forward_request(data)
-        self.connection[data['payload']['idServer']].send(forward_data, 'forwardchunk')
+        self._forward_request(data)
 
     def _process_response_to(self, data):
         """ Forwards the response to the Client """
         response_to = data['responseTo']
-        req_info = self.active_requests[response_to]
+        req_info = self._get_req_info(response_to)
+        if req_info is None:
+            # cancelled, this chunk was already on its way
+            return
         new_data = self._pack_forward_response(data)
+        if new_data is None:
+            return
         self.connection[req_info['origSender']].send(new_data, 'forwardchunk')
 
+    def _process_cancel(self, data):
+        """ The client does not want the rest of a response: the chunks 
+            waiting to be sent to it are dropped and, if the request was
+            forwarded, it is cancelled upstream too.
+        """
+        pld = data['payload']
+        req_info = self._cancel_forwarded(data['sender'], pld['packetId'])
+        self.connection[data['sender']].cancel(pld['packetId'])
+        return req_info
+
+    def _cancel_forwarded(self, sender, packet_id):
+        """ Forgets the forwarded request for the packet packet_id of sender
+            and sends a cancel packet to the server.
+
+            Returns:
+                the information about the request (see :func:`_get_req_info`),
+                None if it was not forwarded or is already complete
+        """
+        forward_id = self._forwarded.pop((sender, packet_id), None)
+        if forward_id is None:
+            return None
+        req_info = self.active_requests.pop(forward_id, None)
+        if req_info is None:
+            return None
+        cancel_data = self._pack_data({'idServer': req_info['idServer'], 
+                                       'packetId': forward_id}, None, 'cancel')
+        req_info['upstream'].send(cancel_data)
+        return req_info
+
     def _process_other(self, data):
         """ To test the connection, replies dummy things. """
         real_data = self._pack_data("There you go: "+ data['payload'], 
@@ -716,7 +1724,8 @@ class ForwardProxy(AbstractProxy):
         Returns:
             dictionnary containing the original sender origSender and the 
             original packet id origPackId of the request we forwarded, so that
-            we can forward the response back.
+            we can forward the response back. None if the request was 
+            cancelled or is complete.
 
 
         Usage example:
@@ -725,7 +1734,7 @@ class ForwardProxy(AbstractProxy):
         >>> {'origSender': 1003, 'origPackId': 18}
 
         """
-        return self.active_requests[id_req]
+        return self.active_requests.get(id_req)
 
 class CachingInterface(metaclass=ABCMeta):
     """ Common interface for proxies that are actually caching objects.
@@ -746,7 +1755,7 @@ class CachingInterface(metaclass=ABCMeta):
         """
         pass
 
-class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=ABCMeta):
+class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, Observable, metaclass=ABCMeta):
     """ Common abstract class for proxies that are actually caching objects.
 
         To implement your own Proxy, extend this Class.
@@ -769,14 +1778,56 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
 
         .. literalinclude:: ../../extend.py
 
+        The connections call the proxy from their own threads. The requests,
+        responses and cancellations for a video are processed one at a time,
+        under the lock of the shard of its key (see :mod:`locks`), so that 
+        those for different videos rarely wait for each other. The cache 
+        itself (the videos, its size and the data of the policy, which 
+        orders all the videos) is changed under the cache lock, 
+        self._cache_lock, always taken after the shard lock and held 
+        briefly. The abstract methods are called with the cache lock held:
+        they must only update the data of the policy, and never block, send
+        anything or call another proxy. A subclass changing the cache in 
+        another way takes the cache lock too. See :func:`get_lock_stats` for
+        the contention of the locks.
+
+        The observers (see :func:`add_observer` and :mod:`metrics`) are 
+        called on each hit (on_hit) and on the first chunk of each miss 
+        (on_miss) of the clients, with the key and the size of the video in
+        kb, under the lock of the shard of the video.
+
     """
 
+    HOOKS = ('on_hit', 'on_miss')
+
     def __init__(self, *args, **kargs):
         ForwardProxy.__init__(self, *args, **kargs)
         ProxyHitCounter.__init__(self)
+        Observable.__init__(self)
+        self._cache_lock = locks.InstrumentedLock()
+        """ lock of the cache and of the data of the policy """
+        self._shards = locks.ShardedLock(16)
+        """ locks of the requests, by shard of the keys of the videos """
         self.__cachedb = dict()
         self.__cache_size = 0
         self.__cache_max_size = 4096
+        self._siblings = []
+        """ IDs of the sibling proxies, see :func:`set_siblings` """
+        self._sibling_digests = dict()
+        """ last :class:`digest.BloomFilter` received from each sibling """
+        self._digest_interval = 60
+        self._digest_fp_rate = 0.01
+        self._digest_timer = None
+        """ handle of the timer of the next digest, see :func:`stop_digests` """
+        self._digest_lock = threading.Lock()
+        self._cache_changed = True
+        """ if the digest must be sent again """
+        self.reset_sibling_stats()
+        self._prefetching = set()
+        """ keys of the videos being prefetched """
+        self._prefetched = set()
+        """ keys of the videos prefetched and not requested yet """
+        self.reset_prefetch_stats()
 
     def set_cache_size(self, size):
         """ Change the maximum size of the cache
@@ -785,6 +1836,210 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
         """
         self.__cache_max_size = size
 
+    def set_lock_shards(self, nb_shards):
+        """ Change the number of locks of the requests, before the 
+            simulation starts
+        """
+        self._shards = locks.ShardedLock(nb_shards)
+
+    def reset_lock_stats(self):
+        """ Sets the counters of the locks back to zero, see 
+            :func:`get_lock_stats`
+        """
+        self._shards.reset_stats()
+        self._cache_lock.reset_stats()
+
+    def get_lock_stats(self):
+        """
+            Returns:
+                A dictionnary containing the stats of the shard locks 
+                (prefix shard_) and of the cache lock (prefix cache_), 
+                see :func:`locks.ShardedLock.get_stats`: the acquisitions, 
+                the contended ones, the contention and the wall-clock 
+                seconds the threads waited, and the contended acquisitions 
+                of the busiest shard.
+        """
+        stats = {'shards': len(self._shards)}
+        for prefix, lock in (('shard_', self._shards), ('cache_', self._cache_lock)):
+            for name, value in lock.get_stats().items():
+                stats[prefix+name] = value
+        return stats
+
+    def set_siblings(self, sibling_ids, digest_interval=60, fp_rate=0.01):
+        """ Cooperates with sibling proxies, connected both ways to this 
+            one. Every digest_interval seconds, if its cache changed, the 
+            proxy sends a digest of its cache (a Bloom filter of the keys, 
+            see :mod:`digest`) to its siblings. On a miss, the request is sent
+            to a sibling whose digest contains the video before going to the
+            parent proxy or the server. A sibling only serves its cache, and
+            answers a siblingMiss when the digest was a false positive.
+
+            Args:
+                sibling_ids (list): IDs of the siblings
+                digest_interval (float): seconds between two digests
+                fp_rate (float): probability of false positive of the digests
+        """
+        self.stop_digests()
+        self._siblings = list(sibling_ids)
+        self._digest_interval = digest_interval
+        self._digest_fp_rate = fp_rate
+        if self._siblings:
+            with self._digest_lock:
+                self._digest_timer = simu.timers.call_later(0, self._publish_digest)
+
+    def stop_digests(self):
+        """ Stops sending the digests, at the end of the simulation """
+        with self._digest_lock:
+            if self._digest_timer is not None:
+                simu.timers.cancel(self._digest_timer)
+                self._digest_timer = None
+
+    def _publish_digest(self):
+        """ Sends the digest of the cache to the siblings if it changed, 
+            and again every digest_interval seconds, until 
+            :func:`stop_digests`
+        """
+        if self._cache_changed:
+            self._cache_changed = False
+            bloom = digest.BloomFilter.from_keys(self.cache_keys(), self._digest_fp_rate)
+            for sibling in self._siblings:
+                self.connection[sibling].send(self._pack_data(bloom, bloom.size_kb, 'digest'),
+                                              'donotchunk')
+                self._add_stat(self.sibling_stats, 'digest_kb', bloom.size_kb)
+        with self._digest_lock:
+            # not stopped meanwhile
+            if self._digest_timer is not None:
+                self._digest_timer = simu.timers.call_later(self._digest_interval, 
+                                                            self._publish_digest)
+
+    def _process_digest(self, data):
+        """ Keeps the last digest of each sibling """
+        self._sibling_digests[data['sender']] = data['payload']
+
+    def _sibling_for(self, key):
+        """ Returns the first sibling whose digest contains the key, or None """
+        for sibling in self._siblings:
+            bloom = self._sibling_digests.get(sibling)
+            if bloom is not None and key in bloom:
+                return sibling
+        return None
+
+    def reset_sibling_stats(self):
+        """ Sets the counters of the cooperation with the siblings back to
+            zero, see :func:`get_sibling_stats`
+        """
+        self.sibling_stats = dict.fromkeys(['sibling_requests', 'sibling_hits', 
+                                            'false_positives', 'false_positive_time',
+                                            'sibling_kb', 'sibling_served_kb', 
+                                            'digest_kb'], 0)
+
+    def get_sibling_stats(self):
+        """ 
+            Returns:
+                A dictionnary containing the stats of the cooperation with 
+                the siblings, fields:
+
+                - sibling_requests (int): misses sent to a sibling
+                - sibling_hits (int): of those, served by the sibling
+                - false_positives (int): of those, not in the cache of the
+                                         sibling despite its digest
+                - false_positive_time (float): seconds lost asking the 
+                                               siblings because of them
+                - sibling_kb (float): kb received from the siblings, which
+                                      did not come from upstream
+                - sibling_served_kb (float): kb sent to the siblings
+                - digest_kb (float): kb of digests sent to the siblings
+        """
+        return dict(self.sibling_stats)
+
+    def prefetch(self, payload):
+        """ Fetches a video from upstream into the cache, without a client
+            requesting it, see :mod:`prefetch`.
+
+            Args:
+                payload (dict): the payload of a request for the video
+
+            Returns:
+                False if the video is already cached or being prefetched
+        """
+        key = self._cache_key(payload)
+        with self._shards.for_key(key):
+            if key in self._prefetching or self.cache_has(payload):
+                return False
+            self._prefetching.add(key)
+            data = self._pack_data(payload, None, 'videoRequest')
+            data['chunkId'] = 0
+            data['chunkSize'] = data['plSize']
+            req_info = self._forward_request(data)
+            req_info['prefetch'] = key
+            req_info['asked'] = simu.time_()
+        return True
+
+    def _prefetch_response(self, data, req_info):
+        """ Caches a prefetched video instead of forwarding it """
+        if data['chunkId'] == 0:
+            self._add_stat(self.prefetch_stats, 'upstream_delay', simu.time_() - req_info['asked'])
+            evicted = []
+            if self.cache_store(data['payload'], evicted):
+                self._add_stat(self.prefetch_stats, 'prefetched', 1)
+                self._add_stat(self.prefetch_stats, 'prefetch_kb', data['payload']['size'])
+                with self._stats_lock:
+                    self._prefetched.add(req_info['prefetch'])
+            self._forget_prefetched(evicted)
+        # to forget the request after the last chunk
+        self._pack_forward_response(data)
+        if 'lastChunk' in data:
+            self._prefetching.discard(req_info['prefetch'])
+
+    def _prefetch_hit(self, key):
+        """ A request is served from the cache, counts it if the video was
+            prefetched
+        """
+        with self._stats_lock:
+            if key in self._prefetched:
+                self._prefetched.discard(key)
+                self.prefetch_stats['useful'] += 1
+
+    def _forget_prefetched(self, videos):
+        """ The videos left the cache, a later hit for them is not thanks
+            to the prefetching
+        """
+        if videos:
+            with self._stats_lock:
+                for video in videos:
+                    self._prefetched.discard(self._cache_key(video))
+
+    def reset_prefetch_stats(self):
+        """ Sets the counters of the prefetching back to zero, see 
+            :func:`get_prefetch_stats`
+        """
+        self.prefetch_stats = dict.fromkeys(['prefetched', 'prefetch_kb', 'useful', 
+                                             'upstream_delay'], 0)
+        self._prefetched.clear()
+
+    def get_prefetch_stats(self):
+        """
+            Returns:
+                A dictionnary containing the stats of the prefetching, 
+                fields:
+
+                - prefetched (int): videos prefetched into the cache
+                - prefetch_kb (float): kb of these videos
+                - useful (int): of those, requested before being evicted
+                - accuracy (float): useful/prefetched
+                - upstream_delay (float): mean seconds before the first 
+                                          chunk of a prefetched video came
+                - latency_saved (float): seconds of startup latency saved by
+                                         the useful prefetches, estimated as
+                                         the upstream delay of each one
+        """
+        stats = dict(self.prefetch_stats)
+        nb = stats['prefetched']
+        stats['accuracy'] = stats['useful']/nb if nb else 0
+        stats['upstream_delay'] = stats['upstream_delay']/nb if nb else 0
+        stats['latency_saved'] = stats['useful']*stats['upstream_delay']
+        return stats
+
     @abc.abstractmethod
     def _cache_admission(self, video):
         """ Should return true to admit the video in the cache
@@ -804,7 +2059,9 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
             This is the cache eviction part of the proxy
 
             Returns:
-                The id of the video to remove from the cache
+                The key of the video to remove from the cache, as given by
+                :func:`_cache_key`: with ABR clients, a (idVideo, rendition,
+                segment) tuple, not the idVideo
         """
         pass
 
@@ -832,6 +2089,18 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
         """
         pass
 
+    def _video_discarded(self, video):
+        """ To signal that a video has been removed from the cache without 
+            being evicted, because the request which brought it was 
+            cancelled before the end of the download. Use this to forget the
+            video in your data structures. A policy which does not may still
+            return its key in _id_to_evict, it is then skipped.
+
+            Args:
+                video (dict): the video removed from the cache
+        """
+        pass
+
     def _cache_full(self, newSize=0):
         """ check if the cache is full, or will be if we add the new size.
 
@@ -846,7 +2115,7 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
         """
         return (self.__cache_size+newSize) >= self.__cache_max_size
 
-    def _make_space_for_new_video(self, video=None, size=None):
+    def _make_space_for_new_video(self, video=None, size=None, evicted=None):
         """ Removes videos until we have enough space. Calls _id_to_evict in 
             loop and removes this video until we have enough space.
 
@@ -855,15 +2124,29 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
                 size (int): if video is not specified, will use this size as the
                             size of the video to calculate how much to remove 
                             from the cache.
+                evicted (list): if given, the videos removed are appended to it
         """
         vsize = size
         if video != None:
             vsize = video['size']
 
-        while self._cache_full(vsize):
-            id_evict = self._id_to_evict()
-            self.__cache_size -= self.__cachedb[id_evict]['size']
-            del self.__cachedb[id_evict]
+        with self._cache_lock:
+            while self._cache_full(vsize):
+                self._evict_one(evicted)
+
+    def _evict_one(self, evicted=None):
+        """ Removes the video chosen by _id_to_evict. A key which is not in
+            the cache any more, discarded without the policy being told (see
+            :func:`_video_discarded`), is skipped.
+        """
+        id_evict = self._id_to_evict()
+        old_video = self.__cachedb.pop(id_evict, None)
+        if old_video is None:
+            return
+        self.__cache_size -= old_video['size']
+        self._cache_changed = True
+        if evicted is not None:
+            evicted.append(old_video)
 
     def _insert_new_video(self, video):
         """ inserts a new video, updates the cache size.
@@ -871,56 +2154,244 @@ class CachingProxy(ForwardProxy, CachingInterface, ProxyHitCounter, metaclass=AB
             Args:
                 video (dict): the video to insert
         """
-        self.__cachedb[video['idVideo']] = video
-        self.__cache_size += video['size']
-        self._new_video_inserted(video)
+        with self._cache_lock:
+            self.__cachedb[self._cache_key(video)] = video
+            self.__cache_size += video['size']
+            self._cache_changed = True
+            self._new_video_inserted(video)
+
+    def cache_lookup(self, payload):
+        """ Returns the video of the cache for a request, or None. The 
+            video is signaled as served, see :func:`_video_served`.
+
+            Args:
+                payload (dict): the payload of the request, or the video
+        """
+        with self._cache_lock:
+            video = self.__cachedb.get(self._cache_key(payload))
+            if video is not None:
+                self._video_served(video)
+        return video
+
+    def cache_store(self, video, evicted=None):
+        """ Caches a video, if it's not already in the cache and we decide 
+            to cache it and it's smaller than the cache size. Videos are 
+            evicted to make space for it.
+
+            Args:
+                video (dict): the video to cache
+                evicted (list): if given, the videos evicted are appended to
+                                it, see :class:`TieredProxy`
+
+            Returns:
+                True if the video was inserted
+        """
+        with self._cache_lock:
+            if self._cache_key(video) in self.__cachedb or\
+               not self._cache_admission(video) or\
+               video['size'] >= self.__cache_max_size:
+                return False
+            self._make_space_for_new_video(video, evicted=evicted)
+            self._insert_new_video(video)
+        return True
+
+    def cache_discard(self, video):
+        """ Removes a video from the cache, see :func:`_discard_video` """
+        self._discard_video(video)
+
+    def cache_keys(self):
+        """ Returns the keys of the videos in the cache """
+        with self._cache_lock:
+            return list(self.__cachedb)
+
+    def cache_has(self, payload):
+        """ True if the video of a request is in the cache, without 
+            signaling it as served
+        """
+        with self._cache_lock:
+            return self._cache_key(payload) in self.__cachedb
+
+    def cache_used(self):
+        """ Returns the kb of videos in the cache """
+        return self.__cache_size
+
+    def cache_trim(self, evicted=None):
+        """ Evicts videos until the cache fits its size, after it was 
+            reduced by set_cache_size
+
+            Args:
+                evicted (list): if given, the videos evicted are appended to it
+        """
+        with self._cache_lock:
+            while self.__cachedb and self.__cache_size > self.__cache_max_size:
+                self._evict_one(evicted)
+
+    def _cache_read(self, data):
+        """ Looks up the video of a request in the cache.
+
+            Returns:
+                the video, or None, and the seconds needed to read it before
+                sending it, 0 by default
+        """
+        return self.cache_lookup(data['payload']), 0
+
+    def _discard_video(self, video):
+        """ removes a video which was not fetched entirely, updates the cache
+            size.
+
+            Args:
+                video (dict): the video to remove
+        """
+        key = self._cache_key(video)
+        with self._cache_lock:
+            if self.__cachedb.get(key) is not video:
+                # already evicted
+                return
+            del self.__cachedb[key]
+            self.__cache_size -= video['size']
+            self._cache_changed = True
+            self._video_discarded(video)
 
     def _process_video_request(self, data):
         """ Main logic of the Proxy. Will serve the video from the cache, or 
             forward the request to the VideoServer.
 
         """
+        with self._shards.for_key(self._cache_key(data['payload'])):
+            self._serve_request(data)
+
+    def _serve_request(self, data):
+        """ Serves a request from the cache or forwards it, with the lock 
+            of its shard held
+        """
         pld = data['payload']
-        if pld['idVideo'] in self.__cachedb:
-            video = self.__cachedb[pld['idVideo']]
-            # for the metric, ProxyHitCounter
-            self._from_cache(size_kb=video['size'])
+        key = self._cache_key(pld)
+        video, read_delay = self._cache_read(data)
+        if video is not None:
+            dropped = self._dropped_from_cache
+            if pld.get('sibling'):
+                # a hit for the sibling, not for the clients of this proxy
+                self._add_stat(self.sibling_stats, 'sibling_served_kb', video['size'])
+                dropped = self._dropped_to_sibling
+            else:
+                # for the metric, ProxyHitCounter
+                self._from_cache(size_kb=video['size'])
+                self._prefetch_hit(key)
+                for hook in self._on_hit_hooks:
+                    hook(key, video['size'])
 
             new_data = self._pack_data(video, video['size'], 
                                        'video', data['packetId'])
-            self._video_served(video)
-            self.connection[data['sender']].send(new_data)
+            if read_delay > 0:
+                simu.timers.call_later(read_delay, self.connection[data['sender']].send,
+                                       new_data, 'normal', None, dropped)
+            else:
+                self.connection[data['sender']].send(new_data, dropped=dropped)
+        elif pld.get('sibling'):
+            # false positive of our digest, the sibling asks upstream
+            miss = self._pack_data(pld, data['plSize'], 'siblingMiss', 
+                                   data['packetId'])
+            self.connection[data['sender']].send(miss, 'donotchunk')
         else:
-            forward_data = self._pack_forward_request(data)
-            self.connection[data['payload']['idServer']].send(forward_data, 
-                                                              'forwardchunk')
+            sibling = self._sibling_for(key)
+            if sibling is None:
+                self._forward_request(data)
+            else:
+                self._add_stat(self.sibling_stats, 'sibling_requests', 1)
+                req_info = self._forward_request(dict(data, payload=dict(pld, sibling=True)),
+                                                 self.connection[sibling])
+                req_info['sibling'] = sibling
+                req_info['request'] = data
+                req_info['asked'] = simu.time_()
 
     def _process_response_to(self, data):
         """ Main logic of the Proxy. Will cache the video or not, depending on 
             the implentation of the abstract methods.
 
         """
+        with self._shards.for_key(self._cache_key(data['payload'])):
+            self._serve_response(data)
+
+    def _serve_response(self, data):
+        """ Caches and forwards a chunk of a response, with the lock of the
+            shard of the video held
+        """
         response_to = data['responseTo']
         req_info = self._get_req_info(response_to)
+        if req_info is None:
+            # cancelled, this chunk was already on its way
+            return
+
+        if data['plType'] is 'siblingMiss':
+            self._sibling_miss(response_to, req_info)
+            return
+        if 'prefetch' in req_info:
+            self._prefetch_response(data, req_info)
+            return
+        if 'sibling' in req_info:
+            if data['chunkId'] == 0:
+                self._add_stat(self.sibling_stats, 'sibling_hits', 1)
+            self._add_stat(self.sibling_stats, 'sibling_kb', data['chunkSize'])
 
         pld = data['payload']
+        if data['chunkId'] == 0:
+            for hook in self._on_miss_hooks:
+                hook(self._cache_key(pld), pld['size'])
         
-        if pld['idVideo'] not in self.__cachedb and\
-           self._cache_admission(pld) and\
-           pld['size'] < self.__cache_max_size:
-            """ cache the video, if it's not already in the cache
-                and we decide to cache it
-                and it's smaller than the cache size
-            """
+        evicted = []
+        if self.cache_store(pld, evicted):
             # for the metric
             self._from_server(size_kb=pld['size'])
-
-            self._make_space_for_new_video(pld)
-            self._insert_new_video(pld)
+            # to take it back if the request is cancelled
+            req_info['inserted'] = pld
+        self._forget_prefetched(evicted)
 
         new_data = self._pack_forward_response(data)
+        if new_data is None:
+            return
 
-        self.connection[req_info['origSender']].send(new_data, 'forwardchunk')
+        dropped = None
+        if 'inserted' in req_info:
+            dropped = self._dropped_from_server
+        self.connection[req_info['origSender']].send(new_data, 'forwardchunk', 
+                                                     dropped=dropped)
+
+    def _process_cancel(self, data):
+        """ Cancels the request. What will not be sent to the client is not
+            counted in the metrics, and a video inserted in the cache for 
+            this request is removed, as it was not fetched entirely.
+        """
+        req_info = ForwardProxy._process_cancel(self, data)
+        if req_info is not None and 'inserted' in req_info:
+            video = req_info['inserted']
+            with self._shards.for_key(self._cache_key(video)):
+                # not received from the server, the chunks already forwarded
+                # but not sent are counted by _dropped_from_server
+                self._not_sent(size_kb=video['size']-req_info.get('forwarded', 0))
+                self._discard_video(video)
+                self._forget_prefetched([video])
+
+    def _sibling_miss(self, response_to, req_info):
+        """ The sibling did not have the video, the request is forwarded 
+            upstream as if the digest had not been checked
+        """
+        self.active_requests.pop(response_to, None)
+        self._forwarded.pop((req_info['origSender'], req_info['origPackId']), None)
+        self._add_stat(self.sibling_stats, 'false_positives', 1)
+        self._add_stat(self.sibling_stats, 'false_positive_time', simu.time_() - req_info['asked'])
+        self._forward_request(req_info['request'])
+
+    def _dropped_to_sibling(self, size):
+        """ called by the connections, size kb for a sibling are not sent """
+        self._add_stat(self.sibling_stats, 'sibling_served_kb', -size)
+
+    def _dropped_from_cache(self, size):
+        """ called by the connections, size kb of a hit are not sent """
+        self._not_sent(size_kb=size, from_cache=True)
+
+    def _dropped_from_server(self, size):
+        """ called by the connections, size kb of a miss are not sent """
+        self._not_sent(size_kb=size)
 
 class FIFOProxy(CachingProxy):
     """ Cache video in a limited size cache, 
@@ -928,8 +2399,10 @@ class FIFOProxy(CachingProxy):
     """
     def __init__(self, *args, **kargs):
         CachingProxy.__init__(self, *args, **kargs)
-        """ Data structure to decide which video to evict """
-        self.__cache_fifo = deque()
+        """ Data structure to decide which video to evict, ordered by 
+            insertion, a dict so that a discarded video is removed in O(1)
+        """
+        self.__cache_fifo = OrderedDict()
 
     def _cache_admission(self, video):
         """ We cache/admit everything. Always True. """
@@ -937,7 +2410,7 @@ class FIFOProxy(CachingProxy):
 
     def _id_to_evict(self):
         """ Removes and returns the id of the video to evict. """
-        return self.__cache_fifo.popleft()
+        return self.__cache_fifo.popitem(last=False)[0]
 
     def _video_served(self, video):
         """ We don't care that a video has been served, it doesn't change
@@ -949,7 +2422,11 @@ class FIFOProxy(CachingProxy):
         """ Update the FIFO to know which video to remove (oldest one)
             when needed.
         """
-        self.__cache_fifo.append(video['idVideo'])
+        self.__cache_fifo[self._cache_key(video)] = None
+
+    def _video_discarded(self, video):
+        """ The video will not be evicted, it is not in the cache any more """
+        self.__cache_fifo.pop(self._cache_key(video), None)
 
 class LRUProxy(CachingProxy):
     """ Cache video in a limited size cache, 
@@ -957,8 +2434,11 @@ class LRUProxy(CachingProxy):
     """
     def __init__(self, *args, **kargs):
         CachingProxy.__init__(self, *args, **kargs)
-        """ Stack data structure to decide which video to evict """
-        self.__cache_fifo = deque()
+        """ Stack data structure to decide which video to evict, the most
+            recently used at the end, a dict so that a video is moved or 
+            removed in O(1)
+        """
+        self.__cache_fifo = OrderedDict()
 
     def _cache_admission(self, video):
         """ We admit everything """
@@ -968,19 +2448,471 @@ class LRUProxy(CachingProxy):
         """ removes and returns the id of the least recently used video,
             the id at the bottom of the stack, to evict it 
         """
-        return self.__cache_fifo.popleft()
+        return self.__cache_fifo.popitem(last=False)[0]
 
     def _video_served(self, video):
         """ when a video is re-accessed, we replace it at the top of the stack,
             so that a recently used video will not be evicted.
         """
-        self.__cache_fifo.remove(video['idVideo'])
-        self.__cache_fifo.append(video['idVideo'])
+        self.__cache_fifo.move_to_end(self._cache_key(video))
 
     def _new_video_inserted(self, video):
         """ Insert the id of the new video at the top of the stack.
         """
-        self.__cache_fifo.append(video['idVideo'])
+        self.__cache_fifo[self._cache_key(video)] = None
+
+    def _video_discarded(self, video):
+        """ Removes the id of the video from the stack """
+        self.__cache_fifo.pop(self._cache_key(video), None)
+
+
+class TieredProxy(CachingProxy):
+    """ Cache video in several tiers, like a small RAM and a large disk, each
+        with its own size, policy, latency and read bandwidth.
+
+        The tiers are exclusive: a video is in one tier only. The videos are
+        inserted in the first tier, and those it evicts are demoted to the
+        next one (and so on, the last tier evicts them for good). A hit in a
+        lower tier promotes the video to the first tier. A video refused by 
+        a tier (admission or size) goes to the next one.
+
+        A hit is sent to the client after the service time of its tier: the
+        latency of the tier, and the time the read takes beyond the sending
+        of the video when the tier is slower than the connection to the 
+        client, the read and the sending being pipelined.
+
+        .. code-block:: python
+
+            proxy = TieredProxy(0, "Proxy")
+            ram = LRUProxy(0, "RAM")
+            ram.set_cache_size(16000)
+            proxy.add_tier('ram', ram)
+            proxy.add_tier('disk', FIFOProxy(0, "Disk"), latency=0.005, 
+                           bandwidth=4000)
+            proxy.set_cache_size(256000)
+    """
+    def __init__(self, *args, **kargs):
+        CachingProxy.__init__(self, *args, **kargs)
+        self.tiers = []
+        """ the tiers, fastest first, as dict with the name, the cache (a
+            :class:`CachingProxy`), the latency and the bandwidth
+        """
+
+    def add_tier(self, name, cache, latency=0, bandwidth=0):
+        """ Adds a tier, slower than the previous ones.
+
+            Args:
+                name (str): name of the tier, in the statistics
+                cache (:class:`CachingProxy`): any caching proxy, only used
+                       for its cache and its policy
+                latency (float): seconds before the first byte is read
+                bandwidth (float): read speed of the tier in kb/s, 0 if it 
+                                   is never slower than the connections
+        """
+        with self._cache_lock:
+            self.tiers.append({'name': name, 'cache': cache, 
+                               'latency': latency, 'bandwidth': bandwidth})
+        self.reset_tier_stats()
+
+    def set_cache_size(self, size):
+        """ Change the maximum size of the last tier, the largest one, 
+            which must have been added
+        """
+        if self.tiers:
+            self.tiers[-1]['cache'].set_cache_size(size)
+
+    def _cache_admission(self, video):
+        """ Each tier decides """
+        return True
+
+    def _id_to_evict(self):
+        """ Not used, each tier evicts """
+        return None
+
+    def _new_video_inserted(self, video):
+        pass
+
+    def _video_served(self, video):
+        pass
+
+    def _tier_lookup(self, payload):
+        """ Returns the video of a request, or None, and the index of its 
+            tier, then promotes it to the first tier
+        """
+        with self._cache_lock:
+            for index, tier in enumerate(self.tiers):
+                video = tier['cache'].cache_lookup(payload)
+                if video is None:
+                    continue
+                if index > 0:
+                    tier['cache'].cache_discard(video)
+                    if self._store_in(video, 0) == 0:
+                        self.tier_stats[self.tiers[0]['name']]['promotions'] += 1
+                return video, index
+        return None, None
+
+    def _store_in(self, video, index, evicted=None):
+        """ Stores a video in the first tier from index accepting it, the 
+            videos it evicts going to the next tier.
+
+            Returns:
+                the index of the tier, None if no tier accepted the video
+        """
+        while index < len(self.tiers):
+            demoted = []
+            if self.tiers[index]['cache'].cache_store(video, demoted):
+                for old_video in demoted:
+                    if index+1 == len(self.tiers):
+                        if evicted is not None:
+                            evicted.append(old_video)
+                    elif self._store_in(old_video, index+1, evicted) is not None:
+                        self.tier_stats[self.tiers[index+1]['name']]['demotions'] += 1
+                return index
+            index += 1
+        return None
+
+    def cache_lookup(self, payload):
+        """ Returns the video of the cache for a request, or None, and 
+            promotes it to the first tier
+        """
+        return self._tier_lookup(payload)[0]
+
+    def cache_store(self, video, evicted=None):
+        """ Caches a video in the first tier accepting it, see 
+            :func:`CachingProxy.cache_store`
+        """
+        with self._cache_lock:
+            if self._tier_of(video) is not None:
+                return False
+            stored = self._store_in(video, 0, evicted) is not None
+        if stored:
+            self._cache_changed = True
+        return stored
+
+    def cache_discard(self, video):
+        """ Removes a video from its tier """
+        with self._cache_lock:
+            for tier in self.tiers:
+                tier['cache'].cache_discard(video)
+        self._cache_changed = True
+
+    def _discard_video(self, video):
+        self.cache_discard(video)
+
+    def cache_keys(self):
+        """ Returns the keys of the videos in all the tiers """
+        with self._cache_lock:
+            return [key for tier in self.tiers for key in tier['cache'].cache_keys()]
+
+    def cache_has(self, payload):
+        with self._cache_lock:
+            return self._tier_of(payload) is not None
+
+    def _tier_of(self, video):
+        """ Index of the tier of a video, None if it is not cached """
+        for index, tier in enumerate(self.tiers):
+            if tier['cache'].cache_has(video):
+                return index
+        return None
+
+    def _cache_read(self, data):
+        """ Looks up a video in the tiers, and computes the service time of
+            its tier
+        """
+        video, index = self._tier_lookup(data['payload'])
+        if video is None:
+            return None, 0
+        tier = self.tiers[index]
+        delay = tier['latency']
+        if tier['bandwidth'] > 0:
+            link_time = video['size']/self.connection[data['sender']].bandwidth
+            delay += max(0, video['size']/tier['bandwidth'] - link_time)
+        with self._cache_lock:
+            stats = self.tier_stats[tier['name']]
+            stats['hits'] += 1
+            stats['hit_kb'] += video['size']
+            stats['read_delay'] += delay
+        return video, delay
+
+    def reset_tier_stats(self):
+        """ Sets the counters of the tiers back to zero, see 
+            :func:`get_tier_stats`
+        """
+        with self._cache_lock:
+            self.tier_stats = {tier['name']: dict.fromkeys(['hits', 'hit_kb', 'read_delay',
+                                                            'promotions', 'demotions'], 0)
+                               for tier in self.tiers}
+
+    def get_tier_stats(self):
+        """
+            Returns:
+                A list of dictionnaries, one per tier, with the fields:
+
+                - tier (str): the name of the tier
+                - hits (int): videos served from the tier
+                - hit_ratio (float): hits over the videos served
+                - byte_hit_ratio (float): kb served from the tier over the kb
+                                          served
+                - extra_latency (float): mean service time of the hits of the
+                                         tier, in seconds
+                - promotions (int): videos promoted to the tier
+                - demotions (int): videos demoted to the tier
+        """
+        hit_stats = self.get_hit_stats()
+        rows = []
+        for tier in self.tiers:
+            stats = self.tier_stats[tier['name']]
+            # byte_served is in kB
+            byte_served = hit_stats['byte_served']*8
+            rows.append({'tier': tier['name'], 'hits': stats['hits'],
+                         'hit_ratio': stats['hits']/hit_stats['nb_served'] if hit_stats['nb_served'] else 0,
+                         'byte_hit_ratio': stats['hit_kb']/byte_served if byte_served else 0,
+                         'extra_latency': stats['read_delay']/stats['hits'] if stats['hits'] else 0,
+                         'promotions': stats['promotions'], 
+                         'demotions': stats['demotions']})
+        return rows
+
+
+class PartitionedProxy(CachingProxy):
+    """ Cache split in partitions, one per video server or per tenant (a 
+        group of servers), so that a popular server can not evict the videos
+        of the others. Each partition has its own quota and its own cache 
+        and policy.
+
+        With elastic partitions, a full partition borrows the space unused
+        by the others, up to the size of the whole cache, and gives it back
+        when a partition under its quota needs space. The used space of the
+        partitions is counted at each insertion and eviction, so that 
+        finding the partition of a request and its space is O(1).
+
+        The videos sent by the servers do not tell their server: the 
+        partition of a video is the one of its last request.
+
+        .. code-block:: python
+
+            proxy = PartitionedProxy(0, "Proxy")
+            proxy.set_cache_size(64000)
+            proxy.set_partitioning(LRUProxy, default_quota=16000, elastic=True)
+            proxy.add_partition('news', 32000)
+            proxy.set_tenant(1, 'news')
+            proxy.set_tenant(2, 'news')
+    """
+    def __init__(self, *args, **kargs):
+        CachingProxy.__init__(self, *args, **kargs)
+        self.partitions = OrderedDict()
+        """ the partitions, by name, as dict with the cache (a 
+            :class:`CachingProxy`) and the quota
+        """
+        self._policy = LRUProxy
+        self._default_quota = 0
+        self.elastic = False
+        self._tenants = dict()
+        """ name of the partition of each server, by id, the id of the 
+            server by default
+        """
+        self._partition_of = dict()
+        """ partition of each cache key, from the last request, until the 
+            video leaves the cache
+        """
+        self._borrowers = OrderedDict()
+        """ names of the partitions using more than their quota """
+        self._size = 0
+        self._used = 0
+        """ kb of videos in all the partitions """
+        self.partition_stats = dict()
+
+    def set_cache_size(self, size):
+        """ Change the size of the whole cache, which the elastic partitions
+            share
+        """
+        self._size = size
+
+    def set_partitioning(self, policy, default_quota=0, elastic=False):
+        """ 
+            Args:
+                policy (class): :class:`CachingProxy` class of the cache of
+                                the partitions, like LRUProxy
+                default_quota (float): quota of the partitions created for
+                                       the servers without partition, in kb
+                elastic (bool): if the partitions can borrow unused space
+        """
+        self._policy = policy
+        self._default_quota = default_quota
+        self.elastic = elastic
+
+    def add_partition(self, name, quota):
+        """ Adds a partition, of quota kb """
+        with self._cache_lock:
+            cache = self._policy(self._id, "Partition "+str(name))
+            cache.set_cache_size(quota)
+            self.partitions[name] = {'cache': cache, 'quota': quota}
+            self.partition_stats[name] = dict.fromkeys(['requests', 'hits', 'hit_kb'], 0)
+            return self.partitions[name]
+
+    def set_tenant(self, id_server, name):
+        """ Puts the videos of a server in the partition name """
+        self._tenants[id_server] = name
+
+    def _partition_for(self, payload, remember=True):
+        """ The partition of a request, created if needed. Remembers the 
+            partition of its video, for its insertion, if remember is True.
+        """
+        name = self._tenants.get(payload['idServer'], payload['idServer'])
+        partition = self.partitions.get(name)
+        if partition is None:
+            partition = self.add_partition(name, self._default_quota)
+        if remember:
+            self._partition_of[self._cache_key(payload)] = name
+        return name, partition
+
+    def _forget_partition(self, videos):
+        """ The videos left the cache, their partition is not needed """
+        for video in videos:
+            self._partition_of.pop(self._cache_key(video), None)
+
+    def _cache_admission(self, video):
+        """ Each partition decides """
+        return True
+
+    def _id_to_evict(self):
+        """ Not used, each partition evicts """
+        return None
+
+    def _new_video_inserted(self, video):
+        pass
+
+    def _video_served(self, video):
+        pass
+
+    def cache_lookup(self, payload):
+        """ Returns the video of the cache for a request, or None """
+        with self._cache_lock:
+            name, partition = self._partition_for(payload)
+            video = partition['cache'].cache_lookup(payload)
+            stats = self.partition_stats[name]
+            stats['requests'] += 1
+            if video is not None:
+                stats['hits'] += 1
+                stats['hit_kb'] += video['size']
+            return video
+
+    def cache_has(self, payload):
+        with self._cache_lock:
+            return self._partition_for(payload, False)[1]['cache'].cache_has(payload)
+
+    def cache_store(self, video, evicted=None):
+        """ Caches a video in its partition, see 
+            :func:`CachingProxy.cache_store`
+        """
+        with self._cache_lock:
+            name = self._partition_of.get(self._cache_key(video))
+            if name is None:
+                return False
+            cache = self.partitions[name]['cache']
+            if cache.cache_has(video):
+                return False
+            removed = []
+            if self.elastic:
+                self._make_room(name, video['size'], removed)
+            used = cache.cache_used()
+            stored = cache.cache_store(video, removed)
+            self._used += cache.cache_used() - used
+            self._forget_partition(removed)
+            if evicted is not None:
+                evicted.extend(removed)
+            if not stored:
+                # not cached, its partition is not needed
+                self._forget_partition([video])
+        if stored:
+            self._cache_changed = True
+        return stored
+
+    def _make_room(self, name, size, evicted):
+        """ Before an insertion in an elastic partition: takes back the 
+            space borrowed by the others if the cache is full and the 
+            partition is under its quota, then borrows the free space if
+            the partition is full.
+        """
+        partition = self.partitions[name]
+        cache = partition['cache']
+        used = cache.cache_used()
+        while self._borrowers and self._used + size >= self._size and \
+              used + size < partition['quota']:
+            self._give_back(next(iter(self._borrowers)), evicted)
+        free = self._size - self._used
+        if used + size >= partition['quota'] and size < free:
+            # 1 because a cache is full when it reaches its size
+            cache.set_cache_size(used + size + 1)
+            self._borrowers[name] = True
+        elif name not in self._borrowers:
+            cache.set_cache_size(partition['quota'])
+
+    def _give_back(self, name, evicted):
+        """ Shrinks a borrowing partition to its quota """
+        del self._borrowers[name]
+        cache = self.partitions[name]['cache']
+        used = cache.cache_used()
+        cache.set_cache_size(self.partitions[name]['quota'])
+        cache.cache_trim(evicted)
+        self._used += cache.cache_used() - used
+
+    def cache_discard(self, video):
+        """ Removes a video from its partition """
+        with self._cache_lock:
+            name = self._partition_of.get(self._cache_key(video))
+            if name is None:
+                return
+            cache = self.partitions[name]['cache']
+            used = cache.cache_used()
+            cache.cache_discard(video)
+            self._used += cache.cache_used() - used
+            self._forget_partition([video])
+        self._cache_changed = True
+
+    def _discard_video(self, video):
+        self.cache_discard(video)
+
+    def cache_keys(self):
+        """ Returns the keys of the videos in all the partitions """
+        with self._cache_lock:
+            return [key for partition in self.partitions.values() 
+                    for key in partition['cache'].cache_keys()]
+
+    def cache_used(self):
+        return self._used
+
+    def reset_partition_stats(self):
+        """ Sets the counters of the partitions back to zero """
+        with self._cache_lock:
+            self.partition_stats = {name: dict.fromkeys(['requests', 'hits', 'hit_kb'], 0)
+                                    for name in self.partitions}
+
+    def get_partition_stats(self):
+        """
+            Returns:
+                A list of dictionnaries, one per partition, with the fields:
+
+                - partition: the name of the partition
+                - quota (float): its quota, in kb
+                - used (float): kb of videos in it
+                - borrowed (float): kb used above its quota
+                - requests (int): requests of its videos
+                - hits (int): of those, served from the cache
+                - hit_ratio (float): hits/requests
+                - hit_kb (float): kb served from the cache
+        """
+        rows = []
+        with self._cache_lock:
+            for name, partition in self.partitions.items():
+                stats = self.partition_stats[name]
+                used = partition['cache'].cache_used()
+                rows.append({'partition': name, 'quota': partition['quota'],
+                             'used': used, 
+                             'borrowed': max(0, used - partition['quota']),
+                             'requests': stats['requests'], 'hits': stats['hits'],
+                             'hit_ratio': stats['hits']/stats['requests'] if stats['requests'] else 0,
+                             'hit_kb': stats['hit_kb']})
+        return rows
 
 
 class FIFOProxyOld(ForwardProxy, ProxyHitCounter, CachingInterface):
@@ -1009,8 +2941,8 @@ class FIFOProxyOld(ForwardProxy, ProxyHitCounter, CachingInterface):
 
     def _process_video_request(self, data):
         pld = data['payload']
-        if pld['idVideo'] in self.__cachedb:
-            video = self.__cachedb[pld['idVideo']]
+        if self._cache_key(pld) in self.__cachedb:
+            video = self.__cachedb[self._cache_key(pld)]
             # for the metric
             self._from_cache(size_kb=video['size'])
 
@@ -1018,17 +2950,17 @@ class FIFOProxyOld(ForwardProxy, ProxyHitCounter, CachingInterface):
                                        'video', data['packetId'])
             self.connection[data['sender']].send(new_data)
         else:
-            forward_data = self._pack_forward_request(data)
-            self.connection[data['payload']['idServer']].send(forward_data, 
-                                                              'forwardchunk')
+            self._forward_request(data)
 
     def _process_response_to(self, data):
         response_to = data['responseTo']
         req_info = self._get_req_info(response_to)
+        if req_info is None:
+            return
 
         pld = data['payload']
         # cache the video, if it's smaller than the cache size
-        if pld['idVideo'] not in self.__cachedb and\
+        if self._cache_key(pld) not in self.__cachedb and\
            pld['size'] < self.__cache_max_size:
             # for the metric
             self._from_server(size_kb=pld['size'])
@@ -1037,6 +2969,8 @@ class FIFOProxyOld(ForwardProxy, ProxyHitCounter, CachingInterface):
             self._insert_new_video(pld)
 
         new_data = self._pack_forward_response(data)
+        if new_data is None:
+            return
 
         self.connection[req_info['origSender']].send(new_data, 'forwardchunk')
 
@@ -1057,9 +2991,9 @@ class FIFOProxyOld(ForwardProxy, ProxyHitCounter, CachingInterface):
 
     def _insert_new_video(self, video):
         """ inserts a new video, updates the cache size and fifo queue """
-        self.__cachedb[video['idVideo']] = video
+        self.__cachedb[self._cache_key(video)] = video
         self.__cache_size += video['size']
-        self.__cache_fifo.append(video['idVideo'])
+        self.__cache_fifo.append(self._cache_key(video))
 
 class UnlimitedProxy(ForwardProxy):
     """ Proxy caching everything, without a size limit, thus can not inherit
@@ -1068,39 +3002,50 @@ class UnlimitedProxy(ForwardProxy):
     """
 
     def __init__(self, *args, **kargs):
-        AbstractProxy.__init__(self, *args, **kargs)
-        self.active_requests = dict()
+        ForwardProxy.__init__(self, *args, **kargs)
         self.__cachedb = dict()
 
     def _process_video_request(self, data):
         pld = data['payload']
-        if pld['idVideo'] in self.__cachedb:
-            video = self.__cachedb[pld['idVideo']]
+        if self._cache_key(pld) in self.__cachedb:
+            video = self.__cachedb[self._cache_key(pld)]
             new_data = self._pack_data(video, video['size'], 
                                        'video', data['packetId'])
             self.connection[data['sender']].send(new_data)
         else:
-            forward_data = self._pack_forward_request(data)
-            self.connection[data['payload']['idServer']].send(forward_data, 
-                                                              'forwardchunk')
+            self._forward_request(data)
 
     def _process_response_to(self, data):
         response_to = data['responseTo']
-        req_info = self.active_requests[response_to]
+        req_info = self._get_req_info(response_to)
+        if req_info is None:
+            return
 
         pld = data['payload']
         # cache the video, unconditionally
-        if pld['idVideo'] not in self.__cachedb:
-            self.__cachedb[pld['idVideo']] = pld
+        if self._cache_key(pld) not in self.__cachedb:
+            self.__cachedb[self._cache_key(pld)] = pld
 
         new_data = self._pack_forward_response(data)
+        if new_data is None:
+            return
 
         self.connection[req_info['origSender']].send(new_data, 'forwardchunk')
 
-class VideoServer(Peer):
+class VideoServer(Peer, ServerLoadCounter):
     """ Simulation of the video server, can store 'videos' 
         and give them through the connection 
 
+        By default, every request is answered at once and the only limit is
+        the bandwidth of the connection. With :func:`set_capacity`, the 
+        server serves a limited number of requests at the same time, the 
+        others wait in a queue, and each request takes some processing time
+        before its response is sent.
+
+        A video can have several renditions (see :func:`add_video`). The 
+        requests with a segment number and a rendition (from the clients 
+        with an ABR algorithm) are answered with this segment only, cut 
+        every segment_duration seconds of video.
 
         Args:
             args (list): will be forwarded to :class:`Peer` 
@@ -1110,8 +3055,99 @@ class VideoServer(Peer):
 
     def __init__(self, *args, **kargs):
         Peer.__init__(self, *args, **kargs)
+        ServerLoadCounter.__init__(self)
         self.__db = dict()
         self.__cur_id = 0
+        self.max_concurrency = 0
+        """ number of requests served at the same time, 0 for no limit """
+        self.service_time = 0
+        """ processing time of a request before sending the response, in s """
+        self.segment_duration = 4
+        """ duration of the segments of the videos, in seconds """
+        self.__waiting = deque()
+        """ requests waiting to be served, with their time of arrival """
+        self.__nb_active = 0
+        self.__sending = dict()
+        """ kb dropped of the responses being sent, by packetId of the 
+            request
+        """
+        self.__cancelled = set()
+        """ packetId of the requests cancelled before their response """
+        self.__connections = dict()
+        """ connections to the peers sending requests (proxies or clients), 
+            by ID
+        """
+        self.__lock = threading.Lock()
+
+    def connect_to(self, peer, connection=None):
+        """ Connects to a peer, a server can be connected to several proxies 
+            and replies to each request through the connection to its sender.
+        """
+        connection = Peer.connect_to(self, peer, connection)
+        self.__connections[peer.get_id()] = connection
+        return connection
+
+    def _connection_to(self, id_peer):
+        """ Returns the connection to a peer, the last one created if the 
+            peer is unknown
+        """
+        return self.__connections.get(id_peer, self.connection)
+
+    def set_capacity(self, max_concurrency=0, service_time=0):
+        """ Set the limits of the server
+
+            Args:
+                max_concurrency (int): number of requests served at the same
+                                       time (until the last chunk of the 
+                                       response is sent), 0 for no limit
+                service_time (float): time to process a request before 
+                                      sending the response, in seconds
+        """
+        self.max_concurrency = max_concurrency
+        self.service_time = service_time
+
+    def set_segment_duration(self, duration):
+        """ Set the duration of the segments served to the ABR clients, in 
+            seconds. 0 to serve the whole rendition as one segment.
+        """
+        self.segment_duration = duration
+
+    def _segment(self, video, rendition, segment):
+        """ Builds the payload of a segment of a rendition of a video
+
+            Args:
+                video (dict): the video in the database
+                rendition (int): index of the rendition, by ascending bitrate
+                segment (int): number of the segment, from 0
+
+            Returns:
+                a dict like the videos, with the size and duration of the 
+                segment, plus the rendition, segment, nbSegments and 
+                renditions (the list of the bitrates) keys
+        """
+        renditions = video.get('renditions') or [video]
+        rendition = min(rendition, len(renditions)-1)
+        chosen = renditions[rendition]
+        duration = video['duration']
+        nb_segments = 1
+        if self.segment_duration > 0 and duration > 0:
+            nb_segments = max(1, int(np.ceil(duration/self.segment_duration)))
+        if nb_segments > 1:
+            seg_duration = min(self.segment_duration, duration-segment*self.segment_duration)
+            size = chosen['size']*seg_duration/duration
+        else:
+            seg_duration = duration
+            size = chosen['size']
+        return {'idVideo': video['idVideo'], 
+                'duration': seg_duration, 
+                'size': size, 
+                'bitrate': chosen['bitrate'], 
+                'title': video['title'], 
+                'description': video['description'],
+                'rendition': rendition,
+                'segment': segment,
+                'nbSegments': nb_segments,
+                'renditions': [r['bitrate'] for r in renditions]}
 
     def received_callback(self, data):
         """ Received Data, should be video of type 'videoRequest'
@@ -1120,14 +3156,78 @@ class VideoServer(Peer):
                 data (dict): data received
         """
         if data['plType'] is 'videoRequest':
-            req = data['payload']
-            #response = {'idVideo': req['idVideo'], 'duration': 60, 'size': 2048, 'bitrate': 2048/60}
-            #resp_data = {'sender': self.id, 'payload': response, 'plSize': response['size'], 'plType': 'video'}
-            response = self.__db[req['idVideo']]
-            resp_data = self._pack_data(response, response['size'], 
-                                        'video', data['packetId'])
-            self.connection.send(resp_data)
-        req = data['payload']
+            arrival = simu.time_()
+            with self.__lock:
+                if self.max_concurrency and self.__nb_active >= self.max_concurrency:
+                    self.__waiting.append((data, arrival))
+                    self._request_received(len(self.__waiting), self.__nb_active)
+                    return
+                self.__nb_active += 1
+                self._request_received(len(self.__waiting), self.__nb_active)
+            self.__serve(data, arrival)
+        elif data['plType'] is 'cancel':
+            self.__cancel(data['sender'], data['payload']['packetId'])
+
+    def __cancel(self, sender, packet_id):
+        """ Stops sending the response to a request, or does not send it if
+            it is waiting.
+        """
+        with self.__lock:
+            if packet_id in self.__sending:
+                self._connection_to(sender).cancel(packet_id)
+            else:
+                self.__cancelled.add(packet_id)
+
+    def __serve(self, data, arrival):
+        if self.service_time:
+            simu.timers.call_later(self.service_time, self.__send_response, data, arrival)
+        else:
+            self.__send_response(data, arrival)
+
+    def __send_response(self, data, arrival):
+        packet_id = data['packetId']
+        pld = data['payload']
+        response = self.__db[pld['idVideo']]
+        if 'segment' in pld:
+            response = self._segment(response, pld['rendition'], pld['segment'])
+        resp_data = self._pack_data(response, response['size'], 
+                                    'video', packet_id)
+        with self.__lock:
+            if packet_id in self.__cancelled:
+                self.__cancelled.remove(packet_id)
+                cancelled = True
+            else:
+                cancelled = False
+                self.__sending[packet_id] = 0
+                self._connection_to(data['sender']).send(resp_data, 
+                    callback=lambda: self.__response_done(packet_id, response['size'], arrival),
+                    dropped=lambda size: self.__dropped(packet_id, size))
+        if cancelled:
+            self.__response_done(packet_id, None, arrival)
+
+    def __dropped(self, packet_id, size):
+        """ size kb of the response to packet_id were not sent """
+        with self.__lock:
+            self.__sending[packet_id] += size
+
+    def __response_done(self, packet_id, size, arrival):
+        """ The last chunk was sent (or dropped), the next request waiting 
+            can be served 
+        """
+        with self.__lock:
+            dropped = self.__sending.pop(packet_id, 0)
+        if size is not None:
+            self._response_sent(size-dropped, simu.time_() - arrival)
+        with self.__lock:
+            if not self.__waiting:
+                self.__nb_active -= 1
+                return
+            data, arrival = self.__waiting.popleft()
+        self.__serve(data, arrival)
+
+    def get_video(self, id_video):
+        """ Returns the video of the database with this id """
+        return self.__db[id_video]
 
     def add_video(self, duration=0, size=0, bitrate=0, title='', 
                   description='', id_=None, video=None):
@@ -1144,6 +3244,9 @@ class VideoServer(Peer):
             Dictionnary entry like this:
                 {'idVideo': 1, 'duration': 13, 'size': 1245, 'bitrate': 96, 
                  'title': "Video", 'description': "Best video"}
+            with optionally a 'renditions' key, the list of the renditions 
+            of the video sorted by bitrate, each like {'size': 1245, 
+            'bitrate': 96}
         Returns:
             Nothing
 
@@ -22,30 +22,163 @@ import datetime
 from model import *
 import simu
 import metrics
+import resultcache
+import traces
+import profiles
+import topology
+import cluster
+import p2p
+import prefetch
+import abr
+
+import numpy as np
 
 import cProfile
 import re
 
 import threading
 
-# this will time how long it takes to start playing a video along with how many times
-# the video stopped during playback.
-@TwoMethodsTimerAndCounter('request_media', 'start_playback', '_video_stopped', 0, 'id_media')
 class MetricClient(Client):
-    pass
+    """ A client timing how long it takes to start playing each video, 
+        and counting how many times the videos stopped during playback, see
+        :class:`metrics.ClientMetrics`
+    """
+
+    def __init__(self, *args, **kargs):
+        Client.__init__(self, *args, **kargs)
+        self.metrics = metrics.ClientMetrics()
+        self.add_observer(self.metrics)
+
+    @property
+    def latencies(self):
+        """ startup latencies of the videos, in seconds """
+        return self.metrics.latencies.tolist()
+
+    @property
+    def counter(self):
+        """ number of times the videos stopped """
+        return self.metrics.stalls
+
+    def reset_metrics(self):
+        """ Forgets the latencies and the stops, for instance at the end
+            of a warm-up period
+        """
+        self.metrics.reset()
 
 class Orchestrator:
     """ Orchestrating the simulation """
     DEF_PRIO = 1
+    HIT_KEYS = ['hit_ratio', 'byte_hit_ratio', 'cache_hits', 'nb_served', 
+                'byte_cache', 'byte_served', 'upstream_kb']
+    """ columns of the statistics of the proxies of a topology or cluster """
+    SIBLING_KEYS = ['sibling_requests', 'sibling_hits', 'false_positives', 
+                    'false_positive_time', 'sibling_kb', 'sibling_served_kb', 
+                    'digest_kb']
+    """ columns added when the proxies cooperate with their siblings """
     def __init__(self, speed=1, method=None, conf={}):
         self._speed = speed
         self._clients_req = dict()
-        self._clients = dict()
+        self._clients = []
+        """ the clients, indexed by their dense id (see :mod:`traces`). None
+            until the first request of the client, and again once the client
+            is parked (see :func:`_park_if_idle`).
+        """
+        self._client_metrics = []
+        """ metrics of the parked clients, as [latencies, counter, 
+            delivered_kb, delivered_seconds, nb_switches, local_hits, 
+            local_hit_kb], indexed by dense id
+        """
+        self._local_caches = dict()
+        """ the local caches of the clients (see 
+            :func:`model.Client.set_local_cache`), by dense id, kept while 
+            the clients are parked
+        """
+        self.output_files = []
+        """ paths of the files written by the last call to 
+            :func:`gather_statistics`
+        """
+        self._clients_lock = threading.RLock()
+        """ the clients are created by the requests and parked by the timers """
+        self._last_request = dict()
+        """ time of the last request of the clients being simulated """
+        self._idle_timers = dict()
+        """ pending timers of :func:`_park_if_idle`, by dense id """
+        self._pool = ConnectionPool()
+        """ connections of the parked clients, reused by the new ones """
+        clients_conf = conf.get('clients', {})
+        self._tracker = None
+        """ :class:`p2p.Tracker` of the clients uploading to each other, 
+            None without peer-assisted delivery
+        """
+        if clients_conf.get('p2p'):
+            self._tracker = p2p.Tracker(clients_conf.get('p2p_lag', 0.05),
+                                        clients_conf.get('max_chunk', 16), self._pool)
+        self._p2p_parked = collec.Counter()
+        """ peer-assisted delivery statistics of the parked clients, see
+            :func:`model.Client.reset_p2p_stats`
+        """
+        self._p2p_startups = []
+        proxy_conf = conf.get('proxy', {})
+        self._prefetcher = None
+        """ :class:`prefetch.Prefetcher` of the popular videos, None 
+            without prefetching
+        """
+        if proxy_conf.get('prefetch') and not clients_conf.get('abr'):
+            self._prefetcher = prefetch.Prefetcher(self._prefetch_video,
+                                                   int(proxy_conf.get('prefetch_top_k', 100)),
+                                                   proxy_conf.get('prefetch_half_life', 600),
+                                                   int(proxy_conf.get('prefetch_max_videos', 5)))
+        self.idle_timeout = conf.get('clients', {}).get('idle_timeout', 0)
+        """ seconds of inactivity after which a client is parked, 0 to never
+            park the clients
+        """
+        self.nb_clients_peak = 0
+        """ maximum number of clients simulated at the same time """
+        self._watch_mean = conf.get('clients', {}).get('watch_mean', 0)
+        """ mean part of the videos watched when the trace does not tell, 0
+            to watch the videos entirely
+        """
+        self._watch_rng = np.random.default_rng(int(conf.get('clients', {}).get('watch_seed', 0)))
+        self._profiles = None
+        """ :class:`profiles.LinkProfiles` of the clients """
+        self._client_profile = np.zeros(0, dtype=np.int64)
+        """ index of the profile of each client, by dense id """
+        self._egress = dict()
+        """ :class:`model.SharedLink` of each edge proxy to its clients, by
+            id of the proxy, if limited
+        """
+        self._origin_egress = None
+        """ :class:`model.SharedLink` of the servers to the proxy, if limited """
+        self._nb_live_clients = 0
+        self._client_ids = traces.IdInterner()
+        """ maps the ids of the clients in the trace to dense ids """
+        self._videos = traces.IdInterner()
+        """ maps the (id_server, id_video) pairs to the dense ids used as 
+            idVideo in the whole simulation
+        """
         self._proxy = None
+        """ the proxy, or the first edge proxy of the topology """
+        self._proxies = collec.OrderedDict()
+        """ all the proxies, by id """
+        self._topology = None
+        """ :class:`topology.Topology` of the caches, None for a single proxy """
+        self._client_edge = np.zeros(0, dtype=np.int64)
+        """ index of the edge proxy of each client in the topology, by dense id """
+        self._router = None
+        """ :class:`cluster.ConsistentHashRouter` of the nodes in cluster
+            mode, None otherwise
+        """
+        self._cluster_changes = []
+        """ For the event_lock method, nodes added or removed during the 
+            simulation, as (delay_abs, '+'|'-', name) tuples
+        """
+        self._cluster_keys = None
         self._servers = dict()
         self._scheduler = sched.scheduler(simu.timesched, simu.sleepsched)
-        self._events_queue = queue.Queue()
-        """ For the event_lock method, stores the trace"""
+        self._events = iter(())
+        """ For the event_lock method, iterator over the trace as tuples 
+            (delay_abs, delay, id_client, id_video, id_server)
+        """
         self.skip_inactivity = True
         """ If true, the scheduler will accelerate time when the simu is inactive """
         self._req_event = threading.Event()
@@ -65,12 +198,49 @@ class Orchestrator:
                  'skip_inactivity': True|False,
                  'trace_file': '/path/to/file' (optional when passing args to set_up()),
                  'db_file': '/path/to/file' (optional when passing args to set_up()),
+                 'window_start': float (optional, seconds since the beginning of the trace),
+                 'window_end': float (optional, seconds since the beginning of the trace),
+                 'warmup': float (optional, seconds replayed before window_start without metrics),
+                 'index_step': int (optional, period of the index of the trace, 60 by default),
                 },
              'proxy':
                 {
                  'proxy_type': NameOfTheProxyClass,
                  'cache_size': int (only for proxy inheriting from CachingProxy),
+                 'egress_bandwidth': int (optional, speed in kb/s shared by
+                                     all the connections to the clients),
+                 'egress_interval': float (optional, period of the egress 
+                                    statistics in seconds, 10 by default),
                  'module': modulename (only when using your own proxy in your own module),
+                 'topology_file': '/path/to/file' (optional, edge and parent
+                                  proxies replacing the single proxy, see 
+                                  :mod:`topology`),
+                 'topology_map': '/path/to/file' (optional, edge proxy of 
+                                 some clients),
+                 'siblings': True|False (optional, the proxies of the 
+                             topology with the same parent cooperate, see
+                             :func:`model.CachingProxy.set_siblings`),
+                 'digest_interval': float (optional, seconds between two
+                                    digests sent to the siblings, 60 by 
+                                    default),
+                 'digest_fp_rate': float (optional, false positive rate of
+                                   the digests, 0.01 by default),
+                 'cluster_size': int (optional, number of proxies sharing 
+                                 the videos by consistent hashing, see 
+                                 :mod:`cluster`),
+                 'virtual_nodes': int (optional, positions of each node on
+                                  the ring, 100 by default),
+                 'cluster_changes': '600:+node5,1200:-node1' (optional, 
+                                    nodes added or removed at these delays),
+                 'workers': int (optional, packets processed at the same 
+                            time by a proxy, 0 for no limit),
+                 'request_cost': float (optional, seconds to process a 
+                                 request or a response),
+                 'byte_cost': float (optional, seconds to process a kb of
+                              a response),
+                 'lock_shards': int (optional, number of locks of the 
+                                requests of a caching proxy, 16 by default,
+                                see :mod:`locks`),
                 },
              'clients':
                 {
@@ -80,6 +250,29 @@ class Orchestrator:
                  'lag_down': float (latency in seconds),
                  'max_chunk': int (size in kb),
                  'consume_videos': True|False,
+                 'idle_timeout': float (optional, seconds of inactivity 
+                                 after which a client is parked),
+                 'profiles_file': '/path/to/file' (optional, link profiles,
+                                  see :mod:`profiles`),
+                 'profiles_map': '/path/to/file' (optional, profile of some
+                                 clients),
+                 'abr': name (optional, ABR algorithm of the clients, see
+                        :mod:`abr`, the videos are downloaded whole if not set),
+                 'max_buffer': float (optional, seconds of video buffered by
+                               the ABR clients, 30 by default),
+                 'watch_mean': float (optional, mean part of the videos 
+                               watched when the trace has no watch_duration,
+                               0 to watch them entirely),
+                 'watch_seed': int (optional, seed of the watched parts),
+                 'local_cache': NameOfTheProxyClass (optional, policy of 
+                                the cache of each client, see 
+                                :func:`model.Client.set_local_cache`),
+                 'local_cache_size': int (size of the cache of each 
+                                     client, in kb),
+                 'p2p': bool (optional, the clients upload the videos of
+                        their local cache to each other, see :mod:`p2p`),
+                 'p2p_lag': float (latency between two clients, in s),
+                 'max_uploads': int (uploads of a client at the same time),
                  'metrics': (not used yet),
                 },
              'servers':
@@ -89,92 +282,180 @@ class Orchestrator:
                  'lag_up': float (latency in seconds),
                  'lag_down': float (latency in seconds),
                  'max_chunk': int (size in kb),
+                 'egress_bandwidth': int (optional, speed in kb/s shared by
+                                     all the servers),
+                 'max_concurrency': int (optional, requests served at the 
+                                    same time by a server, 0 for no limit),
+                 'service_time': float (optional, seconds to process a 
+                                 request before sending the response),
+                 'stats_interval': float (optional, period of the load
+                                   statistics in seconds, 10 by default),
+                 'segment_duration': float (optional, duration of the 
+                                     segments served to the ABR clients, 4 
+                                     seconds by default),
                 }
             }
         """
         self._duration = 0
         """ to track the progress of the simulation """
-
-
-    def load_trace(self, file_path='fake_trace.dat'):
-        """ Creates the clients from the trace file """
-        first_tmstp = None
-        #id_clients = set()
-        trace_file = open(file_path, 'r')
-        trace_reader = csv.DictReader(filter(lambda row: row[0]!='#', trace_file))
-        # needed to have a relative delay in case of the event_lock method
-        last_delay = 0
-        #delay = 0
-        for row in trace_reader:
-            # +1000 because clients begin at id 1000
-            id_client = int(row['id_client'])+1000
-            if id_client not in self._clients:
-                self._clients[id_client] = MetricClient(id_client, 'Client '+str(id_client-1000))
-                # to keep the state of the simulation
-                if self.skip_inactivity:
-                    self._clients[id_client].set_func_new_dl(simu.inc_nb_dl)
-                    self._clients[id_client].set_func_end_dl(simu.dec_nb_dl)
-                if self.conf['clients']['consume_videos']:
-                    self._clients[id_client].start_video_consumer()
-            if first_tmstp is None:
-                first_tmstp = float(row['req_timestamp'])
-            #id_clients.add(id_client)
-            #if row['id_client'] not in self._clients_req:
-            #    self._clients_req.[row['id_client']] = []
-            #self._clients_req.[row['id_client']].append()
-            
-            #print(row)
-            
-            delay = float(row['req_timestamp']) - first_tmstp
-
-            if self.method == 'event_lock':
-                """ if we use the event_lock method, we store the trace in a queue"""
-                event = {'delay_abs': delay, 'delay': delay - last_delay, 'id_client': id_client, 'id_video': row['id_video'], 'id_server': int(row['id_server'])}
-                last_delay = delay
-                self._events_queue.put(event)
-                
-            elif self.method == 'scheduler':
-                """ if we use the scheduler method, we enter the requests as events 
-                    in the scheduler
-                """
-                """ adds the events in the scheduler to trigger the requests at the right time """
+        self._missing_videos = set()
+        """ dense ids of the videos requested in the trace but not in the DB """
+        self._warmup_end = None
+        """ delay at which the warm-up ends, if there is one """
+
+
+    def load_trace(self, file_path='fake_trace.dat', start=None, end=None, 
+                   warmup=0, index_step=60):
+        """ Creates the clients from the trace file. The ids of the clients
+            and the (id_server, id_video) pairs are interned into dense ids.
+
+            Args:
+                file_path (str|list): the trace file(s)
+                start (float): to replay only a window of the trace, seconds
+                               since the beginning of the trace
+                end (float): end of the window, seconds since the beginning
+                             of the trace
+                warmup (float): seconds of trace replayed before start to fill
+                                the cache, the metrics are reset at start
+                index_step (int): period of the index used to seek to the 
+                                  window, see :func:`traces.load_index`
+
+            A single plain trace file is parsed and preprocessed in bulk by 
+            :func:`traces.load_trace_arrays`: it is sorted by timestamp and the
+            requests for the same video two times in a row are already removed,
+            so the clients do not need their two_in_a_row_protection.
+            The clients themselves are only created on their first request,
+            see :func:`_request`.
+
+            Several files (a list, a glob pattern or comma separated paths) or
+            compressed files are streamed with :func:`traces.stream_events`
+            instead: a first pass finds the clients and videos, then the 
+            events are merged again on the fly during the simulation.
+        """
+        paths = traces.expand_paths(file_path)
+
+        window = {'index_step': index_step}
+        if start is not None or end is not None:
+            first = traces.trace_start(paths, index_step)
+            window['origin'] = first
+            if start is not None:
+                window['origin'] = first + max(start - warmup, 0)
+                window['start'] = window['origin']
+                if warmup > 0:
+                    self._warmup_end = first + start - window['origin']
+            if end is not None:
+                window['end'] = first + end
+
+        if len(paths) == 1 and not traces.is_compressed(paths[0]):
+            trace = traces.load_trace_arrays(paths[0], self._client_ids, 
+                                             self._videos, **window)
+            events = list(zip(trace['delay'].tolist(), 
+                              trace['delta'].tolist(), 
+                              trace['id_client'].tolist(), 
+                              trace['id_video'].tolist(), 
+                              trace['id_server'].tolist(),
+                              trace['watch_duration'].tolist()))
+            if events:
+                self._duration = events[-1][0]
+        else:
+            print("Scanning "+str(len(paths))+" trace files...")
+            for event in traces.stream_events(paths, self._client_ids, 
+                                              self._videos, **window):
+                self._duration = event[0]
+            events = traces.stream_events(paths, self._client_ids, 
+                                          self._videos, **window)
+
+        for id_client in range(len(self._clients), len(self._client_ids)):
+            self._clients.append(None)
+            self._client_metrics.append([[], 0, 0, 0, 0, 0, 0])
+
+        if self.method == 'event_lock':
+            """ if we use the event_lock method, we store the trace, the
+                relative delay is used to wait between two requests
+            """
+            self._events = iter(events)
+
+        elif self.method == 'scheduler':
+            """ if we use the scheduler method, we enter the requests as events 
+                in the scheduler to trigger the requests at the right time
+            """
+            for delay, delta, id_client, id_video, id_server, watch in events:
                 self._scheduler.enter(delay, 
                                       self.DEF_PRIO, 
-                                      self._clients[id_client].request_media, 
-                                      argument=(row['id_video'], int(row['id_server'])))
-
-        self._duration = delay
+                                      self._request, 
+                                      argument=(id_client, id_video, id_server, watch))
+            if self._warmup_end is not None:
+                # before the requests at the same time
+                self._scheduler.enter(self._warmup_end, 0, self._end_warmup)
         
         print("Duration of the trace: "+str(datetime.timedelta(seconds=self._duration)))
         print("Duration of the simulation (max): "+str(datetime.timedelta(seconds=self._duration/config.speed)))
 
-        trace_file.close()
-
-        #self._create_clients(list(id_clients))
+    def load_video_db(self, file_path='fake_video_db.dat', join=True):
+        """ Creates the video servers from the DBs dump, the idVideo of the 
+            videos are the dense ids of their (id_server, id_video) pair.
 
-        pass
+            Args:
+                file_path (str): path to the database file
+                join (bool): if True, only the videos requested in the trace 
+                             (which must be loaded first) are kept. The 
+                             videos requested but absent from the database are
+                             reported and their requests will be ignored.
 
-    def load_video_db(self, file_path='fake_video_db.dat'):
-        """ Creates the video servers from the DBs dump """ 
+            The rows with the same id_server and id_video are the renditions
+            of the video (same duration, other size and bitrate), the first
+            one is the video served to the clients without ABR algorithm.
+        """
         #id_servers = set()
         db_file = open(file_path, 'r')
-        db_reader = csv.DictReader(filter(lambda row: row[0]!='#', db_file))
+        db_reader = csv.reader(filter(lambda row: row[0]!='#', db_file))
+        header = next(db_reader)
+        col = {name: i for i, name in enumerate(header)}
+        i_server = col['id_server']
+        i_video = col['id_video']
+        nb_rows = 0
+        found = set()
         for row in db_reader:
+            nb_rows += 1
+            id_server = int(row[i_server])
+            # the join: we only check the key before building anything
+            key = (id_server, traces.normalize_id(row[i_video]))
+            if join:
+                id_video = self._videos.get(key)
+                if id_video is None:
+                    continue
+            else:
+                id_video = self._videos.intern(key)
             #id_servers.add(row['id_server'])
-            id_server = int(row['id_server'])
             if id_server not in self._servers:
                 self._servers[id_server] = VideoServer(id_server, 'Server '+str(id_server))
-            video = {'idVideo': row['id_video'], 
-                     'duration': int(row['duration']), 
-                     'size': int(row['size']), 
-                     'bitrate': int(row['bitrate']), 
-                     'title': row['title'], 
-                     'description': row['description']}
+            rendition = {'size': int(row[col['size']]), 
+                         'bitrate': int(row[col['bitrate']])}
+            if id_video in found:
+                renditions = self._servers[id_server].get_video(id_video)['renditions']
+                renditions.append(rendition)
+                renditions.sort(key=lambda r: r['bitrate'])
+                continue
+            found.add(id_video)
+            video = {'idVideo': id_video, 
+                     'duration': int(row[col['duration']]), 
+                     'size': int(row[col['size']]), 
+                     'bitrate': int(row[col['bitrate']]), 
+                     'title': row[col['title']], 
+                     'description': row[col['description']],
+                     'renditions': [rendition]}
 
             self._servers[id_server].add_video(video=video)
             #print(row)
         db_file.close()
-        pass
+
+        self._missing_videos = set(range(len(self._videos))) - found
+
+        print("Videos loaded: "+str(len(found))+" out of "+str(nb_rows)+" in the database")
+        if self._missing_videos:
+            print(str(len(self._missing_videos))+" videos of the trace are not in the database, their requests will be ignored:")
+            for id_video in sorted(self._missing_videos)[:10]:
+                print("    (id_server, id_video) = "+str(self._videos.key(id_video)))
 
     def set_up(self, trace_path=None, db_path=None):
         """ sets things up """
@@ -188,22 +469,332 @@ class Orchestrator:
 
         print(trace_path)
 
-        self.load_trace(trace_path)
+        conf = self.conf['orchestration']
+        self.load_trace(trace_path, 
+                        conf.get('window_start'), 
+                        conf.get('window_end'), 
+                        conf.get('warmup', 0), 
+                        int(conf.get('index_step', 60)))
         self.load_video_db(db_path)
+        self._configure_servers()
+        self.load_profiles(self.conf['clients'].get('profiles_file'),
+                           self.conf['clients'].get('profiles_map'))
+
+        if self.conf['proxy'].get('cluster_size', 0) > 1:
+            self.load_cluster(int(self.conf['proxy']['cluster_size']),
+                              int(self.conf['proxy'].get('virtual_nodes', 100)),
+                              self.conf['proxy'].get('cluster_changes'))
+        else:
+            self.load_topology(self.conf['proxy'].get('topology_file'),
+                               self.conf['proxy'].get('topology_map'))
+        self._configure_proxies()
+
+        interval = self.conf['proxy'].get('egress_interval', 10)
+        if self.conf['proxy'].get('egress_bandwidth'):
+            for proxy in self._edge_proxies():
+                self._egress[proxy.get_id()] = SharedLink(self.conf['proxy']['egress_bandwidth'], interval)
+        if self.conf['servers'].get('egress_bandwidth'):
+            self._origin_egress = SharedLink(self.conf['servers']['egress_bandwidth'], interval)
+
+        self._connect_network()
+
+    def load_topology(self, file_path=None, map_path=None):
+        """ Creates the proxies: a single one, with the id 0, from the 
+            [proxy] section, or those of a topology of caches (with their 
+            name as id), in which case the edge proxy of each client of the
+            trace (which must be loaded first) is computed.
 
+            Args:
+                file_path (str): CSV file of the topology, see :mod:`topology`
+                map_path (str): CSV file giving the edge proxy of some clients
+        """
+        self._proxies = collec.OrderedDict()
+        if file_path is None:
+            self._topology = None
+            self._proxy = self._get_proxy_class()(0, "Proxy")
+            self._configure_cache(self._proxy, self.conf['proxy']['cache_size'])
+            self._proxies[0] = self._proxy
+            return
+
+        self._topology = topology.Topology()
+        self._topology.load(file_path)
+        for name in self._topology.names:
+            desc = self._topology[name]
+            proxy = self._get_proxy_class(desc['proxy_type'])(name, "Proxy "+name)
+            self._configure_cache(proxy, desc['cache_size'])
+            if desc['parent'] is not None:
+                if not hasattr(proxy, 'set_parent'):
+                    raise ValueError(desc['proxy_type']+" can not forward to a parent proxy")
+                proxy.set_parent(desc['parent'])
+            self._proxies[name] = proxy
+        edges = self._topology.edges
+        self._proxy = self._proxies[edges[0]]
+        self._client_edge = self._topology.assign(self._client_ids.keys, map_path)
+        counts = np.bincount(self._client_edge, minlength=len(edges))
+        print("Clients per edge proxy: "+", ".join(name+": "+str(count) 
+              for name, count in zip(edges, counts.tolist())))
+
+    def _configure_cache(self, proxy, cache_size):
+        """ Sets the size of the cache of a proxy. A :class:`model.TieredProxy`
+            first gets a RAM and a disk tier, from the ram_* and disk_* 
+            options of the [proxy] section, the size of the disk being 
+            cache_size. A :class:`model.PartitionedProxy` first gets a 
+            partition per server or tenant, see :func:`_configure_partitions`.
+        """
+        if hasattr(proxy, 'add_tier'):
+            conf = self.conf['proxy']
+            for tier in ('ram', 'disk'):
+                cache = self._get_proxy_class(conf.get(tier+'_type', 'LRUProxy'))(
+                    proxy.get_id(), tier+" of "+proxy.name)
+                cache.set_cache_size(conf.get(tier+'_size', 0))
+                proxy.add_tier(tier, cache, conf.get(tier+'_latency', 0),
+                               conf.get(tier+'_bandwidth', 0))
+        if hasattr(proxy, 'add_partition'):
+            self._configure_partitions(proxy, cache_size)
+        if(isinstance(proxy, CachingInterface)):
+            proxy.set_cache_size(cache_size)
+
+    def _configure_partitions(self, proxy, cache_size):
+        """ Creates the partitions of a proxy from the partition_* options 
+            of the [proxy] section:
+
+            - partition_tenants: the servers sharing a partition, like
+              '1:news,2:news', the other servers having their own
+            - partition_quotas: the part of the cache of some partitions, by
+              tenant or server id, like 'news:0.5,3:0.25'. The other 
+              partitions share the rest equally.
+            - partition_policy: the class of the caches of the partitions
+            - partition_elastic: if the partitions can borrow unused space
+        """
+        conf = self.conf['proxy']
+        tenants = dict()
+        for item in conf.get('partition_tenants', '').split(','):
+            if item.strip():
+                id_server, name = item.split(':')
+                tenants[int(id_server)] = name.strip()
+        quotas = collec.OrderedDict()
+        for item in conf.get('partition_quotas', '').split(','):
+            if item.strip():
+                name, share = item.split(':')
+                name = name.strip()
+                quotas[int(name) if name.isdigit() else name] = float(share)*cache_size
+        others = []
+        for id_server in self._servers:
+            name = tenants.get(id_server, id_server)
+            if name not in quotas and name not in others:
+                others.append(name)
+        rest = max(0, cache_size - sum(quotas.values()))
+        default_quota = rest/len(others) if others else rest
+        proxy.set_partitioning(self._get_proxy_class(conf.get('partition_policy', 'LRUProxy')),
+                               default_quota, conf.get('partition_elastic', False))
+        for id_server, name in tenants.items():
+            proxy.set_tenant(id_server, name)
+        for name, quota in quotas.items():
+            proxy.add_partition(name, quota)
+        for name in others:
+            proxy.add_partition(name, default_quota)
+
+    def load_cluster(self, nb_nodes, virtual_nodes=100, changes=None):
+        """ Creates the nodes of a cluster of proxies, node1 to nodeN, of 
+            the class and cache size of the [proxy] section. The clients are
+            connected to all of them and route each request by consistent
+            hashing, see :mod:`cluster`.
+
+            Args:
+                nb_nodes (int): number of nodes at the beginning
+                virtual_nodes (int): positions of each node on the ring
+                changes (str): nodes added or removed during the simulation,
+                               like '600:+node5,1200:-node1' with the delays
+                               in seconds since the beginning of the replay.
+                               The added nodes are created and connected at
+                               the beginning, but get no request before.
+        """
+        self._topology = None
+        self._proxies = collec.OrderedDict()
+        self._router = cluster.ConsistentHashRouter(virtual_nodes)
+        names = ['node'+str(i+1) for i in range(nb_nodes)]
+        self._cluster_changes = []
+        for change in (changes or '').split(','):
+            if not change.strip():
+                continue
+            delay, node = change.split(':')
+            node = node.strip()
+            if node[0] not in '+-':
+                raise ValueError("Cluster change without + or -: "+change)
+            self._cluster_changes.append((float(delay), node[0], node[1:]))
+            if node[1:] not in names:
+                names.append(node[1:])
+        self._cluster_changes.sort()
+
+        ClassProxy = self._get_proxy_class()
+        for name in names:
+            proxy = ClassProxy(name, "Proxy "+name)
+            self._configure_cache(proxy, self.conf['proxy']['cache_size'])
+            self._proxies[name] = proxy
+        for name in names[:nb_nodes]:
+            self._router.add_node(name)
+        self._proxy = self._proxies[names[0]]
+
+        if self.method == 'scheduler':
+            for delay, sign, name in self._cluster_changes:
+                # before the requests at the same time
+                self._scheduler.enter(delay, 0, self._change_cluster, 
+                                      argument=(delay, sign, name))
+            self._cluster_changes = []
+
+    def _change_cluster(self, delay, sign, name):
+        """ Adds (sign '+') or removes (sign '-') a node of the cluster,
+            and records the videos moved to another node.
+        """
+        if self._cluster_keys is None:
+            keys = []
+            sizes = []
+            for id_video in range(len(self._videos)):
+                if id_video in self._missing_videos:
+                    continue
+                id_server = self._videos.key(id_video)[0]
+                keys.append((id_server, id_video))
+                sizes.append(self._servers[id_server].get_video(id_video)['size'])
+            self._cluster_keys = (keys, sizes)
+        if sign == '+':
+            change = self._router.add_node(name, *self._cluster_keys, time=delay)
+        else:
+            change = self._router.remove_node(name, *self._cluster_keys, time=delay)
+        print("Cluster change "+change['change']+": "+str(change['nb_nodes'])+
+              " nodes, "+str(change['moved_keys'])+" videos moved")
+
+    def _edge_proxies(self):
+        """ The proxies the clients are connected to """
+        if self._topology is not None:
+            return [self._proxies[name] for name in self._topology.edges]
+        if self._router is not None:
+            return list(self._proxies.values())
+        return [self._proxy]
+
+    def _root_proxies(self):
+        """ The proxies connected to the video servers """
+        if self._topology is not None:
+            return [self._proxies[name] for name in self._topology.roots]
+        if self._router is not None:
+            return list(self._proxies.values())
+        return [self._proxy]
+
+    def _edge_of(self, id_client):
+        """ The proxy a client is connected to, from its dense id """
+        if self._topology is None:
+            return self._proxy
+        return self._proxies[self._topology.edges[self._client_edge[id_client]]]
+
+    def _client_proxies(self, id_client):
+        """ The proxies a client is connected to: its edge proxy, or all 
+            the nodes of the cluster
+        """
+        if self._router is not None:
+            return list(self._proxies.values())
+        return [self._edge_of(id_client)]
+
+    def load_profiles(self, file_path=None, map_path=None):
+        """ Computes the link profile of each client of the trace (which 
+            must be loaded first). The first profile, 'default', is the 
+            one of the [clients] section.
+
+            Args:
+                file_path (str): CSV file of the profiles, see :mod:`profiles`
+                map_path (str): CSV file giving the profile of some clients
+        """
+        conf = self.conf['clients']
+        self._profiles = profiles.LinkProfiles()
+        self._profiles.add('default', conf['up'], conf['down'], 
+                           conf['lag_down'], conf['max_chunk'])
+        if file_path:
+            self._profiles.load(file_path)
+        self._client_profile = self._profiles.assign(self._client_ids.keys, map_path)
+        counts = np.bincount(self._client_profile, minlength=len(self._profiles))
+        print("Clients per profile: "+", ".join(name+": "+str(count) 
+              for name, count in zip(self._profiles.names, counts.tolist())))
+
+    def _configure_proxies(self):
+        """ Sets the processing limits of the proxies from the 
+            configuration, see :func:`model.AbstractProxy.set_processing`, 
+            and the number of locks of the caching proxies
+        """
+        conf = self.conf['proxy']
+        for proxy in self._proxies.values():
+            if hasattr(proxy, 'set_processing'):
+                proxy.set_processing(int(conf.get('workers', 0)), 
+                                     conf.get('request_cost', 0), 
+                                     conf.get('byte_cost', 0))
+            if hasattr(proxy, 'set_lock_shards'):
+                proxy.set_lock_shards(int(conf.get('lock_shards', 16)))
+
+    def _configure_servers(self):
+        """ Sets the capacity of the video servers from the configuration """
+        conf = self.conf['servers']
+        for server in self._servers.values():
+            server.set_capacity(int(conf.get('max_concurrency', 0)), 
+                                conf.get('service_time', 0))
+            server.set_load_interval(conf.get('stats_interval', 10))
+            server.set_segment_duration(conf.get('segment_duration', 4))
+
+    def _get_proxy_class(self, proxy_type=None):
+        """ Loads the class of the proxy given in the configuration, or 
+            called proxy_type, from the model module or from the module 
+            given in the configuration.
+        """
         module_name = 'model'
         if 'module' in self.conf['proxy']:
             module_name = self.conf['proxy']['module']
 
         module = __import__(module_name)
-        ClassProxy = getattr(module, self.conf['proxy']['proxy_type'])
-
-        self._proxy = ClassProxy(0, "Proxy")
+        return getattr(module, proxy_type or self.conf['proxy']['proxy_type'])
 
-        if(isinstance(self._proxy, CachingInterface)):
-            self._proxy.set_cache_size(self.conf['proxy']['cache_size'])
+    def _get_proxy_classes(self):
+        """ The classes of all the proxies, the one of the configuration 
+            or those of the topology
+        """
+        file_path = self.conf['proxy'].get('topology_file')
+        if file_path is None:
+            classes = [self._get_proxy_class()]
+        else:
+            topo = topology.Topology()
+            topo.load(file_path)
+            proxy_types = sorted(set(topo[name]['proxy_type'] for name in topo.names))
+            classes = [self._get_proxy_class(proxy_type) for proxy_type in proxy_types]
+        if any(hasattr(class_, 'add_tier') for class_ in classes):
+            # the policies of the tiers
+            classes += [self._get_proxy_class(self.conf['proxy'].get(tier+'_type', 'LRUProxy'))
+                        for tier in ('ram', 'disk')]
+        if any(hasattr(class_, 'add_partition') for class_ in classes):
+            classes.append(self._get_proxy_class(self.conf['proxy'].get('partition_policy', 'LRUProxy')))
+        return classes
+
+    def fingerprint(self, trace_path=None, db_path=None):
+        """ Computes the key identifying the result of this simulation, see
+            :mod:`resultcache`. Two simulations with the same fingerprint 
+            should give the same statistics.
+        """
+        trace_path = trace_path or self.conf['orchestration']['trace_file']
+        db_path = db_path or self.conf['orchestration']['db_file']
 
-        self._connect_network()
+        input_files = [self.conf['clients'][option] 
+                       for option in ('profiles_file', 'profiles_map') 
+                       if self.conf['clients'].get(option)]
+        input_files += [self.conf['proxy'][option] 
+                        for option in ('topology_file', 'topology_map') 
+                        if self.conf['proxy'].get(option)]
+        if self.conf['clients'].get('profiles_file'):
+            link_profiles = profiles.LinkProfiles()
+            link_profiles.load(self.conf['clients']['profiles_file'])
+            input_files += link_profiles.input_files()
+
+        return resultcache.fingerprint(traces.expand_paths(trace_path), 
+                                       db_path, self.conf,
+                                       self._get_proxy_classes(),
+                                       {'speed': config.speed,
+                                        'wait_acc': config.wait_acc,
+                                        'method': self.method,
+                                        'skip_inactivity': self.skip_inactivity},
+                                       input_files)
 
     def signal_req_event(self):
         """ function to signal that we can execute the next request
@@ -214,10 +805,238 @@ class Orchestrator:
     def signal_sys_inact(self):
         """ function to signal that the system is currently inactive (no downloads)
         """
-        if simu.no_active_download():
+        if self._prefetcher is not None:
+            # the bandwidth is not used by the clients
+            self._prefetcher.prefetch(simu.time_())
+        if self.skip_inactivity and simu.no_active_download():
             # to be sure
             self.signal_req_event()
+
+    def _prefetch_video(self, key):
+        """ Prefetches a video into the edge proxies, or into its node in 
+            cluster mode.
+
+            Args:
+                key (tuple): (id_server, id_video) of the video
+
+            Returns:
+                True if a proxy started to fetch it
+        """
+        id_server, id_video = key
+        payload = {'idServer': id_server, 'idVideo': id_video}
+        if self._router is not None:
+            proxies = [self._proxies[self._router.node_for(key)]]
+        else:
+            proxies = self._edge_proxies()
+        fetched = False
+        for proxy in proxies:
+            if hasattr(proxy, 'prefetch') and proxy.prefetch(payload):
+                fetched = True
+        return fetched
         
+    def _end_warmup(self):
+        """ The cache has been filled, the metrics are reset so that only 
+            the requests of the window are counted.
+        """
+        print("End of the warm-up, resetting the metrics")
+        self._warmup_end = None
+        for proxy in self._proxies.values():
+            if hasattr(proxy, 'reset_hit_stats'):
+                proxy.reset_hit_stats()
+            if hasattr(proxy, 'upstream_kb'):
+                proxy.upstream_kb = 0
+            if hasattr(proxy, 'reset_sibling_stats'):
+                proxy.reset_sibling_stats()
+            if hasattr(proxy, 'reset_tier_stats'):
+                proxy.reset_tier_stats()
+            if hasattr(proxy, 'reset_partition_stats'):
+                proxy.reset_partition_stats()
+            if hasattr(proxy, 'reset_processing_stats'):
+                proxy.reset_processing_stats()
+            if hasattr(proxy, 'reset_lock_stats'):
+                proxy.reset_lock_stats()
+            if hasattr(proxy, 'reset_prefetch_stats'):
+                proxy.reset_prefetch_stats()
+        if self._router is not None:
+            self._router.reset_load_stats()
+        with self._clients_lock:
+            for client in self._clients:
+                if hasattr(client, 'reset_metrics'):
+                    client.reset_metrics()
+                if client is not None:
+                    client.reset_bitrate_stats()
+                    client.reset_local_cache_stats()
+                    client.reset_p2p_stats()
+            self._p2p_parked.clear()
+            self._p2p_startups = []
+            if self._tracker is not None:
+                self._tracker.reset_stats()
+            for server in self._servers.values():
+                server.reset_load_stats()
+            for metrics_ in self._client_metrics:
+                metrics_[:] = [[], 0, 0, 0, 0, 0, 0]
+
+    def _request(self, id_client, id_video, id_server, watch_duration=0):
+        """ Replays one request of the trace, creating the client if it is
+            not currently simulated.
+
+            Args:
+                watch_duration (float): seconds of the video watched, from 
+                                        the trace, 0 if unknown (see 
+                                        :func:`_watch_duration`)
+        """
+        if id_video in self._missing_videos:
+            print("Ignoring request for missing video "+str(self._videos.key(id_video)))
+            return
+        if self._prefetcher is not None:
+            self._prefetcher.record((id_server, id_video), simu.time_())
+        with self._clients_lock:
+            client = self._clients[id_client]
+            if client is None:
+                client = self._create_client(id_client)
+            watch = self._watch_duration(id_video, id_server, watch_duration)
+            client.request_media(id_video, id_server, watch)
+            self._last_request[id_client] = simu.time_()
+            if self.idle_timeout and id_client not in self._idle_timers:
+                self._idle_timers[id_client] = simu.timers.call_later(
+                    self.idle_timeout, self._park_if_idle, id_client)
+
+    def _watch_duration(self, id_video, id_server, watch_duration):
+        """ Seconds of the video the viewer watches before leaving, None for
+            the whole video.
+
+            The duration of the trace is used if there is one. Otherwise, 
+            with watch_mean set in the [clients] section, the watched part of
+            the video is drawn from an exponential distribution of this mean,
+            most sessions being short.
+        """
+        duration = self._servers[id_server].get_video(id_video)['duration']
+        if not watch_duration > 0:
+            if not self._watch_mean:
+                return None
+            watch_duration = duration*self._watch_rng.exponential(self._watch_mean)
+        if watch_duration >= duration:
+            return None
+        return watch_duration
+
+    def _create_client(self, id_client):
+        """ Creates a client and connects it to the proxy, reusing the 
+            connections of the parked clients.
+        """
+        # +1001 because clients begin at id 1001
+        client = MetricClient(id_client+1001, 
+                              'Client '+self._client_ids.key(id_client))
+        client.set_two_in_a_row_protection(False)
+        # to keep the state of the simulation
+        if self.skip_inactivity or self._prefetcher is not None:
+            client.set_func_new_dl(simu.inc_nb_dl)
+            client.set_func_end_dl(simu.dec_nb_dl)
+        conf = self.conf['clients']
+        up = conf['up']
+        if self._profiles is None:
+            self._connect_client(client, conf['lag_down'], conf['down'], 
+                                 conf['up'], conf['max_chunk'], 
+                                 self._edge_of(id_client))
+        else:
+            index = self._client_profile[id_client]
+            profile = self._profiles[index]
+            up = profile['up']
+            self._connect_client(client, profile['lag'], profile['down'], 
+                                 profile['up'], profile['max_chunk'],
+                                 self._edge_of(id_client))
+            trace = self._profiles.bandwidth_trace(index)
+            if trace is not None:
+                # each client at a different place of the trace
+                offset = (id_client*profiles.LinkProfiles.GOLDEN_RATIO % 1)*trace.duration
+                for proxy in self._client_proxies(id_client):
+                    proxy.connection[client.get_id()].set_bandwidth_trace(trace, offset)
+        if conf.get('abr'):
+            client.set_abr(abr.create(conf['abr']), conf.get('max_buffer', 30))
+        if conf.get('local_cache'):
+            cache = self._local_caches.get(id_client)
+            if cache is None:
+                cache = self._get_proxy_class(conf['local_cache'])(client.get_id(), 
+                                                                   'Cache of '+client.name)
+                cache.set_cache_size(conf.get('local_cache_size', 0))
+                self._local_caches[id_client] = cache
+            client.set_local_cache(cache)
+        if self._tracker is not None:
+            self._tracker.add_peer(client, up)
+            client.set_tracker(self._tracker, int(conf.get('max_uploads', 4)))
+        if conf['consume_videos']:
+            client.start_video_consumer()
+
+        self._clients[id_client] = client
+        self._nb_live_clients += 1
+        self.nb_clients_peak = max(self.nb_clients_peak, self._nb_live_clients)
+        return client
+
+    def _park_if_idle(self, id_client):
+        """ Called by a timer, parks the client if it did not request 
+            anything during idle_timeout and is not downloading or playing.
+            Its metrics are kept in _client_metrics, its local cache in 
+            _local_caches, and its connections go back to the pool. Otherwise, checks again later.
+        """
+        with self._clients_lock:
+            del self._idle_timers[id_client]
+            client = self._clients[id_client]
+            if client is None:
+                return
+            now = simu.time_()
+            idle_for = now - self._last_request[id_client]
+            if idle_for < self.idle_timeout:
+                delay = self.idle_timeout - idle_for
+            elif not client.is_idle():
+                # the inactivity starts at the end of the session
+                self._last_request[id_client] = now
+                delay = self.idle_timeout
+            else:
+                metrics_ = self._client_metrics[id_client]
+                metrics_[0].extend(client.latencies)
+                metrics_[1] += client.counter
+                metrics_[2] += client.delivered_kb
+                metrics_[3] += client.delivered_seconds
+                metrics_[4] += client.nb_switches
+                metrics_[5] += client.local_hits
+                metrics_[6] += client.local_hit_kb
+                self._p2p_parked.update(client.p2p_stats)
+                self._p2p_startups.extend(client.p2p_startups)
+                if self._tracker is not None:
+                    self._tracker.remove_peer(client.get_id())
+                connection = client.disconnect()
+                if isinstance(connection, cluster.RoutedConnection):
+                    for node_connection in connection.connections.values():
+                        self._pool.release(node_connection)
+                else:
+                    self._pool.release(connection)
+                for proxy in self._client_proxies(id_client):
+                    self._pool.release(proxy.disconnect(client))
+                self._clients[id_client] = None
+                del self._last_request[id_client]
+                self._nb_live_clients -= 1
+                return
+            self._idle_timers[id_client] = simu.timers.call_later(
+                delay, self._park_if_idle, id_client)
+
+    def _get_client_metrics(self, id_client):
+        """ Latencies, number of stops, bitrate times duration and duration
+            of the videos downloaded, number of rendition switches, and hits
+            and kb of the local cache of a client, parked or not
+        """
+        with self._clients_lock:
+            latencies, counter, kb, seconds, switches, local_hits, local_kb = \
+                self._client_metrics[id_client]
+            client = self._clients[id_client]
+            if client is not None:
+                latencies = latencies + client.latencies
+                counter += client.counter
+                kb += client.delivered_kb
+                seconds += client.delivered_seconds
+                switches += client.nb_switches
+                local_hits += client.local_hits
+                local_kb += client.local_hit_kb
+        return latencies, counter, kb, seconds, switches, local_hits, local_kb
+
     def run_simulation(self):
         """ Runs the simulation, either with a scheduler or by waiting to trigger
             each event. 
@@ -235,20 +1054,27 @@ class Orchestrator:
         try:
             if self.method == 'event_lock':
 
-                if self.skip_inactivity:
+                if self.skip_inactivity or self._prefetcher is not None:
                     simu.action_when_zero = self.signal_sys_inact
 
-                while not self._events_queue.empty():
-                    event = self._events_queue.get()
-                    print("New event: "+str(event))
+                for delay_abs, delay, id_client, id_video, id_server, watch in self._events:
+                    print("New event: delay_abs "+str(delay_abs)+", client "+str(id_client)+", video "+str(id_video))
                     self._req_event.clear()
 
                     if not self.skip_inactivity or not simu.no_active_download():
-                        self._req_event.wait(event['delay'])
+                        self._req_event.wait(delay)
 
-                    self._clients[event['id_client']].request_media(event['id_video'], event['id_server'])
+                    # once the time of the request is reached, like with
+                    # the scheduler
+                    if self._warmup_end is not None and delay_abs >= self._warmup_end:
+                        self._end_warmup()
+                    while self._cluster_changes and self._cluster_changes[0][0] <= delay_abs:
+                        self._change_cluster(*self._cluster_changes.pop(0))
+                    self._request(id_client, id_video, id_server, watch)
 
             elif self.method == 'scheduler':
+                if self._prefetcher is not None:
+                    simu.action_when_zero = self.signal_sys_inact
                 if self.skip_inactivity:
                     while True:
                         """ Inefficient way to skip the inactivity """
@@ -257,7 +1083,7 @@ class Orchestrator:
                         if next != None:
                             if next/config.speed >= 1:
                                 # if it takes more than 1 second in real time
-                                if simu.no_active_download(self._clients.values()):
+                                if simu.no_active_download(self._clients):
                                     simu.add_time(next-1)
                                     print("Skiping inactivity!")
                         elif self._scheduler.empty():
@@ -278,9 +1104,12 @@ class Orchestrator:
         """ Waits for for all downloads to be over """
         print("The end.")
 
-        while not simu.no_active_download(self._clients.values()):
+        while not simu.no_active_download(self._clients):
             print("Waiting...")
             time.sleep(1)
+        for proxy in self._proxies.values():
+            if hasattr(proxy, 'stop_digests'):
+                proxy.stop_digests()
 
 
     def run_simulation_from_trace(self, trace_path):
@@ -301,6 +1130,13 @@ class Orchestrator:
         self._create_clients(list(id_clients))
         pass
 
+    def _open_output(self, path):
+        """ Opens an output file of the statistics, and records its path in
+            output_files
+        """
+        self.output_files.append(path)
+        return open(path, 'w', newline='')
+
     def gather_statistics(self,out_dir='stats',graphs=False,stats=True):
         """ writes statistics from the metrics to the out_dir 
             For now two files: clients and proxy.
@@ -314,16 +1150,17 @@ class Orchestrator:
             os.makedirs(out_dir)
 
         print("Writing data to "+out_dir)
+        self.output_files = []
         proxy_name = self.conf['proxy']['proxy_type']
 
-        client_file = open(out_dir+'/'+proxy_name+'_clients_latencies', 'w', newline='')
-        client_keys= ['id_client','playout_latency']
+        client_file = self._open_output(out_dir+'/'+proxy_name+'_clients_latencies')
+        client_keys= ['id_client','trace_id','playout_latency']
         client_writer = csv.DictWriter(client_file,client_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
 
         client_writer.writeheader()
 
-        client_stop_file = open(out_dir+'/'+proxy_name+'_clients_stops', 'w', newline='')
-        client_stop_keys= ['id_client','nb_stops']
+        client_stop_file = self._open_output(out_dir+'/'+proxy_name+'_clients_stops')
+        client_stop_keys= ['id_client','trace_id','nb_stops','avg_bitrate','nb_switches','local_hits']
         client_stop_writer = csv.DictWriter(client_stop_file,client_stop_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
 
         client_stop_writer.writeheader()
@@ -340,37 +1177,76 @@ class Orchestrator:
 
         latencies_per_client = collec.OrderedDict()
 
-        for client in self._clients.values():
-            id_client = client.get_id()
-            if hasattr(client, 'counter'):
-                row_client_stop['id_client'] = id_client
-                row_client_stop['nb_stops'] = client.counter
-                client_stop_writer.writerow(row_client_stop)
-            if hasattr(client, 'latencies'):
-                latencies = client.latencies
-                latencies_per_client[id_client] = latencies
-                for latency in latencies:
-                    row_client['id_client'] = id_client
-                    row_client['playout_latency'] = latency
-                    client_writer.writerow(row_client)
+        print("Clients: "+str(len(self._clients))+", at most "+str(self.nb_clients_peak)+
+              " simulated at the same time with "+str(self._pool.nb_created)+" pooled connections")
+
+        # per profile: [nb clients, latencies, nb stops, kb, seconds, switches]
+        per_profile = collec.OrderedDict()
+
+        local_hits = 0
+        local_kb = 0
+
+        for dense_id in range(len(self._clients)):
+            # +1001 because clients begin at id 1001
+            id_client = dense_id+1001
+            # the id of the client in the trace, to map the rows back to it
+            trace_id = self._client_ids.key(dense_id)
+            latencies, counter, kb, seconds, switches, hits, hit_kb = self._get_client_metrics(dense_id)
+            local_hits += hits
+            local_kb += hit_kb
+            if self._profiles is not None:
+                name = self._profiles.names[self._client_profile[dense_id]]
+                profile_stats = per_profile.setdefault(name, [0, [], 0, 0, 0, 0])
+                profile_stats[0] += 1
+                profile_stats[1].extend(latencies)
+                profile_stats[2] += counter
+                profile_stats[3] += kb
+                profile_stats[4] += seconds
+                profile_stats[5] += switches
+            row_client_stop['id_client'] = id_client
+            row_client_stop['trace_id'] = trace_id
+            row_client_stop['nb_stops'] = counter
+            row_client_stop['avg_bitrate'] = kb/seconds if seconds else 0
+            row_client_stop['nb_switches'] = switches
+            row_client_stop['local_hits'] = hits
+            client_stop_writer.writerow(row_client_stop)
+            latencies_per_client[id_client] = latencies
+            for latency in latencies:
+                row_client['id_client'] = id_client
+                row_client['trace_id'] = trace_id
+                row_client['playout_latency'] = latency
+                client_writer.writerow(row_client)
 
         client_file.close()
         client_stop_file.close()
 
+        if per_profile:
+            self._write_profiles_stats(out_dir+'/'+proxy_name+'_profiles', per_profile)
+
 
         if graphs:
             ps = metrics.PlotStats()
             ps.plot_bar(out_dir, None, latencies_per_client, latencies_per_client)
 
 
+        origin_kb = self._write_servers_stats(out_dir+'/'+proxy_name+'_servers')
+
         proxy_stats = None
 
-        if hasattr(self._proxy, 'get_stats'):
-            proxy_file = open(out_dir+'/'+proxy_name+'_proxy', 'w', newline='')
+        if self._topology is not None:
+            proxy_stats = self._write_topology_stats(out_dir+'/'+proxy_name, origin_kb)
+        elif self._router is not None:
+            proxy_stats = self._write_cluster_stats(out_dir+'/'+proxy_name, origin_kb)
+        elif hasattr(self._proxy, 'get_stats'):
+            proxy_file = self._open_output(out_dir+'/'+proxy_name+'_proxy')
             proxy_keys= ['id_client','playout_latency']
 
-            id_client = client.get_id()
             proxy_stats = self._proxy.get_stats()
+            # part of the data sent to the clients which did not come from the 
+            # servers, byte_cache is in kB
+            if 'byte_cache' in proxy_stats:
+                cache_kb = proxy_stats['byte_cache']*8
+                proxy_stats['origin_offload'] = cache_kb/(cache_kb+origin_kb) if cache_kb+origin_kb else 0
 
             print("Writing proxy data...")
 
@@ -381,8 +1257,383 @@ class Orchestrator:
 
             proxy_file.close()
 
+        if self.conf['clients'].get('local_cache'):
+            # the requests answered by the caches of the clients never
+            # reached a proxy
+            nb_played = sum(len(latencies) for latencies in latencies_per_client.values())
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats['local_hits'] = local_hits
+            proxy_stats['local_hit_kb'] = local_kb
+            proxy_stats['local_hit_ratio'] = local_hits/nb_played if nb_played else 0
+
+        tiered = [proxy for proxy in self._proxies.values() if hasattr(proxy, 'get_tier_stats')]
+        if tiered:
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_tier_stats(out_dir+'/'+proxy_name+'_tiers', tiered))
+
+        partitioned = [proxy for proxy in self._proxies.values() if hasattr(proxy, 'get_partition_stats')]
+        if partitioned:
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_partition_stats(out_dir+'/'+proxy_name+'_partitions',
+                                                           partitioned))
+
+        if any(hasattr(proxy, 'get_lock_stats') for proxy in self._proxies.values()):
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_lock_stats(out_dir+'/'+proxy_name+'_locks'))
+
+        if self.conf['proxy'].get('workers'):
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_processing_stats(out_dir+'/'+proxy_name+'_processing'))
+
+        if self._prefetcher is not None:
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_prefetch_stats(out_dir+'/'+proxy_name+'_prefetch'))
+
+        if self._tracker is not None:
+            proxy_stats = proxy_stats if proxy_stats is not None else dict()
+            proxy_stats.update(self._write_p2p_stats(out_dir+'/'+proxy_name+'_p2p',
+                                                     latencies_per_client))
+
+        links = [('_egress', link) if len(self._egress) == 1 else ('_egress_'+str(id_), link)
+                 for id_, link in self._egress.items()]
+        links.append(('_origin_egress', self._origin_egress))
+        for name, link in links:
+            if link is not None:
+                print("Writing"+name.replace('_', ' ')+" data...")
+                self._write_link_stats(out_dir+'/'+proxy_name+name, link)
+
         return (latencies_per_client, proxy_stats)
 
+    def _write_tier_stats(self, path, proxies):
+        """ Writes the statistics of each tier of the tiered proxies, and 
+            returns the hit ratio and the mean extra latency of the hits 
+            (the service time of the tier) of each tier of all the proxies
+        """
+        print("Writing tiers data...")
+        rows = []
+        nb_served = 0
+        for proxy in proxies:
+            nb_served += proxy.get_hit_stats()['nb_served']
+            for row in proxy.get_tier_stats():
+                rows.append(dict(id_proxy=proxy.get_id(), **row))
+        with self._open_output(path) as tiers_file:
+            writer = csv.DictWriter(tiers_file, rows[0].keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerows(rows)
+
+        stats = collec.OrderedDict()
+        for tier in [row['tier'] for row in proxies[0].get_tier_stats()]:
+            tier_rows = [row for row in rows if row['tier'] == tier]
+            hits = sum(row['hits'] for row in tier_rows)
+            delay = sum(row['extra_latency']*row['hits'] for row in tier_rows)
+            stats[tier+'_hit_ratio'] = hits/nb_served if nb_served else 0
+            stats[tier+'_extra_latency'] = delay/hits if hits else 0
+        return stats
+
+    def _write_partition_stats(self, path, proxies):
+        """ Writes the statistics of each partition of the partitioned 
+            proxies, and returns the hit ratio of each partition over all 
+            the proxies
+        """
+        print("Writing partitions data...")
+        rows = [dict(id_proxy=proxy.get_id(), **row) 
+                for proxy in proxies for row in proxy.get_partition_stats()]
+        with self._open_output(path) as partitions_file:
+            writer = csv.DictWriter(partitions_file, rows[0].keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerows(rows)
+
+        stats = collec.OrderedDict()
+        for name in collec.OrderedDict.fromkeys(row['partition'] for row in rows):
+            partition_rows = [row for row in rows if row['partition'] == name]
+            requests = sum(row['requests'] for row in partition_rows)
+            hits = sum(row['hits'] for row in partition_rows)
+            stats['partition_'+str(name)+'_hit_ratio'] = hits/requests if requests else 0
+        return stats
+
+    def _write_lock_stats(self, path):
+        """ Writes the contention of the locks of each caching proxy, and 
+            returns the contention of the shard and cache locks of all the
+            proxies and the wall-clock seconds the threads waited for them
+        """
+        print("Writing locks data...")
+        rows = [dict(id_proxy=id_, **proxy.get_lock_stats()) 
+                for id_, proxy in self._proxies.items() if hasattr(proxy, 'get_lock_stats')]
+        with self._open_output(path) as locks_file:
+            writer = csv.DictWriter(locks_file, rows[0].keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerows(rows)
+        stats = collec.OrderedDict()
+        for prefix in ('shard_', 'cache_'):
+            acquisitions = sum(row[prefix+'acquisitions'] for row in rows)
+            contended = sum(row[prefix+'contended'] for row in rows)
+            stats[prefix+'lock_contention'] = contended/acquisitions if acquisitions else 0
+        stats['lock_wait_time'] = sum(row['shard_wait_time']+row['cache_wait_time'] for row in rows)
+        return stats
+
+    def _write_processing_stats(self, path):
+        """ Writes the processing statistics of each proxy: the packets 
+            processed, the queueing delays before a worker took them and the
+            utilization of the workers. Returns the mean queueing delay of 
+            all the proxies, and the highest 99th percentile and utilization
+            of a proxy, the busiest proxy being the bottleneck.
+        """
+        print("Writing processing data...")
+        rows = [dict(id_proxy=id_, **proxy.get_processing_stats()) 
+                for id_, proxy in self._proxies.items() if hasattr(proxy, 'get_processing_stats')]
+        with self._open_output(path) as processing_file:
+            writer = csv.DictWriter(processing_file, rows[0].keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerows(rows)
+        nb_processed = sum(row['nb_processed'] for row in rows)
+        delay = sum(row['queueing_delay_mean']*row['nb_processed'] for row in rows)
+        return {'proxy_queueing_delay': delay/nb_processed if nb_processed else 0,
+                'proxy_queueing_delay_p99': max(row['queueing_delay_p99'] for row in rows),
+                'proxy_utilization': max(row['utilization'] for row in rows)}
+
+    def _write_prefetch_stats(self, path):
+        """ Writes the statistics of the prefetching of each proxy, and 
+            returns those of all the proxies: the kb prefetched, the part of 
+            the prefetched videos requested later (the accuracy) and the 
+            seconds of startup latency saved
+        """
+        print("Writing prefetch data...")
+        rows = [dict(id_proxy=id_, **proxy.get_prefetch_stats()) 
+                for id_, proxy in self._proxies.items() if hasattr(proxy, 'get_prefetch_stats')]
+        with self._open_output(path) as prefetch_file:
+            writer = csv.DictWriter(prefetch_file, rows[0].keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerows(rows)
+        prefetched = sum(row['prefetched'] for row in rows)
+        useful = sum(row['useful'] for row in rows)
+        return {'prefetch_kb': sum(row['prefetch_kb'] for row in rows),
+                'prefetch_accuracy': useful/prefetched if prefetched else 0,
+                'prefetch_latency_saved': sum(row['latency_saved'] for row in rows)}
+
+    def _write_p2p_stats(self, path, latencies_per_client):
+        """ Writes the statistics of the peer-assisted delivery of all the
+            clients, and returns them: the kb received from the other clients
+            (the proxy egress saved) and their part of the kb received 
+            (p2p_offload), the kb uploaded, the requests matched by the 
+            tracker and the peer misses, and the mean startup latency of all
+            the videos and of those received from other clients.
+        """
+        with self._clients_lock:
+            totals = collec.Counter(self._p2p_parked)
+            startups = list(self._p2p_startups)
+            for client in self._clients:
+                if client is not None:
+                    totals.update(client.p2p_stats)
+                    startups.extend(client.p2p_startups)
+        stats = dict.fromkeys(['p2p_requests', 'p2p_misses', 'p2p_kb', 'proxy_kb',
+                               'nb_uploads', 'upload_kb'], 0)
+        stats.update(totals)
+        stats.update(self._tracker.get_stats())
+        received_kb = stats['p2p_kb'] + stats['proxy_kb']
+        stats['p2p_offload'] = stats['p2p_kb']/received_kb if received_kb else 0
+        latencies = [latency for client_latencies in latencies_per_client.values()
+                     for latency in client_latencies]
+        stats['startup_latency'] = np.mean(latencies) if latencies else 0
+        stats['p2p_startup_latency'] = np.mean(startups) if startups else 0
+
+        print("Writing p2p data...")
+        with self._open_output(path) as p2p_file:
+            writer = csv.DictWriter(p2p_file, stats.keys(), quoting=csv.QUOTE_NONNUMERIC, delimiter=',')
+            writer.writeheader()
+            writer.writerow(stats)
+        return {key: stats[key] for key in ('p2p_kb', 'p2p_offload', 'upload_kb',
+                                             'p2p_misses', 'startup_latency',
+                                             'p2p_startup_latency')}
+
+    def _write_topology_stats(self, path, origin_kb):
+        """ Writes the hit statistics and the kb received from upstream 
+            (the traffic from the level above) of each proxy of the topology
+            in path_proxies, and aggregated by level in path_levels.
+
+            Returns:
+                the aggregated statistics of the edge proxies, with the 
+                origin_offload of the whole topology
+        """
+        print("Writing proxies data...")
+        levels = self._topology.levels()
+        per_level = collec.OrderedDict((level, []) for level in sorted(set(levels.values())))
+        proxy_file = self._open_output(path+'_proxies')
+        proxy_keys = ['proxy', 'level', 'proxy_type', 'cache_size', 'parent'] + self._stat_keys()
+        proxy_writer = csv.DictWriter(proxy_file,proxy_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        proxy_writer.writeheader()
+        for name, proxy in self._proxies.items():
+            desc = self._topology[name]
+            row = self._hit_stats(proxy)
+            row.update({'proxy': name, 'level': levels[name], 
+                        'proxy_type': desc['proxy_type'], 
+                        'cache_size': desc['cache_size'], 
+                        'parent': desc['parent'] or ''})
+            proxy_writer.writerow(row)
+            per_level[levels[name]].append(row)
+        proxy_file.close()
+
+        level_file = self._open_output(path+'_levels')
+        level_keys = ['level'] + self._stat_keys()
+        level_writer = csv.DictWriter(level_file,level_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        level_writer.writeheader()
+        cache_kb = 0
+        for level, rows in per_level.items():
+            stats = self._sum_hit_stats(rows)
+            per_level[level] = stats
+            stats['level'] = level
+            level_writer.writerow(stats)
+            # byte_cache is in kB
+            cache_kb += stats['byte_cache']*8
+        level_file.close()
+
+        totals = self._sum_hit_stats(list(per_level.values()))
+        proxy_stats = per_level[0]
+        del proxy_stats['level'], proxy_stats['upstream_kb']
+        if self.conf['proxy'].get('siblings'):
+            for key in self.SIBLING_KEYS:
+                del proxy_stats[key]
+            proxy_stats['false_positives'] = totals['false_positives']
+            proxy_stats['inter_proxy_kb'] = totals['sibling_served_kb'] + totals['digest_kb']
+            proxy_stats['saved_origin_kb'] = totals['sibling_kb']
+            # served to the clients by a sibling, not by the servers
+            cache_kb += totals['sibling_kb']
+        proxy_stats['origin_offload'] = cache_kb/(cache_kb+origin_kb) if cache_kb+origin_kb else 0
+        return proxy_stats
+
+    def _write_cluster_stats(self, path, origin_kb):
+        """ Writes the requests routed to each node of the cluster with 
+            its hit statistics in path_nodes, and the changes of the 
+            cluster with their churn in path_cluster.
+
+            Returns:
+                the aggregated statistics of the nodes, with the imbalance
+                of the requests and the origin_offload
+        """
+        print("Writing cluster data...")
+        requests, imbalance = self._router.get_load_stats(list(self._proxies))
+        nodes = self._router.nodes
+        node_file = self._open_output(path+'_nodes')
+        node_keys = ['node', 'in_cluster', 'requests'] + self.HIT_KEYS
+        node_writer = csv.DictWriter(node_file,node_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        node_writer.writeheader()
+        rows = []
+        for name, proxy in self._proxies.items():
+            row = self._hit_stats(proxy)
+            row.update({'node': name, 'in_cluster': name in nodes, 
+                        'requests': requests[name]})
+            node_writer.writerow(row)
+            rows.append(row)
+        node_file.close()
+
+        change_file = self._open_output(path+'_cluster')
+        change_keys = ['time', 'change', 'nb_nodes', 'moved_keys', 'churn', 'moved_kb']
+        change_writer = csv.DictWriter(change_file,change_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        change_writer.writeheader()
+        for change in self._router.get_changes():
+            change_writer.writerow(change)
+        change_file.close()
+
+        proxy_stats = self._sum_hit_stats(rows)
+        del proxy_stats['upstream_kb']
+        proxy_stats['imbalance'] = imbalance
+        # byte_cache is in kB
+        cache_kb = proxy_stats['byte_cache']*8
+        proxy_stats['origin_offload'] = cache_kb/(cache_kb+origin_kb) if cache_kb+origin_kb else 0
+        return proxy_stats
+
+    def _stat_keys(self):
+        """ HIT_KEYS, and SIBLING_KEYS if the proxies cooperate """
+        if self.conf['proxy'].get('siblings'):
+            return self.HIT_KEYS + self.SIBLING_KEYS
+        return self.HIT_KEYS
+
+    def _hit_stats(self, proxy):
+        """ The statistics of a proxy, 0 for those it does not have, see 
+            :func:`_stat_keys`
+        """
+        stats = proxy.get_hit_stats() if hasattr(proxy, 'get_hit_stats') else dict()
+        if hasattr(proxy, 'get_sibling_stats'):
+            stats.update(proxy.get_sibling_stats())
+        row = {key: stats.get(key, 0) for key in self._stat_keys()}
+        row['upstream_kb'] = getattr(proxy, 'upstream_kb', 0)
+        return row
+
+    def _sum_hit_stats(self, rows):
+        """ Aggregates the statistics of several proxies """
+        stats = {key: sum(row[key] for row in rows) for key in self._stat_keys()}
+        stats['hit_ratio'] = stats['cache_hits']/stats['nb_served'] if stats['nb_served'] else 0
+        stats['byte_hit_ratio'] = stats['byte_cache']/stats['byte_served'] if stats['byte_served'] else 0
+        return stats
+
+    def _write_profiles_stats(self, path, per_profile):
+        """ Writes the playout latencies, stops, average bitrate and switches
+            of the clients of each link profile, one line per profile.
+        """
+        profile_file = self._open_output(path)
+        profile_keys = ['profile', 'nb_clients', 'nb_playbacks', 'latency_mean', 
+                        'latency_p90', 'nb_stops', 'stops_per_client', 
+                        'avg_bitrate', 'nb_switches']
+        profile_writer = csv.DictWriter(profile_file,profile_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        profile_writer.writeheader()
+        for name, (nb_clients, latencies, nb_stops, kb, seconds, switches) in per_profile.items():
+            profile_writer.writerow({'profile': name,
+                                     'nb_clients': nb_clients,
+                                     'nb_playbacks': len(latencies),
+                                     'latency_mean': np.mean(latencies) if latencies else 0,
+                                     'latency_p90': np.percentile(latencies, 90) if latencies else 0,
+                                     'nb_stops': nb_stops,
+                                     'stops_per_client': nb_stops/nb_clients,
+                                     'avg_bitrate': kb/seconds if seconds else 0,
+                                     'nb_switches': switches})
+        profile_file.close()
+
+    def _write_servers_stats(self, path):
+        """ Writes the load of the video servers: one line per server and 
+            per interval in path, and the response times of each server in 
+            path_response.
+
+            Returns:
+                the total kb sent by the servers
+        """
+        print("Writing servers data...")
+        interval_file = self._open_output(path)
+        interval_keys = ['id_server', 'time', 'requests', 'served_kb', 'max_queue', 'max_active']
+        interval_writer = csv.DictWriter(interval_file,interval_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        interval_writer.writeheader()
+
+        response_file = self._open_output(path+'_response')
+        response_writer = None
+
+        origin_kb = 0
+        for id_server, server in sorted(self._servers.items()):
+            for row in server.get_load_intervals():
+                row['id_server'] = id_server
+                interval_writer.writerow(row)
+            stats = server.get_load_stats()
+            origin_kb += stats['served_kb']
+            stats['id_server'] = id_server
+            if response_writer is None:
+                response_keys = ['id_server'] + [k for k in stats if k != 'id_server']
+                response_writer = csv.DictWriter(response_file,response_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+                response_writer.writeheader()
+            response_writer.writerow(stats)
+
+        interval_file.close()
+        response_file.close()
+        return origin_kb
+
+    def _write_link_stats(self, path, link):
+        """ Writes the utilization and queueing delay of a 
+            :class:`model.SharedLink` over time, one line per interval.
+        """
+        link_file = self._open_output(path)
+        link_keys = ['time', 'utilization', 'queueing_delay', 'flows']
+        link_writer = csv.DictWriter(link_file,link_keys,quoting=csv.QUOTE_NONNUMERIC,delimiter=',')
+        link_writer.writeheader()
+        for row in link.get_stats():
+            link_writer.writerow(row)
+        link_file.close()
+
         
     """
     def _configure_client(self, client):
@@ -405,26 +1656,95 @@ class Orchestrator:
             self._clients[id_] = VideoServer(id_, 'Server '+id_)
 
     def _connect_network(self):
-        """ Connects all clients to the proxy and all servers to 
-            to the proxy with the config parameters.
+        """ Connects all clients to their (edge) proxy, the proxies of
+            the topology to their parent and all servers to the proxies
+            without parent with the config parameters.
         """
         self._connect_clients(self.conf['clients']['lag_down'],
                               self.conf['clients']['down'], 
                               self.conf['clients']['up'],
                               self.conf['clients']['max_chunk'])
+        self._connect_proxies(self.conf['servers']['lag_down'],
+                              self.conf['servers']['down'],
+                              self.conf['servers']['max_chunk'])
         self._connect_servers(self.conf['servers']['lag_down'],
                               self.conf['servers']['down'], 
                               self.conf['servers']['up'],
                               self.conf['servers']['max_chunk'])
 
     def _connect_clients(self, lag=0.1, bandwidth_down=4000, bandwidth_up=600, max_chunk=16):
+        """ Connects the clients already created, the others are connected
+            when they are created.
+        """
         print("Connecting the clients...")
-        for client in self._clients.values():
-            client.connect_to(self._proxy).set_lag(lag).set_bandwidth(bandwidth_up).set_max_chunk(max_chunk)
-            self._proxy.connect_to(client).set_lag(lag).set_bandwidth(bandwidth_down).set_max_chunk(max_chunk)
+        for id_client, client in enumerate(self._clients):
+            if client is not None:
+                self._connect_client(client, lag, bandwidth_down, bandwidth_up, 
+                                     max_chunk, self._edge_of(id_client))
+
+    def _connect_client(self, client, lag=0.1, bandwidth_down=4000, bandwidth_up=600, max_chunk=16, proxy=None):
+        """ Connects a client to its proxy, or to all the nodes of the 
+            cluster through a :class:`cluster.RoutedConnection`.
+        """
+        proxies = [proxy or self._proxy]
+        if self._router is not None:
+            proxies = list(self._proxies.values())
+        connections = dict()
+        for proxy in proxies:
+            connections[proxy.get_id()] = client.connect_to(proxy, self._pool.get()).set_lag(lag).set_bandwidth(bandwidth_up).set_max_chunk(max_chunk)
+            proxy.connect_to(client, self._pool.get()).set_lag(lag).set_bandwidth(bandwidth_down).set_max_chunk(max_chunk).set_shared_link(self._egress.get(proxy.get_id()))
+        if self._router is not None:
+            client.set_connection(cluster.RoutedConnection(self._router, connections))
+
+    def _connect_proxies(self, lag=0.1, bandwidth=100000, max_chunk=16):
+        """ Connects each proxy of the topology to its parent, with the lag
+            and bandwidth of the topology or the given ones.
+        """
+        if self._topology is None:
+            return
+        print("Connecting the proxies...")
+        for name in self._topology.names:
+            desc = self._topology[name]
+            if desc['parent'] is None:
+                continue
+            link_lag = lag if desc['lag'] is None else desc['lag']
+            link_bandwidth = desc['bandwidth'] or bandwidth
+            proxy = self._proxies[name]
+            parent = self._proxies[desc['parent']]
+            proxy.connect_to(parent).set_lag(link_lag).set_bandwidth(link_bandwidth).set_max_chunk(max_chunk)
+            parent.connect_to(proxy).set_lag(link_lag).set_bandwidth(link_bandwidth).set_max_chunk(max_chunk)
+        if self.conf['proxy'].get('siblings'):
+            self._connect_siblings(lag, bandwidth, max_chunk)
+
+    def _connect_siblings(self, lag=0.1, bandwidth=100000, max_chunk=16):
+        """ Connects the caching proxies having the same parent (or no 
+            parent) to each other, and makes them cooperate. A link has the
+            lag and bandwidth of the proxy sending on it.
+        """
+        groups = collec.OrderedDict()
+        for name in self._topology.names:
+            if hasattr(self._proxies[name], 'set_siblings'):
+                groups.setdefault(self._topology[name]['parent'], []).append(name)
+        for names in groups.values():
+            if len(names) < 2:
+                continue
+            print("Siblings: "+", ".join(names))
+            for name in names:
+                desc = self._topology[name]
+                link_lag = lag if desc['lag'] is None else desc['lag']
+                link_bandwidth = desc['bandwidth'] or bandwidth
+                proxy = self._proxies[name]
+                for other in names:
+                    if other != name:
+                        proxy.connect_to(self._proxies[other]).set_lag(link_lag).set_bandwidth(link_bandwidth).set_max_chunk(max_chunk)
+            for name in names:
+                self._proxies[name].set_siblings([other for other in names if other != name],
+                                                 self.conf['proxy'].get('digest_interval', 60),
+                                                 self.conf['proxy'].get('digest_fp_rate', 0.01))
 
     def _connect_servers(self, lag=0.1, bandwidth_down=100000, bandwidth_up=100000, max_chunk=16):
         print("Connecting the servers...")
-        for server in self._servers.values():
-            server.connect_to(self._proxy).set_lag(lag).set_bandwidth(bandwidth_up).set_max_chunk(max_chunk)
-            self._proxy.connect_to(server).set_lag(lag).set_bandwidth(bandwidth_down).set_max_chunk(max_chunk)
+        for proxy in self._root_proxies():
+            for server in self._servers.values():
+                server.connect_to(proxy).set_lag(lag).set_bandwidth(bandwidth_up).set_max_chunk(max_chunk).set_shared_link(self._origin_egress)
+                proxy.connect_to(server).set_lag(lag).set_bandwidth(bandwidth_down).set_max_chunk(max_chunk)
@@ -0,0 +1,207 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the peer-assisted delivery: the clients which have a
+video in their local cache (see :func:`model.Client.set_local_cache`) upload
+it to the other clients, the proxy being the fallback.
+
+The :class:`Tracker` knows which clients announced each video (or segment)
+and matches a request with one of them in O(1): the holders of a key are
+kept in a list, taken in turn, and removed by swapping with the last one. A
+video evicted from the cache of a client is not withdrawn at once: the
+client answers that it does not have it anymore (a peer miss), and the
+requester withdraws it and asks the proxy instead. A client already sending
+max_uploads videos answers the same way, without withdrawing anything.
+
+The tracker also creates the connections between the clients, when they
+are first needed. All the uploads of a client share its up bandwidth (see
+:class:`model.SharedLink`).
+
+.. code-block:: python
+
+    tracker = p2p.Tracker(lag=0.05, max_chunk=16, pool=pool)
+    for client in clients:
+        tracker.add_peer(client, up=600)
+        client.set_tracker(tracker, max_uploads=4)
+    ...
+    tracker.remove_peer(client.get_id())
+
+Code documentation
+==================
+"""
+import threading
+
+from model import Connection, SharedLink
+
+
+class Tracker:
+    """ The videos held by the clients and the connections between them.
+
+        Args:
+            lag (float): latency of the connections between clients, in
+                         seconds
+            max_chunk (float): size of the chunks sent between clients, in kb
+            pool (:class:`model.ConnectionPool`): to get the connections
+                                                  from, optional
+    """
+
+    def __init__(self, lag=0.05, max_chunk=16, pool=None):
+        self.lag = lag
+        self.max_chunk = max_chunk
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._peers = dict()
+        """ the clients, by id """
+        self._links = dict()
+        """ :class:`model.SharedLink` of the uploads of each client, by id """
+        self._holders = dict()
+        """ ids of the clients holding each key """
+        self._position = dict()
+        """ index in _holders of each (key, id) """
+        self._turn = dict()
+        """ number of matches of each key, to take the holders in turn """
+        self._keys_of = dict()
+        """ keys announced by each client, by id """
+        self._connections = dict()
+        """ connections between clients, by (id_from, id_to) """
+        self._connections_of = dict()
+        """ keys of _connections of each client, by id """
+        self.lookups = 0
+        """ number of requests looked up """
+        self.matches = 0
+        """ number of requests matched with a peer """
+
+    @staticmethod
+    def key(payload):
+        """ The key of a video request: the server and the video, and the
+            rendition and segment when the videos are downloaded segment by
+            segment.
+        """
+        if 'segment' in payload:
+            return (payload['idServer'], payload['idVideo'],
+                    payload['rendition'], payload['segment'])
+        return (payload['idServer'], payload['idVideo'])
+
+    def add_peer(self, peer, up):
+        """ Adds a client, which can then announce videos and be matched.
+
+            Args:
+                peer (:class:`model.Client`): the client
+                up (float): its upload bandwidth, shared by its uploads, in
+                            kb/s
+        """
+        with self._lock:
+            id_ = peer.get_id()
+            self._peers[id_] = peer
+            self._links[id_] = SharedLink(up)
+            self._keys_of.setdefault(id_, set())
+            self._connections_of.setdefault(id_, set())
+
+    def remove_peer(self, id_peer):
+        """ Withdraws all the videos of a client, and releases its
+            connections to the pool. It must not be sending anything.
+        """
+        with self._lock:
+            if self._peers.pop(id_peer, None) is None:
+                return
+            del self._links[id_peer]
+            for key in self._keys_of.pop(id_peer):
+                self._withdraw(key, id_peer)
+            for pair in self._connections_of.pop(id_peer):
+                connection = self._connections.pop(pair)
+                other = pair[1] if pair[0] == id_peer else pair[0]
+                self._connections_of[other].discard(pair)
+                if self._pool is not None:
+                    self._pool.release(connection)
+
+    def announce(self, key, id_peer):
+        """ A client has the video of key and can upload it """
+        with self._lock:
+            if id_peer not in self._peers or (key, id_peer) in self._position:
+                return
+            holders = self._holders.setdefault(key, [])
+            self._position[(key, id_peer)] = len(holders)
+            holders.append(id_peer)
+            self._keys_of[id_peer].add(key)
+
+    def withdraw(self, key, id_peer):
+        """ A client does not have the video of key anymore """
+        with self._lock:
+            if self._withdraw(key, id_peer):
+                self._keys_of[id_peer].discard(key)
+
+    def _withdraw(self, key, id_peer):
+        index = self._position.pop((key, id_peer), None)
+        if index is None:
+            return False
+        holders = self._holders[key]
+        last = holders.pop()
+        if last != id_peer:
+            holders[index] = last
+            self._position[(key, last)] = index
+        if not holders:
+            del self._holders[key]
+            self._turn.pop(key, None)
+        return True
+
+    def find(self, key, id_requester):
+        """ Returns the id of a client holding the video of key, other than
+            the requester, None if there is none. The holders are taken in
+            turn.
+        """
+        with self._lock:
+            self.lookups += 1
+            holders = self._holders.get(key)
+            if not holders:
+                return None
+            turn = self._turn.get(key, 0)
+            id_peer = holders[turn % len(holders)]
+            if id_peer == id_requester:
+                if len(holders) == 1:
+                    return None
+                turn += 1
+                id_peer = holders[turn % len(holders)]
+            self._turn[key] = turn+1
+            self.matches += 1
+            return id_peer
+
+    def connection(self, id_from, id_to):
+        """ Returns the connection from a client to another one, created
+            when first needed. None if one of them was removed.
+        """
+        with self._lock:
+            connection = self._connections.get((id_from, id_to))
+            if connection is not None:
+                return connection
+            if id_from not in self._peers or id_to not in self._peers:
+                return None
+            link = self._links[id_from]
+            if self._pool is not None:
+                connection = self._pool.get()
+                connection.connect(self._peers[id_to])
+            else:
+                connection = Connection(self._peers[id_to])
+            connection.set_lag(self.lag).set_bandwidth(link.capacity)
+            connection.set_max_chunk(self.max_chunk).set_shared_link(link)
+            self._connections[(id_from, id_to)] = connection
+            self._connections_of[id_from].add((id_from, id_to))
+            self._connections_of[id_to].add((id_from, id_to))
+            return connection
+
+    def reset_stats(self):
+        """ Sets the number of lookups and matches back to zero """
+        with self._lock:
+            self.lookups = 0
+            self.matches = 0
+
+    def get_stats(self):
+        """ Returns the number of lookups and matches, the number of clients
+            and the number of videos announced.
+        """
+        with self._lock:
+            return {'lookups': self.lookups, 'matches': self.matches,
+                    'nb_peers': len(self._peers), 'nb_keys': len(self._holders)}
+
+    def __len__(self):
+        return len(self._peers)
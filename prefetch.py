@@ -0,0 +1,160 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the prefetching of the videos predicted to be popular
+soon: when no client is downloading anything, the idle bandwidth of the
+proxies and of the servers is used to pull these videos into the caches
+(see :func:`model.CachingProxy.prefetch`).
+
+The prediction is the number of requests of each video, decayed with a half
+life so that the recent requests count more, kept for the k most requested
+videos only by the Space-Saving algorithm (:class:`SpaceSaving`). A video
+not among the k ones replaces the one with the lowest count, and inherits
+its count, so that a video requested often enough always gets in.
+
+The decay is a forward decay: a request at time t weighs 2^(t/half_life),
+so that the counts never need to be decayed, only compared. They are scaled
+down when the weights get too large.
+
+.. code-block:: python
+
+    prefetcher = prefetch.Prefetcher(fetch, top_k=100, half_life=600,
+                                     max_videos=5)
+    # for each request
+    prefetcher.record((id_server, id_video), simu.time_())
+    # when the system is idle, fetch(key) is called for the most popular
+    # videos until max_videos of them are fetched
+    prefetcher.prefetch(simu.time_())
+
+Code documentation
+==================
+"""
+import heapq
+import itertools
+import threading
+
+
+class SpaceSaving:
+    """ The k keys with the highest decayed counts, approximately.
+
+        Args:
+            k (int): number of keys kept
+            half_life (float): seconds after which a request counts half, 0
+                               for no decay
+    """
+
+    MAX_WEIGHT = 2.0**500
+    """ above which the counts are scaled down """
+
+    def __init__(self, k=100, half_life=600):
+        self.k = k
+        self.half_life = half_life
+        self._origin = None
+        """ time of weight 1 """
+        self._counts = dict()
+        """ decayed count of each key kept """
+        self._heap = []
+        """ (count, order, key), with the outdated counts removed lazily """
+        self._order = itertools.count()
+
+    def _weight(self, time):
+        if not self.half_life:
+            return 1.0
+        if self._origin is None:
+            self._origin = time
+        weight = 2.0**((time - self._origin)/self.half_life)
+        if weight > self.MAX_WEIGHT:
+            self._rescale(weight)
+            weight = 1.0
+            self._origin = time
+        return weight
+
+    def _rescale(self, factor):
+        """ Divides all the counts by factor """
+        self._counts = {key: count/factor for key, count in self._counts.items()}
+        self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(count, next(self._order), key) for key, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        """ Removes and returns the key with the lowest count, and the count """
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            if self._counts.get(key) == count:
+                del self._counts[key]
+                return key, count
+
+    def add(self, key, time):
+        """ Counts a request for key at time """
+        weight = self._weight(time)
+        count = self._counts.get(key)
+        if count is None:
+            count = 0
+            if len(self._counts) >= self.k:
+                count = self._pop_min()[1]
+        count += weight
+        self._counts[key] = count
+        heapq.heappush(self._heap, (count, next(self._order), key))
+        if len(self._heap) > 4*self.k:
+            # too many outdated entries
+            self._rebuild()
+
+    def top(self, n, time=None):
+        """ Returns the n keys with the highest counts, with their count
+            decayed at time (or not decayed), highest first
+        """
+        scale = 1.0
+        if time is not None and self.half_life and self._origin is not None:
+            scale = 2.0**(-(time - self._origin)/self.half_life)
+        best = heapq.nlargest(n, self._counts.items(), key=lambda item: item[1])
+        return [(key, count*scale) for key, count in best]
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class Prefetcher:
+    """ Predicts the popular videos and fetches them when the system is idle.
+
+        Args:
+            fetch (function): called with the key of a video to prefetch it,
+                              returns True if it is fetched, False if it is
+                              already cached or being fetched
+            top_k (int): number of videos whose popularity is kept
+            half_life (float): of the request counts, in seconds
+            max_videos (int): videos fetched at most each time the system
+                              is idle
+    """
+
+    def __init__(self, fetch, top_k=100, half_life=600, max_videos=5):
+        self.fetch = fetch
+        self.max_videos = max_videos
+        self.popularity = SpaceSaving(top_k, half_life)
+        self._lock = threading.Lock()
+
+    def record(self, key, time):
+        """ Counts a request for the video of key """
+        with self._lock:
+            self.popularity.add(key, time)
+
+    def prefetch(self, time):
+        """ Fetches the most popular videos which are not cached yet.
+
+            Returns:
+                the keys of the videos fetched
+        """
+        with self._lock:
+            candidates = self.popularity.top(self.popularity.k, time)
+        fetched = []
+        for key, _ in candidates:
+            if len(fetched) >= self.max_videos:
+                break
+            if self.fetch(key):
+                fetched.append(key)
+        return fetched
@@ -0,0 +1,214 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the link profiles of the clients: the bandwidth, the
+latency and the size of the chunks of their connection to the proxy. A
+profile is a class of users, like fibre or mobile, so that the metrics can be
+broken down by profile.
+
+The profiles are read from a CSV file. The share column is the part of the
+clients which are not in the client map (see below) given to this profile:
+
+.. code-block:: none
+
+    "profile","up","down","lag","max_chunk","share"
+    "fibre",20000,100000,0.005,16,0.2
+    "mobile",500,3000,0.1,8,0.3
+
+The optional bandwidth_trace column gives a file of the bandwidth over time
+of the connections from the proxy to the clients of the profile, which then
+replaces down (see :class:`model.BandwidthTrace`). Each file is loaded once
+and shared by all the clients of the profile:
+
+.. code-block:: none
+
+    "time","bandwidth"
+    0,3000
+    1,2200
+    2,400
+
+The client map is an optional CSV file giving the profile of some clients,
+by their id in the trace:
+
+.. code-block:: none
+
+    "id_client","profile"
+    1,"fibre"
+    4,"mobile"
+
+The profiles of all the clients are computed at once by :func:`LinkProfiles.assign`,
+with a binary search in the sorted ids of the map. The clients neither in the
+map nor in a share get the first profile, which the orchestrator builds from
+the [clients] section of the configuration.
+
+.. code-block:: python
+
+    profiles = profiles.LinkProfiles()
+    profiles.add('default', up=600, down=2000, lag=0.1, max_chunk=16)
+    profiles.load('fake_profiles.dat')
+    client_profile = profiles.assign(client_ids.keys, 'clients_map.dat')
+    profiles[client_profile[dense_id]]['down']
+
+Code documentation
+==================
+"""
+import csv
+
+import numpy as np
+
+import traces
+from model import BandwidthTrace
+
+GOLDEN_RATIO = 0.6180339887498949
+""" to spread the clients over the shares, see :func:`assign` """
+
+def assign(client_keys, shares, map_path=None, column='profile', index=None):
+    """ Chooses one of several options (profiles, proxies...) for each client.
+
+        Args:
+            client_keys (list): the ids of the clients in the trace, indexed 
+                                by dense id
+            shares (list): part of the clients getting each option
+            map_path (str): optional CSV file giving the option of some 
+                            clients, with the id_client and column columns
+            column (str): column of the map giving the name of the option
+            index (dict): index of the options, by name
+
+        Returns:
+            numpy array of the option indexes, indexed by dense id
+
+        The clients which are not in the map are spread over the options 
+        with a share, in proportion to the shares (option 0 if there is no
+        share). The dense id times the golden ratio (modulo 1) is used 
+        instead of a random number, so that the assignment is the same at 
+        each run and well balanced even with few clients.
+    """
+    nb_clients = len(client_keys)
+    result = np.zeros(nb_clients, dtype=np.int64)
+
+    shares = np.asarray(shares, dtype=np.float64)
+    if shares.sum() > 0:
+        bounds = np.cumsum(shares)/shares.sum()
+        position = (np.arange(nb_clients)*GOLDEN_RATIO) % 1
+        result = np.searchsorted(bounds, position, side='right')
+        result = np.minimum(result, len(shares)-1)
+
+    if map_path and nb_clients:
+        map_ids = []
+        map_values = []
+        with open(map_path, 'r') as f:
+            reader = csv.DictReader(filter(lambda row: row[0]!='#', f))
+            for row in reader:
+                map_ids.append(traces.normalize_id(row['id_client']))
+                map_values.append(index[row[column]])
+        if map_ids:
+            map_ids = np.array(map_ids)
+            map_values = np.array(map_values, dtype=np.int64)
+            order = np.argsort(map_ids, kind='stable')
+            map_ids = map_ids[order]
+            map_values = map_values[order]
+
+            keys = np.array(client_keys, dtype=str)
+            pos = np.searchsorted(map_ids, keys)
+            pos = np.minimum(pos, len(map_ids)-1)
+            found = map_ids[pos] == keys
+            result = np.where(found, map_values[pos], result)
+    return result
+
+
+class LinkProfiles:
+    """ The link profiles, indexed by their position in the file (the
+        profiles added with :func:`add` first).
+    """
+
+    GOLDEN_RATIO = GOLDEN_RATIO
+
+    def __init__(self):
+        self.names = []
+        """ the names of the profiles, by index """
+        self._profiles = []
+        self._index = dict()
+        self._bandwidth_traces = dict()
+        """ the traces already loaded, by path """
+
+    def add(self, name, up, down, lag, max_chunk=16, share=0, bandwidth_trace=None):
+        """ Adds a profile, or replaces the one with the same name.
+
+            Args:
+                name (str): name of the profile
+                up (float): speed from the client to the proxy, in kb/s
+                down (float): speed from the proxy to the client, in kb/s
+                lag (float): latency of both directions, in seconds
+                max_chunk (float): size of the chunks, in kb
+                share (float): part of the clients not in the client map
+                               having this profile
+                bandwidth_trace (str): path of a file of bandwidth over time
+                                       for the down link, optional
+
+            Returns:
+                the index of the profile
+        """
+        profile = {'name': name, 'up': float(up), 'down': float(down),
+                   'lag': float(lag), 'max_chunk': float(max_chunk),
+                   'share': float(share), 
+                   'bandwidth_trace': bandwidth_trace or None}
+        index = self._index.get(name)
+        if index is None:
+            index = len(self._profiles)
+            self._index[name] = index
+            self.names.append(name)
+            self._profiles.append(profile)
+        else:
+            self._profiles[index] = profile
+        return index
+
+    def load(self, file_path):
+        """ Adds the profiles of a CSV file """
+        with open(file_path, 'r') as f:
+            reader = csv.DictReader(filter(lambda row: row[0]!='#', f))
+            for row in reader:
+                self.add(row['profile'], row['up'], row['down'], row['lag'],
+                         row.get('max_chunk') or 16, row.get('share') or 0,
+                         row.get('bandwidth_trace'))
+
+    def bandwidth_trace(self, index):
+        """ Returns the :class:`model.BandwidthTrace` of a profile, or None """
+        path = self._profiles[index]['bandwidth_trace']
+        if path is None:
+            return None
+        if path not in self._bandwidth_traces:
+            self._bandwidth_traces[path] = BandwidthTrace.from_file(path)
+        return self._bandwidth_traces[path]
+
+    def input_files(self):
+        """ Returns the paths of the bandwidth traces used by the profiles """
+        return sorted(set(p['bandwidth_trace'] for p in self._profiles 
+                          if p['bandwidth_trace']))
+
+    def index(self, name):
+        """ Returns the index of a profile from its name """
+        return self._index[name]
+
+    def assign(self, client_keys, map_path=None):
+        """ Computes the profile of each client.
+
+            Args:
+                client_keys (list): the ids of the clients in the trace,
+                                    indexed by dense id
+                map_path (str): optional CSV file giving the profile of some
+                                clients
+
+            Returns:
+                numpy array of the profile indexes, indexed by dense id
+
+            See :func:`profiles.assign`.
+        """
+        return assign(client_keys, [p['share'] for p in self._profiles], 
+                      map_path, 'profile', self._index)
+
+    def __getitem__(self, index):
+        return self._profiles[index]
+
+    def __len__(self):
+        return len(self._profiles)
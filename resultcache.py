@@ -0,0 +1,192 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains a content-addressed store for simulation results.
+
+A simulation is identified by a fingerprint computed from the content of the
+trace and database files, the configuration of the orchestrator, the speed of
+the simulation and the source code of the proxy class (and its parents). When
+the same fingerprint is seen again, the result of
+:func:`orchestration.Orchestrator.gather_statistics` stored on disk is returned
+instead of running the simulation again. The output files written by the 
+simulation are stored with the result, and written again in the output 
+folder when the result is reused.
+
+.. code-block:: python
+
+    cache = resultcache.ResultCache('.results_cache', 50)
+    key = o.fingerprint()
+    result = cache.get(key, out_dir)
+    if result is None:
+        ...
+        result = o.gather_statistics(out_dir)
+        cache.put(key, result, o.output_files)
+
+Code documentation
+==================
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+def _hash_file(path, h, block_size=1<<20):
+    """ Feeds the content of a file to the hash object h """
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            h.update(block)
+            block = f.read(block_size)
+
+def _class_source(cls):
+    """ Concatenates the source code of a class and all its parents, so that
+        a modification in CachingProxy also changes the fingerprint of
+        FIFOProxy. Classes without available source (builtins) are skipped.
+    """
+    sources = []
+    for klass in inspect.getmro(cls):
+        try:
+            sources.append(inspect.getsource(klass))
+        except (OSError, TypeError):
+            sources.append(klass.__qualname__)
+    return '\n'.join(sources)
+
+def fingerprint(trace_path, db_path, conf, proxy_class, extra=None, input_files=()):
+    """ Computes the key identifying a simulation.
+
+        Args:
+            trace_path (str|list): path to the trace file, or list of paths
+            db_path (str): path to the database file
+            conf (dict): configuration of the orchestrator, as given by
+                         config.get_orchestration_config_dict()
+            proxy_class (class|list): the class of the proxy used, or the
+                                      classes of all the proxies
+            extra (dict): other values influencing the result, like the speed
+            input_files (list): paths of the other input files, like the 
+                                link profiles
+
+        Returns:
+            The hexadecimal digest (str) of the simulation
+    """
+    h = hashlib.sha256()
+    if isinstance(trace_path, str):
+        trace_path = [trace_path]
+    for path in trace_path:
+        h.update(b'trace')
+        _hash_file(path, h)
+    h.update(b'db')
+    _hash_file(db_path, h)
+    for path in input_files:
+        h.update(b'input')
+        _hash_file(path, h)
+    # the paths are not part of the key, only the content of the files
+    conf = {section: dict(options) for section, options in conf.items()}
+    conf.get('orchestration', {}).pop('trace_file', None)
+    conf.get('orchestration', {}).pop('db_file', None)
+    h.update(json.dumps(conf, sort_keys=True, default=str).encode('utf-8'))
+    h.update(json.dumps(extra or {}, sort_keys=True, default=str).encode('utf-8'))
+    if isinstance(proxy_class, type):
+        proxy_class = [proxy_class]
+    for cls in proxy_class:
+        h.update(_class_source(cls).encode('utf-8'))
+    return h.hexdigest()
+
+class ResultCache:
+    """ On-disk store of simulation results, indexed by fingerprint.
+
+        Each result is pickled in its own file, with the content of its 
+        output files. When the total size of the
+        store exceeds max_size, the least recently used results are removed.
+
+        Args:
+            directory (str): where to store the results
+            max_size (float): maximum size of the store, in MB
+    """
+
+    SUFFIX = '.result'
+
+    def __init__(self, directory='.results_cache', max_size=50):
+        self.directory = directory
+        self.max_size = max_size*1024*1024
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+self.SUFFIX)
+
+    def get(self, key, out_dir=None):
+        """ Returns the stored result for this key, or None if there is none.
+
+            Args:
+                out_dir (str): if given, the output files stored with the 
+                               result are written in this folder, a result
+                               stored without its files is not returned
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if not isinstance(entry, dict) or 'result' not in entry:
+            # stored by an older version, without its files
+            if out_dir is not None:
+                return None
+            entry = {'result': entry, 'files': {}}
+        if out_dir is not None:
+            if not entry['files']:
+                return None
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            for name, content in entry['files'].items():
+                with open(os.path.join(out_dir, name), 'wb') as f:
+                    f.write(content)
+        # to keep track of the recently used results for the eviction
+        os.utime(path, None)
+        return entry['result']
+
+    def put(self, key, result, files=()):
+        """ Stores a result and the content of its output files (see 
+            :attr:`orchestration.Orchestrator.output_files`), then evicts 
+            old results if the store is too big
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        contents = dict()
+        for file_path in files:
+            with open(file_path, 'rb') as f:
+                contents[os.path.basename(file_path)] = f.read()
+        path = self._path(key)
+        tmp_path = path+'.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'result': result, 'files': contents}, f)
+        # atomic, so that two parallel simulations can not corrupt the store
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used results until the store fits in
+            max_size.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -3,6 +3,9 @@
 
 import time
 import threading
+import heapq
+import itertools
+import traceback
 import config
 
 
@@ -44,6 +47,71 @@ def real_time(time):
     """ converts simulation time to real time """
     return time * config.speed
 
+class TimerQueue:
+    """ Calls functions at given times of the simulation (see :func:`time_`),
+        from one single thread for the whole simulation, instead of having
+        one thread sleeping per object.
+
+        The thread is started on the first call to :func:`call_later`.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func, *args):
+        """ Calls func(*args) in delay seconds (simulation time).
+
+            Returns:
+                a handle to give to :func:`cancel`
+        """
+        entry = [time_()+delay, next(self._seq), func, args]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return entry
+
+    def cancel(self, entry):
+        """ The function of this handle will not be called """
+        entry[2] = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when = self._heap[0][0]
+                    now = time_()
+                    if when <= now:
+                        entry = heapq.heappop(self._heap)
+                        if entry[2] is not None:
+                            break
+                    else:
+                        self._cond.wait((when-now)/config.speed)
+            try:
+                entry[2](*entry[3])
+            except Exception:
+                # one failing timer must not stop all the others
+                print("Exception in the timer "+repr(entry[2]))
+                traceback.print_exc()
+
+timers = TimerQueue()
+""" The timers of the simulation, used for instance by the clients to know
+    when their buffer will be empty.
+"""
+
 # def no_active_download(clients):
 #   """ returns true if no client from the list is currently downloading """
 #   """ Inefficient way to check if there are still downloads pending """
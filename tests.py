@@ -14,8 +14,23 @@ Listing of the tests
 from model import *
 from metrics import *
 import simu
+import resultcache
+import traces
+import orchestration
+import profiles
+import topology
+import cluster
+import digest
+import p2p
+import prefetch
+import locks
+import abr
 import unittest
 import time
+import threading
+import tempfile
+import os
+import gzip
 
 @PacketTimer('request', 'received_callback')
 class TimedPeer(Peer):
@@ -156,6 +171,46 @@ class TestClient(unittest.TestCase):
 
         self.assertGreater(counter1, counter2)
 
+    def test_video_played(self):
+        video = {'idVideo': 1, 'duration': 2, 'size': 2048, 'bitrate': 1024, 'title': 'Video', 'description': 'A video'}
+        self.s2.add_video(video=video)
+        self.c4.start_video_consumer()
+        self.c4.request_media(1, 2)
+
+        simu.sleep(4)
+        # fast enough network: no stop, and the session is archived once played
+        self.assertEqual(self.c4.counter, 0)
+        self.assertEqual(self.c4.media_played, [1])
+        self.assertNotIn(1, self.c4.media_asked_for)
+
+    def test_server_capacity(self):
+        self.s2.add_video(video={'idVideo': 1, 'duration': 1, 'size': 1024, 'bitrate': 1024, 'title': 'Video', 'description': 'A video'})
+        self.s2.add_video(video={'idVideo': 2, 'duration': 1, 'size': 1024, 'bitrate': 1024, 'title': 'Video', 'description': 'A video'})
+        self.s2.set_capacity(max_concurrency=1, service_time=0.2)
+        self.c4.request_media(1, 2)
+        self.c4.request_media(2, 2)
+
+        simu.sleep(3)
+        stats = self.s2.get_load_stats()
+        self.assertEqual(stats['nb_requests'], 2)
+        self.assertEqual(stats['nb_responses'], 2)
+        self.assertEqual(stats['max_queue'], 1)
+        self.assertEqual(stats['served_kb'], 2048)
+        # the second one waited for the first one: 2*(0.2+0.5) seconds
+        self.assertGreater(self.s2.get_load_stats()['response_time_max'], 1.3)
+        self.assertEqual(self.s2.get_load_intervals()[0]['requests'], 2)
+
+    def test_timers(self):
+        called = []
+        simu.timers.call_later(0.2, called.append, 2)
+        simu.timers.call_later(0.1, called.append, 1)
+        handle = simu.timers.call_later(0.1, called.append, 3)
+        simu.timers.cancel(handle)
+        # a failing timer does not stop the next ones
+        simu.timers.call_later(0.15, called.remove, 4)
+        simu.sleep(0.5)
+        self.assertEqual(called, [1, 2])
+
 
 
     def test_two_videos_buffer_nowait(self):
@@ -204,6 +259,34 @@ class TestClient(unittest.TestCase):
 
         pass
 
+    def test_local_cache(self):
+        c1 = LatenciesClient(1001, "c1")
+        p1 = LRUProxy(1, "p1")
+        s1 = VideoServer(1, "s1")
+        c1.connect_to(p1).set_lag(0.1).set_bandwidth(12000)
+        p1.connect_to(c1).set_lag(0.1).set_bandwidth(12000)
+        p1.connect_to(s1).set_lag(0.1).set_bandwidth(12000)
+        s1.connect_to(p1).set_lag(0.1).set_bandwidth(12000)
+        s1.add_video(video={'idVideo': 1337, 'duration': 60, 'size': 2048, 
+                            'bitrate': 2048/60, 'title': 'Video', 
+                            'description': 'A video'})
+        cache = LRUProxy(1001, "Cache c1")
+        cache.set_cache_size(4096)
+        c1.set_local_cache(cache)
+        c1.set_two_in_a_row_protection(False)
+
+        c1.request_media(1337, 1)
+        simu.sleep(2)
+        c1.request_media(1337, 1)
+        simu.sleep(0.5)
+
+        # the second request never reached the proxy
+        self.assertEqual(c1.local_hits, 1)
+        self.assertEqual(c1.local_hit_kb, 2048)
+        self.assertEqual(p1.get_hit_stats()['nb_served'], 1)
+        self.assertEqual(len(c1.latencies), 2)
+        self.assertLess(c1.latencies[1], 0.1)
+
 class TestTiming(unittest.TestCase):
 
     def setUp(self):
@@ -343,6 +426,26 @@ class TestForwardProxy(unittest.TestCase):
         self.assertEqual(self.c2.received_data['payload'], self.video2)
         self.assertEqual(self.c3.received_data['payload'], self.video1)
 
+    def test_processing(self):
+        self.s1.add_video(video=self.video1)
+        self.s1.add_video(video=self.video2)
+        self.p.set_processing(workers=1, request_cost=0.3)
+
+        self.c2.request_media(9001, 1)
+        self.c3.request_media(1337, 1)
+
+        simu.sleep(4)
+
+        self.assertEqual(self.c2.received_data['payload'], self.video2)
+        self.assertEqual(self.c3.received_data['payload'], self.video1)
+        stats = self.p.get_processing_stats()
+        self.assertEqual(stats['max_queue'], 1)
+        # one request waited for the other one
+        self.assertGreater(stats['queueing_delay_mean']*stats['nb_processed'], 0.25)
+        self.assertGreater(stats['queueing_delay_max'], 0.25)
+        self.assertLessEqual(stats['queueing_delay_p99'], stats['queueing_delay_max'])
+        self.assertGreater(stats['utilization'], 0)
+
 class TestUnlimitedProxy(unittest.TestCase):
 
     def setUp(self):
@@ -480,6 +583,886 @@ class TestFIFOProxy(unittest.TestCase):
         self.assertEqual(stats['byte_hit_ratio'], 0.5)
         self.assertEqual(stats['byte_cache'], self.video1['size']/8)
 
+    def test_observers(self):
+        self.s1.add_video(video=self.video1)
+        c3 = orchestration.MetricClient(1003, "c3")
+        c3.connect_to(self.p).set_lag(0.1).set_bandwidth(12000)
+        self.p.connect_to(c3).set_lag(0.1).set_bandwidth(12000)
+        c3.set_two_in_a_row_protection(False)
+        proxy_metrics = ProxyMetrics(capacity=1)
+        self.p.add_observer(proxy_metrics)
+
+        c3.request_media(1337, 1)
+        simu.sleep(3)
+        c3.request_media(1337, 1)
+        simu.sleep(1)
+
+        self.assertIsInstance(c3, Client)
+        self.assertEqual(len(c3.latencies), 2)
+        self.assertLess(c3.latencies[1], c3.latencies[0])
+        self.assertEqual(proxy_metrics.hits.tolist(), [False, True])
+        self.assertEqual(proxy_metrics.hit_ratio(), 0.5)
+        self.assertEqual(proxy_metrics.sizes.tolist(), [2048, 2048])
+        self.p.remove_observer(proxy_metrics)
+        self.assertEqual(self.p._on_hit_hooks, ())
+
+    def test_abandon(self):
+        self.s1.add_video(video=self.video1)
+        # plays after about 1 s, leaves half a second later
+        self.c1.request_media(1337, 1, watch_duration=0.5)
+
+        simu.sleep(3)
+
+        self.assertEqual(self.c1.nb_abandoned, 1)
+        self.assertTrue(self.c1.is_idle())
+        self.assertEqual(self.s1.get_load_stats()['nb_responses'], 1)
+        served_kb = self.s1.get_load_stats()['served_kb']
+        self.assertLess(served_kb, 1900)
+        # only what was fetched is counted, and the partial video is not cached
+        self.assertLess(self.p.get_hit_stats()['byte_served'], served_kb/8+1)
+        self.c2.request_media(1337, 1)
+        simu.sleep(3)
+        self.assertEqual(self.p.get_hit_stats()['byte_cache'], 0)
+
+class DequeFIFOProxy(CachingProxy):
+    """ A policy which does not implement _video_discarded """
+    def __init__(self, *args, **kargs):
+        CachingProxy.__init__(self, *args, **kargs)
+        self.fifo = deque()
+
+    def _cache_admission(self, video):
+        return True
+
+    def _id_to_evict(self):
+        return self.fifo.popleft()
+
+    def _new_video_inserted(self, video):
+        self.fifo.append(self._cache_key(video))
+
+    def _video_served(self, video):
+        pass
+
+class TestCustomPolicy(unittest.TestCase):
+
+    def test_discarded_not_told(self):
+        p = DequeFIFOProxy(0, "Proxy")
+        p.set_cache_size(2500)
+        videos = [{'idVideo': i, 'size': 1000} for i in range(4)]
+        p.cache_store(videos[0])
+        p.cache_store(videos[1])
+        p.cache_discard(videos[0])
+        p.cache_store(videos[2])
+        # the id of video 0 is skipped, video 1 is evicted
+        p.cache_store(videos[3])
+        self.assertEqual(p.cache_keys(), [2, 3])
+        self.assertEqual(p.cache_used(), 2000)
+
+class TestTieredProxy(unittest.TestCase):
+
+    def test_disk_hit(self):
+        c1 = LatenciesClient(1001, "c1")
+        c2 = LatenciesClient(1002, "c2")
+        p = TieredProxy(0, "Proxy")
+        ram = LRUProxy(0, "RAM")
+        ram.set_cache_size(3000)
+        p.add_tier('ram', ram)
+        p.add_tier('disk', LRUProxy(0, "Disk"), latency=0.2, bandwidth=1024)
+        p.set_cache_size(16000)
+        s1 = VideoServer(1, "s1")
+        for client in (c1, c2):
+            client.connect_to(p).set_lag(0.1).set_bandwidth(12000)
+            p.connect_to(client).set_lag(0.1).set_bandwidth(12000)
+            client.set_two_in_a_row_protection(False)
+        s1.connect_to(p).set_lag(0.01).set_bandwidth(12000)
+        p.connect_to(s1).set_lag(0.01).set_bandwidth(12000)
+        for id_video in (1, 2):
+            s1.add_video(video={'idVideo': id_video, 'duration': 60, 'size': 2048, 
+                                'bitrate': 2048/60, 'title': 'Video', 
+                                'description': 'A video'})
+
+        c1.request_media(1, 1)
+        simu.sleep(1)
+        # the first video is demoted to the disk
+        c1.request_media(2, 1)
+        simu.sleep(1)
+        c2.request_media(1, 1)
+        simu.sleep(3)
+
+        ram_stats, disk_stats = p.get_tier_stats()
+        self.assertEqual(ram_stats['hits'], 0)
+        self.assertEqual(disk_stats['hits'], 1)
+        # latency, and the disk slower than the connection
+        self.assertAlmostEqual(disk_stats['extra_latency'], 0.2+2048/1024-2048/12000)
+        self.assertEqual(ram_stats['promotions'], 1)
+        self.assertEqual(disk_stats['demotions'], 2)
+        self.assertTrue(ram.cache_has({'idVideo': 1}))
+        self.assertTrue(c2.latencies[0] > c1.latencies[1] + 1.8)
+
+class TestPartitionedProxy(unittest.TestCase):
+
+    def fetch(self, p, id_server, id_video):
+        """ a request, cached if missed """
+        request = {'idServer': id_server, 'idVideo': id_video}
+        if p.cache_lookup(request) is None:
+            p.cache_store({'idVideo': id_video, 'size': 1000})
+
+    def test_viral_server(self):
+        p = PartitionedProxy(0, "Proxy")
+        p.set_partitioning(LRUProxy, default_quota=3000)
+        p.set_cache_size(6000)
+        for id_video in (1, 2):
+            self.fetch(p, 1, id_video)
+        for id_video in range(10, 20):
+            self.fetch(p, 2, id_video)
+        self.fetch(p, 1, 1)
+
+        self.assertTrue(p.cache_has({'idServer': 1, 'idVideo': 2}))
+        self.assertEqual(p.cache_used(), 4000)
+        stats = {row['partition']: row for row in p.get_partition_stats()}
+        self.assertEqual(stats[1]['hits'], 1)
+        self.assertAlmostEqual(stats[1]['hit_ratio'], 1/3)
+        self.assertEqual(stats[2]['hits'], 0)
+        self.assertEqual(stats[2]['used'], 2000)
+
+    def test_elastic(self):
+        p = PartitionedProxy(0, "Proxy")
+        p.set_partitioning(LRUProxy, elastic=True)
+        p.add_partition(1, 3000)
+        p.add_partition(2, 3000)
+        p.set_cache_size(6000)
+        for id_video in range(10, 14):
+            self.fetch(p, 2, id_video)
+        stats = {row['partition']: row for row in p.get_partition_stats()}
+        self.assertEqual(stats[2]['borrowed'], 1000)
+
+        # the cache is full, the first partition takes its quota back
+        for id_video in (1, 2):
+            self.fetch(p, 1, id_video)
+        stats = {row['partition']: row for row in p.get_partition_stats()}
+        self.assertEqual(stats[2]['borrowed'], 0)
+        self.assertEqual(stats[1]['used'], 2000)
+        self.assertFalse(p.cache_has({'idServer': 2, 'idVideo': 10}))
+        self.assertEqual(p.cache_used(), 5000)
+
+    def test_partition_of(self):
+        p = PartitionedProxy(0, "Proxy")
+        p.set_partitioning(LRUProxy, default_quota=3000)
+        p.set_cache_size(6000)
+        for id_video in range(100):
+            self.fetch(p, 1, id_video)
+        video = p.cache_lookup({'idServer': 1, 'idVideo': 99})
+        p.cache_discard(video)
+        # only the videos still cached are remembered
+        self.assertEqual(p.cache_keys(), [98])
+        self.assertEqual(list(p._partition_of), [98])
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = Histogram(low=1e-3, high=10, bins_per_decade=10)
+        for i in range(1, 101):
+            h.add(i/100)
+        h.add(0)
+        self.assertEqual(len(h), 101)
+        self.assertAlmostEqual(h.mean(), 50.5/101)
+        self.assertEqual(h.max, 1)
+        # the upper bound of the bin, at most 26% above with 10 bins per decade
+        self.assertGreaterEqual(h.percentile(50), 0.5)
+        self.assertLess(h.percentile(50), 0.5*1.26)
+        self.assertEqual(h.percentile(100), 1)
+        self.assertEqual(h.percentile(0), 0)
+        h.clear()
+        self.assertEqual(h.percentile(50), 0)
+
+class TestLocks(unittest.TestCase):
+
+    def test_contention(self):
+        lock = locks.InstrumentedLock()
+        held = threading.Event()
+        def hold():
+            with lock:
+                held.set()
+                time.sleep(0.1)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        with lock:
+            pass
+        thread.join()
+        stats = lock.get_stats()
+        self.assertEqual(stats['acquisitions'], 2)
+        self.assertEqual(stats['contended'], 1)
+        self.assertGreater(stats['wait_time'], 0.05)
+
+    def test_concurrent_cache(self):
+        p = LRUProxy(0, "Proxy")
+        p.set_cache_size(50000)
+        def work(first):
+            for id_video in range(first, first+300):
+                p.cache_store({'idVideo': id_video % 500, 'size': 100+id_video % 500 % 7})
+                if p.cache_lookup({'idVideo': (id_video*7) % 500}) is not None:
+                    p._from_cache(size_kb=8)
+                else:
+                    p._from_server(size_kb=8)
+        threads = [threading.Thread(target=work, args=(i*100,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sizes = [100+id_video % 7 for id_video in p.cache_keys()]
+        self.assertEqual(p.cache_used(), sum(sizes))
+        self.assertLess(p.cache_used(), 50000)
+        self.assertEqual(p.get_hit_stats()['nb_served'], 8*300)
+        self.assertEqual(p.get_hit_stats()['byte_served'], 8*300)
+        self.assertGreater(p.get_lock_stats()['cache_acquisitions'], 0)
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.conf = {'orchestration': {'method': 'event_lock', 'trace_file': 'fake_trace_fast.dat', 'db_file': 'fake_video_db.dat'},
+                     'proxy': {'proxy_type': 'FIFOProxy', 'cache_size': 64000.0}}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_fingerprint(self):
+        key1 = resultcache.fingerprint('fake_trace_fast.dat', 'fake_video_db.dat', self.conf, FIFOProxy)
+        key2 = resultcache.fingerprint('fake_trace_fast.dat', 'fake_video_db.dat', self.conf, FIFOProxy)
+        self.assertEqual(key1, key2)
+
+        # another policy, trace or configuration gives another key
+        self.assertNotEqual(key1, resultcache.fingerprint('fake_trace_fast.dat', 'fake_video_db.dat', self.conf, LRUProxy))
+        self.assertNotEqual(key1, resultcache.fingerprint('fake_trace.dat', 'fake_video_db.dat', self.conf, FIFOProxy))
+        self.conf['proxy']['cache_size'] = 32000.0
+        self.assertNotEqual(key1, resultcache.fingerprint('fake_trace_fast.dat', 'fake_video_db.dat', self.conf, FIFOProxy))
+
+    def test_get_put_evict(self):
+        cache = resultcache.ResultCache(self.dir.name, 1)
+        self.assertIsNone(cache.get('a'))
+        result = ({1001: [0.5, 1.2]}, {'hit_ratio': 0.5})
+        cache.put('a', result)
+        self.assertEqual(cache.get('a'), result)
+
+        # 1 MB store, two results of 0.6 MB can not fit
+        big = 'x'*int(0.6*1024*1024)
+        cache.put('b', big)
+        os.utime(os.path.join(self.dir.name, 'b'+cache.SUFFIX), (0, 0))
+        cache.put('c', big)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), big)
+
+    def test_output_files(self):
+        cache = resultcache.ResultCache(self.dir.name)
+        out_dir = os.path.join(self.dir.name, 'stats')
+        os.makedirs(out_dir)
+        for name in ('FIFOProxy_proxy', 'FIFOProxyOld_proxy'):
+            with open(os.path.join(out_dir, name), 'w') as f:
+                f.write(name)
+        # only the files given are stored, not the stale ones of other runs
+        files = [os.path.join(out_dir, 'FIFOProxy_proxy')]
+        cache.put('a', 'result', files)
+        cache.put('b', 'result')
+
+        # the files are written again when the result is reused
+        other_dir = os.path.join(self.dir.name, 'other')
+        self.assertEqual(cache.get('a', other_dir), 'result')
+        self.assertEqual(os.listdir(other_dir), ['FIFOProxy_proxy'])
+        self.assertIsNone(cache.get('b', other_dir))
+        self.assertEqual(cache.get('b'), 'result')
+
+class TestTraces(unittest.TestCase):
+
+    def test_interner(self):
+        videos = traces.IdInterner()
+        self.assertEqual(videos.intern((1, '42')), 0)
+        # same video id on another server is another video
+        self.assertEqual(videos.intern((2, '42')), 1)
+        self.assertEqual(videos.intern((1, '42')), 0)
+        self.assertEqual(videos.key(1), (2, '42'))
+        self.assertIsNone(videos.get((3, '42')))
+        self.assertEqual(len(videos), 2)
+
+    def test_load_trace_arrays(self):
+        trace = tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False)
+        # unsorted, with two requests in a row for the same video by client 1
+        trace.write('# comment\n'
+                    '"id_client","req_timestamp","id_video","id_server"\n'
+                    '1,1005,"7",1\n'
+                    '1,1000,"7",1\n'
+                    '2,1002,"7",2\n'
+                    '2,1003,"8",1\n'
+                    '2,1009,"007",1\n')
+        trace.close()
+        clients = traces.IdInterner()
+        videos = traces.IdInterner()
+        arrays = traces.load_trace_arrays(trace.name, clients, videos)
+        os.remove(trace.name)
+
+        self.assertEqual(arrays['delay'].tolist(), [0, 2, 3, 9])
+        self.assertEqual(arrays['delta'].tolist(), [0, 2, 1, 6])
+        c1 = clients.get('1')
+        c2 = clients.get('2')
+        self.assertEqual(arrays['id_client'].tolist(), [c1, c2, c2, c2])
+        self.assertEqual(arrays['id_video'].tolist(), [videos.get((1, '7')), videos.get((2, '7')), videos.get((1, '8')), videos.get((1, '7'))])
+
+    def test_big_ids(self):
+        trace = tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False)
+        # the same number in a float64
+        trace.write('"id_client","req_timestamp","id_video","id_server"\n'
+                    '9007199254740993,1000,18014398509481985,1\n'
+                    '9007199254740992,1001,18014398509481984,1\n')
+        trace.close()
+        clients = traces.IdInterner()
+        videos = traces.IdInterner()
+        arrays = traces.load_trace_arrays(trace.name, clients, videos)
+        os.remove(trace.name)
+
+        self.assertEqual(len(clients), 2)
+        self.assertEqual(clients.key(arrays['id_client'][0]), '9007199254740993')
+        self.assertEqual(videos.key(arrays['id_video'][1]), (1, '18014398509481984'))
+
+    def test_stream_merge(self):
+        header = '"id_client","req_timestamp","id_video","id_server"\n'
+        tmp = tempfile.TemporaryDirectory()
+        with gzip.open(os.path.join(tmp.name, 'node1.dat.gz'), 'wt') as f:
+            f.write(header+'1,1000,7,1\n1,1004,8,1\n2,1005,8,1\n')
+        with open(os.path.join(tmp.name, 'node2.dat'), 'w') as f:
+            f.write('# second node\n'+header+'3,1001,7,1\n1,1003,8,1\n')
+        clients = traces.IdInterner()
+        videos = traces.IdInterner()
+        paths = traces.expand_paths(os.path.join(tmp.name, 'node*'))
+        events = list(traces.stream_events(paths, clients, videos))
+        tmp.cleanup()
+
+        self.assertEqual(len(paths), 2)
+        # the request at 1004 is the second one in a row for video 8 by client 1
+        self.assertEqual([e[0] for e in events], [0, 1, 3, 5])
+        self.assertEqual([e[1] for e in events], [0, 1, 2, 2])
+        self.assertEqual([clients.key(e[2]) for e in events], ['1', '3', '1', '2'])
+        self.assertEqual([videos.key(e[3]) for e in events], [(1, '7'), (1, '7'), (1, '8'), (1, '8')])
+
+    def test_watch_duration(self):
+        trace = tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False)
+        trace.write('"id_client","req_timestamp","id_video","id_server","watch_duration"\n'
+                    '1,1000,7,1,12.5\n'
+                    '2,1001,7,1,\n')
+        trace.close()
+        arrays = traces.load_trace_arrays(trace.name, traces.IdInterner(), traces.IdInterner())
+        events = list(traces.stream_events([trace.name], traces.IdInterner(), traces.IdInterner()))
+        os.remove(trace.name)
+
+        self.assertEqual(arrays['watch_duration'].tolist(), [12.5, 0])
+        self.assertEqual([e[5] for e in events], [12.5, 0])
+
+    def test_window(self):
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'trace.dat')
+        with open(path, 'w') as f:
+            f.write('"id_client","req_timestamp","id_video","id_server"\n')
+            # one request every 10 seconds during 10 minutes
+            for i in range(60):
+                f.write(str(i%7)+','+str(1000+10*i)+','+str(i)+',1\n')
+
+        self.assertEqual(traces.trace_start([path], 60), 1000)
+        self.assertTrue(os.path.exists(path+traces.INDEX_SUFFIX))
+        timestamps, offsets = traces.load_index(path, 60)
+        self.assertEqual(timestamps.tolist(), [1000+60*i for i in range(10)])
+
+        clients = traces.IdInterner()
+        videos = traces.IdInterner()
+        arrays = traces.load_trace_arrays(path, clients, videos, start=1125, end=1300, origin=1100)
+        events = list(traces.stream_events([path], clients, videos, start=1125, end=1300, origin=1100))
+        tmp.cleanup()
+
+        self.assertEqual(arrays['timestamp'].tolist(), list(range(1130, 1300, 10)))
+        self.assertEqual(arrays['delay'][0], 30)
+        self.assertEqual([e[0] for e in events], arrays['delay'].tolist())
+
+    def test_unsorted_window(self):
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'trace.dat')
+        with open(path, 'w') as f:
+            f.write('"id_client","req_timestamp","id_video","id_server"\n')
+            for i in reversed(range(60)):
+                f.write(str(i%7)+','+str(1000+10*i)+','+str(i)+',1\n')
+
+        # a single plain file is read entirely, the others cannot be indexed
+        self.assertEqual(traces.trace_start([path], 60), 1000)
+        arrays = traces.load_trace_arrays(path, traces.IdInterner(), traces.IdInterner(), 
+                                          start=1125, end=1300, origin=1100)
+        self.assertRaises(ValueError, list, 
+                          traces.stream_events([path], traces.IdInterner(), traces.IdInterner(), 
+                                               start=1125, end=1300))
+        self.assertFalse(os.path.exists(path+traces.INDEX_SUFFIX))
+        tmp.cleanup()
+
+        self.assertEqual(arrays['timestamp'].tolist(), list(range(1130, 1300, 10)))
+        self.assertEqual(arrays['delay'][0], 30)
+
+    def test_db_join(self):
+        db = tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False)
+        db.write('"id_server","id_video","size","duration","bitrate","title","description"\n'
+                 '1,1,4578,13,360,"First video","desc"\n'
+                 '1,2,33451,45,800,"Second video","desc"\n'
+                 '1,1,1600,13,100,"First video","desc"\n'
+                 '2,5,100,1,100,"Not in the trace","desc"\n')
+        db.close()
+        o = orchestration.Orchestrator(method='event_lock', conf={'clients': {'consume_videos': False}})
+        o.skip_inactivity = False
+        o.load_trace('fake_trace_fast.dat')
+        o.load_video_db(db.name)
+        os.remove(db.name)
+
+        # server 2 is not requested in the trace
+        self.assertEqual(list(o._servers.keys()), [1])
+        self.assertNotIn(o._videos.get((1, '1')), o._missing_videos)
+        self.assertIn(o._videos.get((1, '5')), o._missing_videos)
+        self.assertIsNone(o._videos.get((2, '5')))
+        # two renditions of the first video, sorted by bitrate
+        video = o._servers[1].get_video(o._videos.get((1, '1')))
+        self.assertEqual(video['size'], 4578)
+        self.assertEqual([r['bitrate'] for r in video['renditions']], [100, 360])
+
+class TestTopology(unittest.TestCase):
+
+    def test_load_assign(self):
+        topo = topology.Topology()
+        topo.load('fake_topology.dat')
+        self.assertEqual(topo.edges, ['edge1', 'edge2'])
+        self.assertEqual(topo.roots, ['regional'])
+        self.assertEqual(topo.levels(), {'edge1': 0, 'edge2': 0, 'regional': 1})
+        assigned = topo.assign([str(i) for i in range(100)])
+        self.assertAlmostEqual(np.bincount(assigned)[0]/100, 0.6, 1)
+
+        topo.add('loop', 'LRUProxy', parent='regional')
+        topo.add('regional', 'LRUProxy', parent='loop')
+        self.assertRaises(ValueError, topo.check)
+
+    def test_parent_hit(self):
+        c1 = LatenciesClient(1001, "c1")
+        c2 = LatenciesClient(1002, "c2")
+        edge1 = FIFOProxy('edge1', "Edge 1")
+        edge2 = FIFOProxy('edge2', "Edge 2")
+        parent = LRUProxy('parent', "Parent")
+        s1 = VideoServer(1, "s1")
+        for client, edge in ((c1, edge1), (c2, edge2)):
+            client.connect_to(edge).set_lag(0.1).set_bandwidth(12000)
+            edge.connect_to(client).set_lag(0.1).set_bandwidth(12000)
+            edge.connect_to(parent).set_lag(0.01).set_bandwidth(12000)
+            parent.connect_to(edge).set_lag(0.01).set_bandwidth(12000)
+            edge.set_parent('parent')
+        s1.connect_to(parent).set_lag(0.01).set_bandwidth(1024)
+        parent.connect_to(s1).set_lag(0.01).set_bandwidth(1024)
+        s1.add_video(video={'idVideo': 1337, 'duration': 60, 'size': 2048, 
+                            'bitrate': 2048/60, 'title': 'Video', 
+                            'description': 'A video'})
+
+        c1.request_media(1337, 1)
+        simu.sleep(3)
+        c2.request_media(1337, 1)
+        simu.sleep(2)
+
+        # missed by the second edge, served by the parent
+        self.assertEqual(edge2.get_hit_stats()['cache_hits'], 0)
+        self.assertEqual(parent.get_hit_stats()['cache_hits'], 1)
+        self.assertEqual(edge2.upstream_kb, 2048)
+        self.assertEqual(parent.upstream_kb, 2048)
+        self.assertTrue(c1.latencies[0] > c2.latencies[0])
+
+class TestSiblings(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        bloom = digest.BloomFilter.from_keys(range(1000), fp_rate=0.01)
+        self.assertTrue(all(key in bloom for key in range(1000)))
+        false_positives = sum(key in bloom for key in range(1000, 11000))
+        self.assertLess(false_positives/10000, 0.03)
+
+    def test_sibling_hit(self):
+        c1 = LatenciesClient(1001, "c1")
+        c2 = LatenciesClient(1002, "c2")
+        e1 = FIFOProxy('e1', "Edge 1")
+        e2 = FIFOProxy('e2', "Edge 2")
+        s1 = VideoServer(1, "s1")
+        for client, edge in ((c1, e1), (c2, e2)):
+            client.connect_to(edge).set_lag(0.1).set_bandwidth(12000)
+            edge.connect_to(client).set_lag(0.1).set_bandwidth(12000)
+            s1.connect_to(edge).set_lag(0.01).set_bandwidth(1024)
+            edge.connect_to(s1).set_lag(0.01).set_bandwidth(1024)
+        e1.connect_to(e2).set_lag(0.01).set_bandwidth(12000)
+        e2.connect_to(e1).set_lag(0.01).set_bandwidth(12000)
+        e1.set_siblings(['e2'], digest_interval=0.5)
+        e2.set_siblings(['e1'], digest_interval=0.5)
+        for id_video in (1, 2):
+            s1.add_video(video={'idVideo': id_video, 'duration': 60, 'size': 2048, 
+                                'bitrate': 2048/60, 'title': 'Video', 
+                                'description': 'A video'})
+
+        c1.request_media(1, 1)
+        simu.sleep(3)
+        c2.request_media(1, 1)
+        simu.sleep(2)
+        stats = e2.get_sibling_stats()
+        self.assertEqual(stats['sibling_hits'], 1)
+        self.assertEqual(stats['sibling_kb'], 2048)
+        self.assertEqual(e1.get_sibling_stats()['sibling_served_kb'], 2048)
+        self.assertEqual(s1.get_load_stats()['nb_responses'], 1)
+
+        # a digest claiming a video the sibling does not have
+        e2._sibling_digests['e1'] = digest.BloomFilter.from_keys([2])
+        c2.request_media(2, 1)
+        simu.sleep(3)
+        self.assertEqual(e2.get_sibling_stats()['false_positives'], 1)
+        self.assertEqual(len(c2.latencies), 2)
+        self.assertEqual(s1.get_load_stats()['nb_responses'], 2)
+
+        # no more digests once stopped
+        for edge in (e1, e2):
+            edge.stop_digests()
+        digest_kb = e1.get_sibling_stats()['digest_kb']
+        e1._cache_changed = True
+        simu.sleep(1)
+        self.assertEqual(e1.get_sibling_stats()['digest_kb'], digest_kb)
+
+class TestCluster(unittest.TestCase):
+
+    def test_ring_churn(self):
+        router = cluster.ConsistentHashRouter(virtual_nodes=100)
+        for node in ('node1', 'node2', 'node3'):
+            router.add_node(node)
+        keys = [(1, i) for i in range(3000)]
+        owners = [router.route(key) for key in keys]
+        requests, imbalance = router.get_load_stats()
+        self.assertEqual(sum(requests.values()), 3000)
+        self.assertLess(imbalance, 1.3)
+
+        # only the keys of the new node move
+        change = router.add_node('node4', keys, time=60)
+        self.assertAlmostEqual(change['churn'], 1/4, 1)
+        for key, owner in zip(keys, owners):
+            node = router.node_for(key)
+            self.assertIn(node, (owner, 'node4'))
+        change = router.remove_node('node2', keys, np.full(3000, 10.))
+        self.assertEqual(change['moved_kb'], 10*change['moved_keys'])
+        self.assertEqual(router.nodes, ['node1', 'node3', 'node4'])
+        self.assertEqual(len(router.get_changes()), 2)
+
+    def test_routed_connection(self):
+        c1 = LatenciesClient(1001, "c1")
+        s1 = VideoServer(1, "s1")
+        nodes = [FIFOProxy('node1', "Node 1"), FIFOProxy('node2', "Node 2")]
+        router = cluster.ConsistentHashRouter()
+        connections = dict()
+        for node in nodes:
+            router.add_node(node.get_id())
+            connections[node.get_id()] = c1.connect_to(node).set_lag(0.01).set_bandwidth(12000)
+            node.connect_to(c1).set_lag(0.01).set_bandwidth(12000)
+            s1.connect_to(node).set_lag(0.01).set_bandwidth(12000)
+            node.connect_to(s1).set_lag(0.01).set_bandwidth(12000)
+        c1.set_connection(cluster.RoutedConnection(router, connections))
+        for id_video in range(1, 9):
+            s1.add_video(video={'idVideo': id_video, 'duration': 1, 'size': 100, 
+                                'bitrate': 100, 'title': 'Video', 
+                                'description': 'A video'})
+        for id_video in range(1, 9):
+            c1.request_media(id_video, 1)
+            simu.sleep(1)
+        c1.request_media(1, 1)
+        simu.sleep(1)
+
+        self.assertEqual(len(c1.latencies), 9)
+        served = [node.get_hit_stats()['nb_served'] for node in nodes]
+        self.assertEqual(sum(served), 9)
+        # the second request went to the node of the first one
+        node = router.node_for((1, 1))
+        self.assertEqual(nodes[[n.get_id() for n in nodes].index(node)].get_hit_stats()['cache_hits'], 1)
+
+class TestP2P(unittest.TestCase):
+
+    def test_tracker(self):
+        tracker = p2p.Tracker()
+        for id_ in (1001, 1002, 1003):
+            tracker.add_peer(Client(id_), up=600)
+        key = tracker.key({'idServer': 1, 'idVideo': 7})
+        self.assertIsNone(tracker.find(key, 1001))
+        tracker.announce(key, 1001)
+        self.assertIsNone(tracker.find(key, 1001))
+        tracker.announce(key, 1002)
+        tracker.announce(key, 1003)
+        # in turn, never the requester
+        self.assertEqual({tracker.find(key, 1001) for i in range(4)}, {1002, 1003})
+        tracker.withdraw(key, 1002)
+        tracker.remove_peer(1003)
+        self.assertEqual(tracker.find(key, 1003), 1001)
+        self.assertIsNone(tracker.find(key, 1001))
+
+    def test_peer_upload(self):
+        c1 = LatenciesClient(1001, "c1")
+        c2 = LatenciesClient(1002, "c2")
+        p1 = LRUProxy(1, "p1")
+        s1 = VideoServer(1, "s1")
+        tracker = p2p.Tracker(lag=0.05)
+        for client in (c1, c2):
+            client.connect_to(p1).set_lag(0.1).set_bandwidth(12000)
+            p1.connect_to(client).set_lag(0.1).set_bandwidth(12000)
+            cache = LRUProxy(client.get_id(), "Cache")
+            cache.set_cache_size(4096)
+            client.set_local_cache(cache)
+            tracker.add_peer(client, up=12000)
+            client.set_tracker(tracker)
+        p1.connect_to(s1).set_lag(0.1).set_bandwidth(12000)
+        s1.connect_to(p1).set_lag(0.1).set_bandwidth(12000)
+        s1.add_video(video={'idVideo': 1337, 'duration': 60, 'size': 2048, 
+                            'bitrate': 2048/60, 'title': 'Video', 
+                            'description': 'A video'})
+
+        c1.request_media(1337, 1)
+        simu.sleep(2)
+        c2.request_media(1337, 1)
+        simu.sleep(1)
+
+        # the second client got it from the first one, not from the proxy
+        self.assertEqual(p1.get_hit_stats()['nb_served'], 1)
+        self.assertEqual(c2.p2p_stats['p2p_kb'], 2048)
+        self.assertEqual(c2.p2p_stats['proxy_kb'], 0)
+        self.assertEqual(c1.p2p_stats['upload_kb'], 2048)
+        self.assertEqual(len(c2.p2p_startups), 1)
+        self.assertTrue(c1.latencies[0] > c2.latencies[0])
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_space_saving(self):
+        counts = prefetch.SpaceSaving(k=4, half_life=10)
+        for i in range(20):
+            counts.add('old', 0)
+        for i in range(10):
+            # many keys seen once, they replace each other
+            counts.add(i, 1)
+        for i in range(5):
+            counts.add('new', 60)
+        # 20 requests decayed by 6 half lives count less than 5 recent ones
+        self.assertEqual([key for key, _ in counts.top(2, 60)], ['new', 'old'])
+        self.assertAlmostEqual(counts.top(2, 60)[1][1], 20/2**6)
+        self.assertEqual(len(counts), 4)
+
+    def test_prefetch_hit(self):
+        c1 = LatenciesClient(1001, "c1")
+        p = LRUProxy(0, "Proxy")
+        s1 = VideoServer(1, "s1")
+        c1.connect_to(p).set_lag(0.1).set_bandwidth(12000)
+        p.connect_to(c1).set_lag(0.1).set_bandwidth(12000)
+        s1.connect_to(p).set_lag(0.01).set_bandwidth(1024)
+        p.connect_to(s1).set_lag(0.01).set_bandwidth(1024)
+        p.set_cache_size(16000)
+        for id_video in (1, 2):
+            s1.add_video(video={'idVideo': id_video, 'duration': 60, 'size': 2048, 
+                                'bitrate': 2048/60, 'title': 'Video', 
+                                'description': 'A video'})
+
+        self.assertTrue(p.prefetch({'idServer': 1, 'idVideo': 1}))
+        self.assertFalse(p.prefetch({'idServer': 1, 'idVideo': 1}))
+        p.prefetch({'idServer': 1, 'idVideo': 2})
+        simu.sleep(5)
+        c1.request_media(1, 1)
+        simu.sleep(1)
+
+        stats = p.get_prefetch_stats()
+        self.assertEqual(stats['prefetched'], 2)
+        self.assertEqual(stats['prefetch_kb'], 4096)
+        self.assertEqual(stats['useful'], 1)
+        self.assertEqual(stats['accuracy'], 0.5)
+        self.assertGreater(stats['latency_saved'], 0)
+        self.assertEqual(p.get_hit_stats()['cache_hits'], 1)
+        self.assertLess(c1.latencies[0], 1)
+
+        # video 2 is evicted by a bigger one, its hits later would not be
+        # thanks to the prefetching
+        s1.add_video(video={'idVideo': 3, 'duration': 60, 'size': 15000, 
+                            'bitrate': 15000/60, 'title': 'Video', 
+                            'description': 'A video'})
+        s1.connection.set_bandwidth(100000)
+        c1.request_media(3, 1)
+        simu.sleep(1)
+        self.assertFalse(p.cache_has({'idVideo': 2}))
+        self.assertEqual(len(p._prefetched), 0)
+
+class TestProfiles(unittest.TestCase):
+
+    def test_assign(self):
+        link_profiles = profiles.LinkProfiles()
+        link_profiles.add('default', 600, 2000, 0.1)
+        link_profiles.load('fake_profiles.dat')
+        self.assertEqual(link_profiles.names, ['default', 'fibre', 'adsl', 'mobile'])
+
+        client_map = tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False)
+        client_map.write('"id_client","profile"\n007,"mobile"\n3,"default"\n')
+        client_map.close()
+        keys = [str(i) for i in range(1000)]
+        assigned = link_profiles.assign(keys, client_map.name)
+        os.remove(client_map.name)
+
+        self.assertEqual(assigned[7], link_profiles.index('mobile'))
+        self.assertEqual(assigned[3], 0)
+        # the others follow the shares: 0.2, 0.5 and 0.3
+        counts = np.bincount(assigned, minlength=4)
+        self.assertEqual(counts[0], 1)
+        self.assertAlmostEqual(counts[1]/1000, 0.2, 1)
+        self.assertAlmostEqual(counts[2]/1000, 0.5, 1)
+        self.assertAlmostEqual(counts[3]/1000, 0.3, 1)
+
+class TestBandwidthTrace(unittest.TestCase):
+
+    def test_transmission_time(self):
+        trace = BandwidthTrace([0, 1, 2], [100, 0, 300], 3)
+        self.assertAlmostEqual(trace.transmission_time(0, 100), 1)
+        # 50 kb until 1, nothing until 2, then 50 kb at 300 kb/s
+        self.assertAlmostEqual(trace.transmission_time(0.5, 100), 1.5+1/6)
+        # 150 kb until the end, then the trace starts again
+        self.assertAlmostEqual(trace.transmission_time(2.5, 250), 1.5)
+        self.assertAlmostEqual(trace.transmission_time(3000.5, 100), 1.5+1/6)
+        self.assertEqual(trace.rate_at(4.5), 0)
+
+    def test_connection(self):
+        s = VideoServer(1, "s")
+        c = StopClient(1001, "c")
+        c.connect_to(s).set_lag(0)
+        # 1024 kb/s during one second, then 0 during one second
+        trace = BandwidthTrace([0, 1], [1024, 0])
+        s.connect_to(c).set_lag(0).set_max_chunk(64).set_bandwidth_trace(trace, -simu.time_())
+        s.add_video(video={'idVideo': 1, 'duration': 2, 'size': 1536, 'bitrate': 768, 'title': 'Video', 'description': 'A video'})
+        c.request_media(1, 1)
+        simu.sleep(1.5)
+        self.assertIn(c.media_asked_for[1]['received'], range(900, 1100))
+        simu.sleep(1.2)
+        self.assertEqual(c.media_asked_for[1]['received'], 1536)
+
+class TestSharedLink(unittest.TestCase):
+
+    def test_weighted_sharing(self):
+        link = SharedLink(1000)
+        c1 = Connection(bandwidth=2000)
+        c2 = Connection(bandwidth=2000).set_weight(3)
+        c3 = Connection(bandwidth=100)
+
+        self.assertAlmostEqual(link.transmission_delay(c1, 100), 0.1)
+        self.assertAlmostEqual(link.transmission_delay(c2, 100), 100/750)
+        self.assertAlmostEqual(link.transmission_delay(c1, 100), 0.4)
+        link.release(c2)
+        self.assertAlmostEqual(link.transmission_delay(c1, 100), 0.1)
+        # never faster than its own bandwidth
+        self.assertAlmostEqual(link.transmission_delay(c3, 100), 1)
+        # and what c3 cannot use goes to c1
+        self.assertAlmostEqual(link.transmission_delay(c1, 90), 0.1)
+
+        stats = link.get_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertAlmostEqual(stats[0]['utilization'], 590/10000)
+        self.assertEqual(stats[0]['flows'], 2)
+
+class TestABR(unittest.TestCase):
+
+    def test_rules(self):
+        rule = abr.ThroughputRule(safety=0.5)
+        self.assertEqual(rule.choose([100, 1000], 0, 0), 0)
+        rule.segment_downloaded(1000, 0.5)
+        self.assertEqual(rule.choose([100, 1000, 2000], 0, 0), 1)
+
+        rule = abr.BufferRule(reservoir=5, cushion=10)
+        self.assertEqual(rule.choose([100, 500, 1000], 2, 2), 0)
+        self.assertEqual(rule.choose([100, 500, 1000], 10, 0), 1)
+        self.assertEqual(rule.choose([100, 500, 1000], 20, 0), 2)
+
+    def test_segments(self):
+        s = VideoServer(1, "s")
+        p = LRUProxy(0, "Proxy")
+        p.set_cache_size(100000)
+        c1 = Client(1001, "c1")
+        c2 = Client(1002, "c2")
+        for c in (c1, c2):
+            c.connect_to(p).set_lag(0.01).set_bandwidth(4096)
+            p.connect_to(c).set_lag(0.01).set_bandwidth(4096)
+            c.set_abr(abr.create('throughput'))
+        s.connect_to(p).set_lag(0.01).set_bandwidth(4096)
+        p.connect_to(s).set_lag(0.01).set_bandwidth(4096)
+        s.set_segment_duration(2)
+        s.add_video(video={'idVideo': 1, 'duration': 8, 'size': 800, 'bitrate': 100, 
+                           'title': 'Video', 'description': 'A video',
+                           'renditions': [{'size': 800, 'bitrate': 100},
+                                          {'size': 8000, 'bitrate': 1000}]})
+        c1.request_media(1, 1)
+        simu.sleep(4)
+        # the first segment in the lowest rendition, then the highest one
+        self.assertEqual(c1.delivered_seconds, 8)
+        self.assertEqual(c1.nb_switches, 1)
+        self.assertAlmostEqual(c1.avg_bitrate, (2*100+6*1000)/8)
+        self.assertEqual(s.get_load_stats()['served_kb'], 200+3*2000)
+
+        # the segments are cached by rendition
+        c2.request_media(1, 1)
+        simu.sleep(4)
+        self.assertEqual(c2.delivered_seconds, 8)
+        self.assertGreaterEqual(p.get_hit_stats()['byte_cache'], 200/8)
+        self.assertEqual(p._cache_key({'idVideo': 1, 'rendition': 1, 'segment': 2}), (1, 1, 2))
+
+    def test_local_segments(self):
+        s = VideoServer(1, "s")
+        s.set_segment_duration(1)
+        video = {'idVideo': 1, 'duration': 600, 'size': 600, 'bitrate': 1, 
+                 'title': 'Video', 'description': 'A video'}
+        cache = LRUProxy(1001, "Cache c1")
+        cache.set_cache_size(1000)
+        for segment in range(600):
+            cache.cache_store(s._segment(video, 0, segment))
+        c1 = Client(1001, "c1")
+        c1.set_abr(abr.create('throughput'), max_buffer=1000)
+        c1.set_local_cache(cache)
+        # a video entirely in the local cache, more segments than the
+        # recursion limit would allow when delivered by nested calls
+        c1.request_media(1, 1)
+        simu.sleep(1)
+        self.assertEqual(c1.local_hits, 600)
+        self.assertEqual(c1.delivered_seconds, 600)
+
+class TestOrchestrator(unittest.TestCase):
+
+    def test_lazy_clients(self):
+        link = {'up': 2000, 'down': 2000, 'lag_up': 0.1, 'lag_down': 0.1, 'max_chunk': 16}
+        conf = {'clients': dict(link, consume_videos=False, idle_timeout=0.5,
+                                local_cache='LRUProxy', local_cache_size=10**7),
+                'servers': dict(link), 'proxy': {}}
+        o = orchestration.Orchestrator(method='event_lock', conf=conf)
+        o.skip_inactivity = False
+        o.load_trace('fake_trace_fast.dat')
+        o.load_video_db('fake_video_db.dat')
+        o._proxy = ForwardProxy(0, "Proxy")
+        o._connect_network()
+        self.assertEqual(o._clients.count(None), len(o._clients))
+
+        id_video = min(set(range(len(o._videos))) - o._missing_videos)
+        id_server = o._videos.key(id_video)[0]
+        o._request(0, id_video, id_server)
+        self.assertIsNotNone(o._clients[0])
+        cache = o._clients[0].local_cache
+
+        for i in range(60):
+            if o._clients[0] is None:
+                break
+            simu.sleep(1)
+        # parked, with its metrics and its connections kept
+        self.assertIsNone(o._clients[0])
+        self.assertEqual(len(o._get_client_metrics(0)[0]), 1)
+        self.assertEqual(len(o._pool), 2)
+
+        o._request(1, id_video, id_server)
+        self.assertEqual(o._pool.nb_created, 2)
+        self.assertEqual(o.nb_clients_peak, 1)
+
+        # the local cache survived the parking
+        o._request(0, id_video, id_server)
+        self.assertIs(o._clients[0].local_cache, cache)
+        self.assertEqual(o._clients[0].local_hits, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,152 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the topology of the caches: the edge proxies, to which
+the clients are connected, and the parent proxies to which the edges forward
+their misses. The proxies without parent forward their misses to the video
+servers.
+
+The topology is read from a CSV file, one row per proxy with its policy (the
+class of the proxy), the size of its cache and the name of its parent. The
+share column is the part of the clients (which are not in the client map,
+see below) connected to an edge. lag and bandwidth (kb/s) are those of the
+link to the parent, the [servers] section of the configuration being used
+when they are empty. The proxies without parent are connected to the servers
+like a single proxy.
+
+.. code-block:: none
+
+    "name","proxy_type","cache_size","parent","share","lag","bandwidth"
+    "regional","LRUProxy",256000,,,,
+    "edge1","LRUProxy",64000,"regional",0.6,0.01,20000
+    "edge2","FIFOProxy",32000,"regional",0.4,0.01,20000
+
+The client map is an optional CSV file giving the edge of some clients, by
+their id in the trace:
+
+.. code-block:: none
+
+    "id_client","edge"
+    1,"edge2"
+
+The level of a proxy is 0 for the edges (the proxies which are not the
+parent of another one), and one more than the highest level of its children
+otherwise.
+
+.. code-block:: python
+
+    topo = topology.Topology()
+    topo.load('fake_topology.dat')
+    client_edge = topo.assign(client_ids.keys, 'clients_edges.dat')
+    topo.edges[client_edge[dense_id]]
+
+Code documentation
+==================
+"""
+import csv
+
+import profiles
+
+
+class Topology:
+    """ The proxies of a hierarchy of caches, in the order of the file """
+
+    def __init__(self):
+        self.names = []
+        """ the names of the proxies, by index """
+        self._proxies = dict()
+
+    def add(self, name, proxy_type, cache_size=0, parent=None, share=0,
+            lag=None, bandwidth=None):
+        """ Adds a proxy, or replaces the one with the same name.
+
+            Args:
+                name (str): name of the proxy, also used as its ID
+                proxy_type (str): name of the class of the proxy
+                cache_size (float): size of its cache, in kb
+                parent (str): name of the parent proxy, None to forward the
+                              misses to the servers
+                share (float): part of the clients not in the client map
+                               connected to this proxy, if it is an edge
+                lag (float): latency of the link to the parent, in seconds
+                bandwidth (float): speed of the link to the parent, in kb/s
+        """
+        if name not in self._proxies:
+            self.names.append(name)
+        self._proxies[name] = {'name': name, 'proxy_type': proxy_type,
+                               'cache_size': float(cache_size or 0),
+                               'parent': parent or None,
+                               'share': float(share or 0),
+                               'lag': float(lag) if lag else None,
+                               'bandwidth': float(bandwidth) if bandwidth else None}
+
+    def load(self, file_path):
+        """ Adds the proxies of a CSV file """
+        with open(file_path, 'r') as f:
+            reader = csv.DictReader(filter(lambda row: row[0]!='#', f))
+            for row in reader:
+                self.add(row['name'], row['proxy_type'], row.get('cache_size'),
+                         row.get('parent'), row.get('share'), row.get('lag'),
+                         row.get('bandwidth'))
+        self.check()
+
+    def check(self):
+        """ Raises ValueError if a parent is unknown or if there is a cycle """
+        for name in self.names:
+            seen = {name}
+            parent = self._proxies[name]['parent']
+            while parent is not None:
+                if parent not in self._proxies:
+                    raise ValueError("Unknown parent proxy "+parent+" of "+name)
+                if parent in seen:
+                    raise ValueError("Cycle in the topology at "+parent)
+                seen.add(parent)
+                parent = self._proxies[parent]['parent']
+
+    @property
+    def edges(self):
+        """ names of the proxies which are not the parent of another one """
+        parents = set(p['parent'] for p in self._proxies.values())
+        return [name for name in self.names if name not in parents]
+
+    @property
+    def roots(self):
+        """ names of the proxies connected to the servers """
+        return [name for name in self.names if self._proxies[name]['parent'] is None]
+
+    def levels(self):
+        """ Returns the level of each proxy, by name """
+        levels = dict.fromkeys(self.edges, 0)
+        for name in self.edges:
+            level = 0
+            parent = self._proxies[name]['parent']
+            while parent is not None:
+                level += 1
+                levels[parent] = max(levels.get(parent, 0), level)
+                parent = self._proxies[parent]['parent']
+        return levels
+
+    def assign(self, client_keys, map_path=None):
+        """ Computes the edge of each client.
+
+            Args:
+                client_keys (list): the ids of the clients in the trace,
+                                    indexed by dense id
+                map_path (str): optional CSV file giving the edge of some
+                                clients
+
+            Returns:
+                numpy array of the indexes in :attr:`edges`, by dense id
+        """
+        edges = self.edges
+        return profiles.assign(client_keys,
+                               [self._proxies[name]['share'] for name in edges],
+                               map_path, 'edge',
+                               {name: i for i, name in enumerate(edges)})
+
+    def __getitem__(self, name):
+        return self._proxies[name]
+
+    def __len__(self):
+        return len(self.names)
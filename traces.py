@@ -0,0 +1,520 @@
+#coding=utf-8
+"""
+Presentation
+============
+This module contains the helpers used by the orchestrator to read the trace
+and database files.
+
+IDs in the input files are arbitrary strings. At load time they are interned
+into dense integers with :class:`IdInterner`, so that the rest of the
+simulation only manipulates small integers:
+
+- a video is identified by the pair (id_server, id_video), two servers can
+  have a video with the same id without colliding in the caches
+- a client is identified by its id in the trace
+
+.. code-block:: python
+
+    videos = traces.IdInterner()
+    videos.intern((1, '42'))  # 0
+    videos.intern((2, '42'))  # 1
+    videos.intern((1, '42'))  # 0
+    videos.key(1)             # (2, '42')
+
+The trace is parsed into NumPy arrays by :func:`load_trace_arrays`, which also
+does the preprocessing in bulk: sorting by timestamp, removing the requests 
+for the same video two times in a row by the same client and computing the 
+delays between the requests.
+
+A trace can also be split in several files, one per node and per hour for 
+instance, compressed with gzip, xz or bzip2. :func:`stream_events` decompresses
+them on the fly and merges them by req_timestamp with a heap, so that only
+one row per file is in memory at a time. Each file must be sorted.
+
+.. code-block:: python
+
+    paths = traces.expand_paths('logs/node*.dat.gz')
+    for delay_abs, delay, id_client, id_video, id_server, watch in \
+            traces.stream_events(paths, clients, videos):
+        ...
+
+The optional watch_duration column of the trace gives the seconds of the 
+video watched before the viewer leaves. It is 0 when the column is absent or
+empty, meaning unknown.
+
+To replay only a window of a long trace, a sparse index of the trace is kept
+in a sidecar file (trace.dat.idx): the byte offset of the first request of
+each period of index_step seconds. It is built the first time a window is
+asked for, then the loaders seek directly to the beginning of the window.
+Only a sorted file can be indexed: a single plain trace file which is not 
+sorted is read entirely instead, and the other ones are rejected.
+
+.. code-block:: python
+
+    start = traces.trace_start(paths)
+    # from 18:00 to 22:00 of the first day
+    traces.stream_events(paths, clients, videos, 
+                         start=start+18*3600, end=start+22*3600)
+
+Code documentation
+==================
+"""
+import bz2
+import csv
+import glob
+import gzip
+import heapq
+import io
+import lzma
+import os
+
+import numpy as np
+
+
+class IdInterner:
+    """ Maps hashable keys to dense integers, in order of first appearance.
+
+        The reverse mapping is a list, so that the original key of a dense
+        id can be found without hashing.
+    """
+
+    def __init__(self):
+        self._ids = dict()
+        self.keys = []
+        """ list of the original keys, indexed by dense id """
+
+    def intern(self, key):
+        """ Returns the dense id of key, allocating a new one if needed """
+        id_ = self._ids.get(key)
+        if id_ is None:
+            id_ = len(self.keys)
+            self._ids[key] = id_
+            self.keys.append(key)
+        return id_
+
+    def get(self, key, default=None):
+        """ Returns the dense id of key without allocating a new one """
+        return self._ids.get(key, default)
+
+    def intern_array(self, keys):
+        """ Interns a sequence of keys
+
+            Returns:
+                numpy array of the dense ids, in the same order as keys
+        """
+        return np.fromiter((self.intern(key) for key in keys), 
+                           dtype=np.int64, count=len(keys))
+
+    def key(self, id_):
+        """ Returns the original key of a dense id """
+        return self.keys[id_]
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self.keys)
+
+def normalize_id(id_):
+    """ Returns the canonical form of an id read from a file, so that '007' in
+        the trace and '7' in the database are the same id.
+    """
+    id_ = id_.strip()
+    if id_.isdigit():
+        return str(int(id_))
+    return id_
+
+_OPENERS = {'.gz': gzip.open, '.xz': lzma.open, '.lzma': lzma.open, 
+            '.bz2': bz2.open}
+""" functions to open the compressed files, by extension """
+
+def is_compressed(path):
+    """ True if the file will be decompressed on the fly """
+    return any(path.endswith(ext) for ext in _OPENERS)
+
+def open_binary(path):
+    """ Opens a file in binary mode, decompressing it on the fly if its 
+        extension is .gz, .xz, .lzma or .bz2. The offsets (tell, seek) are
+        the ones of the decompressed data.
+    """
+    for ext, opener in _OPENERS.items():
+        if path.endswith(ext):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+def open_text(path):
+    """ Same as :func:`open_binary`, in text mode """
+    return io.TextIOWrapper(open_binary(path))
+
+def expand_paths(spec):
+    """ Expands a trace specification into a list of files.
+
+        Args:
+            spec (str|list): a path, a glob pattern, comma separated paths or
+                             patterns, or a list of them
+
+        Returns:
+            the sorted list of the paths. A pattern matching nothing is kept 
+            as it is, so that opening it gives a meaningful error.
+    """
+    if isinstance(spec, str):
+        spec = spec.split(',')
+    paths = []
+    for pattern in spec:
+        pattern = pattern.strip()
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches or [pattern])
+    return paths
+
+def _read_header(f):
+    """ Reads the header of an input file opened in binary mode, skipping 
+        the comments.
+
+        Returns:
+            the list of the column names, None if the file is empty
+    """
+    line = f.readline()
+    while line.startswith(b'#'):
+        line = f.readline()
+    if not line:
+        return None
+    return next(csv.reader([line.decode()]))
+
+INDEX_SUFFIX = '.idx'
+""" extension of the sidecar file of the index of a trace """
+
+def build_index(path, step=60):
+    """ Builds the sparse index of a trace file: for each period of step 
+        seconds containing requests, the offset of its first request. The 
+        file must be sorted by timestamp.
+
+        Returns:
+            (timestamps, offsets): numpy arrays, the beginning of the periods 
+            and the offsets in the (decompressed) file
+
+        Raises:
+            ValueError: if the file is not sorted
+    """
+    timestamps = []
+    offsets = []
+    with open_binary(path) as f:
+        header = _read_header(f)
+        if header is None:
+            return np.array(timestamps), np.array(offsets, dtype=np.int64)
+        i_tmstp = header.index('req_timestamp')
+        offset = f.tell()
+        first = None
+        next_period = None
+        last = None
+        for line in f:
+            if line[:1] != b'#' and line.strip():
+                tmstp = float(line.split(b',')[i_tmstp].strip(b'" '))
+                if last is not None and tmstp < last:
+                    raise ValueError(path+" is not sorted by req_timestamp (offset "+
+                                     str(offset)+"), sort it to replay a window of it")
+                last = tmstp
+                if first is None:
+                    first = tmstp
+                    next_period = tmstp
+                if tmstp >= next_period:
+                    period = first + ((tmstp - first)//step)*step
+                    timestamps.append(period)
+                    offsets.append(offset)
+                    next_period = period + step
+            offset += len(line)
+    return np.array(timestamps), np.array(offsets, dtype=np.int64)
+
+def load_index(path, step=60):
+    """ Returns the sparse index of a trace file, see :func:`build_index`.
+
+        The index is read from its sidecar file, or built and written next to
+        the trace if the sidecar does not exist or is out of date.
+    """
+    index_path = path+INDEX_SUFFIX
+    stat = os.stat(path)
+    signature = '# index of a trace, step '+str(step)+', size '+ \
+                str(stat.st_size)+', mtime '+str(stat.st_mtime)+'\n'
+    try:
+        with open(index_path, 'r') as f:
+            if f.readline() == signature:
+                table = np.loadtxt(f, delimiter=',', skiprows=1, ndmin=2)
+                return table[:, 0], table[:, 1].astype(np.int64)
+    except OSError:
+        pass
+
+    print("Building the index of "+path+"...")
+    timestamps, offsets = build_index(path, step)
+    try:
+        with open(index_path, 'w') as f:
+            f.write(signature)
+            f.write('"req_timestamp","offset"\n')
+            for tmstp, offset in zip(timestamps.tolist(), offsets.tolist()):
+                f.write(repr(tmstp)+','+str(offset)+'\n')
+    except OSError:
+        print("Could not write the index "+index_path)
+    return timestamps, offsets
+
+def trace_start(paths, step=60):
+    """ Returns the timestamp of the first request of one or more trace 
+        files, read from their indexes, or from the whole file for a single
+        plain file which is not sorted.
+    """
+    if len(paths) == 1 and not is_compressed(paths[0]):
+        try:
+            firsts = [load_index(paths[0], step)[0][:1]]
+        except ValueError:
+            header, table = read_table(paths[0])
+            firsts = [np.sort(table[:, header.index('req_timestamp')].astype(np.float64))[:1]]
+    else:
+        firsts = [load_index(path, step)[0][:1] for path in paths]
+    firsts = [first[0] for first in firsts if len(first)]
+    if not firsts:
+        return 0
+    return min(firsts)
+
+def _window_offsets(path, start=None, end=None, step=60):
+    """ Returns the (start, end) offsets of the part of a trace file 
+        containing the requests between the timestamps start and end, None
+        meaning the beginning or the end of the file.
+    """
+    if start is None and end is None:
+        return None, None
+    timestamps, offsets = load_index(path, step)
+    start_offset = None
+    end_offset = None
+    if start is not None:
+        i = np.searchsorted(timestamps, start, side='right') - 1
+        if i >= 0:
+            start_offset = int(offsets[i])
+    if end is not None:
+        i = np.searchsorted(timestamps, end, side='right')
+        if i < len(offsets):
+            end_offset = int(offsets[i])
+    return start_offset, end_offset
+
+def read_table(file_path, start_offset=None, end_offset=None, dtype=None):
+    """ Reads a CSV input file (trace or database) into a 2D numpy array.
+
+        Comment lines, beginning with '#', are ignored. The values are parsed 
+        as floats when all of them are numerical, as str otherwise.
+
+        Args:
+            file_path (str): the file to read
+            start_offset (int): if given, where to begin to read the rows
+            end_offset (int): if given, where to stop to read the rows
+            dtype: if given, the type of all the values, like str to keep
+                   the ids exact (a float64 is exact only up to 2**53)
+
+        Returns:
+            (header, table): the list of the column names and the array
+    """
+    with open_binary(file_path) as f:
+        header = _read_header(f)
+        if start_offset is not None:
+            f.seek(start_offset)
+        if end_offset is not None:
+            data = f.read(end_offset - f.tell())
+        else:
+            data = f.read()
+    try:
+        table = np.loadtxt(io.BytesIO(data), delimiter=',', comments='#', 
+                           quotechar='"', ndmin=2, dtype=dtype or np.float64)
+    except ValueError:
+        if dtype is not None:
+            raise
+        # some values are not numbers, like the id of the videos
+        table = np.loadtxt(io.BytesIO(data), delimiter=',', comments='#', 
+                           quotechar='"', ndmin=2, dtype=str)
+    if table.size == 0:
+        table = table.reshape(0, len(header))
+    return header, table
+
+def _id_names(uniques):
+    """ Returns the canonical str form of an array of distinct str ids """
+    return [normalize_id(id_) for id_ in uniques.tolist()]
+
+def load_trace_arrays(file_path, client_ids, video_ids, two_in_a_row=True, 
+                      start=None, end=None, origin=None, index_step=60):
+    """ Loads a trace file and preprocesses it in bulk with NumPy.
+
+        The requests are sorted by timestamp, the file does not need to be, 
+        and if two_in_a_row is True, a request is dropped when the previous request of the same client was 
+        for the same video (like Client.two_in_a_row_protection).
+
+        Args:
+            file_path (str): path to the trace file
+            client_ids (:class:`IdInterner`): interner for the client ids
+            video_ids (:class:`IdInterner`): interner for the 
+                                             (id_server, id_video) pairs
+            two_in_a_row (bool): to drop the duplicated requests
+            start (float): if given, only the requests from this timestamp 
+                           are loaded, the index of the trace is used to seek
+                           to them
+            end (float): if given, only the requests before this timestamp 
+                         are loaded
+            origin (float): timestamp from which the delays are computed, the
+                            first request by default
+            index_step (int): period of the index, in seconds
+
+        Returns:
+            dictionnary of numpy arrays, one entry per request, ordered by time:
+
+            - timestamp (float): req_timestamp of the trace
+            - delay (float): time since the origin
+            - delta (float): time since the previous request
+            - id_client (int): dense id of the client
+            - id_video (int): dense id of the (id_server, id_video) pair
+            - id_server (int): id of the server
+            - watch_duration (float): seconds watched, 0 if unknown
+    """
+    try:
+        offsets = _window_offsets(file_path, start, end, index_step)
+    except ValueError:
+        # not sorted, the window is taken after reading the whole file
+        offsets = (None, None)
+    # read as str, the ids can be any string or big integers
+    header, table = read_table(file_path, *offsets, dtype=str)
+    col = {name: i for i, name in enumerate(header)}
+    timestamps = table[:, col['req_timestamp']].astype(np.float64)
+    if start is not None or end is not None:
+        window = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            window &= timestamps >= start
+        if end is not None:
+            window &= timestamps < end
+        table = table[window]
+        timestamps = timestamps[window]
+    servers = table[:, col['id_server']].astype(np.int64)
+    if 'watch_duration' in col:
+        watch = table[:, col['watch_duration']]
+        watch = np.where(watch == '', '0', watch).astype(np.float64)
+    else:
+        watch = np.zeros(len(timestamps))
+
+    # interning, only the distinct values are handled in Python
+    clients_u, clients_inv = np.unique(table[:, col['id_client']], 
+                                       return_inverse=True)
+    clients = client_ids.intern_array(_id_names(clients_u))[clients_inv]
+
+    # the (id_server, id_video) pairs are interned with one integer per pair
+    videos_u, videos_inv = np.unique(table[:, col['id_video']], 
+                                     return_inverse=True)
+    nb_videos = max(len(videos_u), 1)
+    pairs_u, pairs_inv = np.unique(servers*nb_videos+videos_inv, 
+                                   return_inverse=True)
+    names = _id_names(videos_u)
+    pairs = [(id_server, names[i]) for id_server, i in 
+             zip((pairs_u//nb_videos).tolist(), (pairs_u%nb_videos).tolist())]
+    videos = video_ids.intern_array(pairs)[pairs_inv]
+
+    # unsorted traces would give negative delays
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    clients = clients[order]
+    videos = videos[order]
+    servers = servers[order]
+    watch = watch[order]
+
+    if two_in_a_row and len(order) > 1:
+        # grouping by client, keeping the time order in each group
+        by_client = np.argsort(clients, kind='stable')
+        c = clients[by_client]
+        v = videos[by_client]
+        dup = np.zeros(len(order), dtype=bool)
+        dup[by_client[1:]] = (c[1:] == c[:-1]) & (v[1:] == v[:-1])
+        keep = ~dup
+        timestamps = timestamps[keep]
+        clients = clients[keep]
+        videos = videos[keep]
+        servers = servers[keep]
+        watch = watch[keep]
+
+    if origin is None and len(timestamps):
+        origin = timestamps[0]
+    delays = timestamps - (origin or 0)
+    deltas = np.diff(delays, prepend=0)
+
+    return {'timestamp': timestamps, 'delay': delays, 'delta': deltas,
+            'id_client': clients, 'id_video': videos, 'id_server': servers,
+            'watch_duration': watch}
+
+def iter_rows(path, start=None, end=None, index_step=60):
+    """ Reads a trace file row by row.
+
+        Args:
+            path (str): the trace file
+            start (float): if given, the rows before this timestamp are 
+                           skipped, seeking directly to them with the index
+            end (float): if given, the reading stops at this timestamp
+
+        Yields:
+            tuples (req_timestamp, id_client, id_video, id_server, 
+            watch_duration), the ids of the client and video being 
+            normalized str
+    """
+    start_offset, end_offset = _window_offsets(path, start, end, index_step)
+    with open_binary(path) as f:
+        header = _read_header(f)
+        if header is None:
+            return
+        if start_offset is not None:
+            f.seek(start_offset)
+        col = {name: i for i, name in enumerate(header)}
+        i_tmstp = col['req_timestamp']
+        i_client = col['id_client']
+        i_video = col['id_video']
+        i_server = col['id_server']
+        i_watch = col.get('watch_duration')
+        reader = csv.reader(line for line in io.TextIOWrapper(f) 
+                            if line[0] != '#')
+        for row in reader:
+            if not row:
+                continue
+            tmstp = float(row[i_tmstp])
+            if start is not None and tmstp < start:
+                continue
+            if end is not None and tmstp >= end:
+                return
+            watch = 0.0
+            if i_watch is not None and row[i_watch]:
+                watch = float(row[i_watch])
+            yield (tmstp, normalize_id(row[i_client]), 
+                   normalize_id(row[i_video]), int(row[i_server]), watch)
+
+def merge_rows(paths, start=None, end=None, index_step=60):
+    """ k-way merge of the rows of several sorted trace files, by timestamp """
+    if len(paths) == 1:
+        return iter_rows(paths[0], start, end, index_step)
+    return heapq.merge(*[iter_rows(path, start, end, index_step) 
+                         for path in paths], 
+                       key=lambda row: row[0])
+
+def stream_events(paths, client_ids, video_ids, two_in_a_row=True, 
+                  start=None, end=None, origin=None, index_step=60):
+    """ Streams the requests of one or more trace files, in time order.
+
+        Same preprocessing and arguments as :func:`load_trace_arrays`, but 
+        row by row and with a memory bounded by the number of files (and of 
+        clients, to remove the requests two times in a row). A row older than
+        the previous one (unsorted file) is replayed without waiting.
+
+        Yields:
+            tuples (delay_abs, delay, id_client, id_video, id_server, 
+            watch_duration) with the dense ids of the client and of the video
+    """
+    last_delay = 0
+    last_video = dict()
+    for tmstp, client, video, id_server, watch in merge_rows(paths, start, end, 
+                                                             index_step):
+        id_client = client_ids.intern(client)
+        id_video = video_ids.intern((id_server, video))
+        if two_in_a_row:
+            if last_video.get(id_client) == id_video:
+                continue
+            last_video[id_client] = id_video
+        if origin is None:
+            origin = tmstp
+        delay = tmstp - origin
+        yield (delay, max(delay - last_delay, 0), id_client, id_video, id_server,
+               watch)
+        last_delay = max(delay, last_delay)